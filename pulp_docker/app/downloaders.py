@@ -1,112 +1,557 @@
+from email.utils import parsedate_to_datetime
 from gettext import gettext as _
 from logging import getLogger
 from urllib import parse
 import asyncio
 import backoff
+import hashlib
 import json
+import math
+import os
 import re
+import tempfile
+import time
 
-from aiohttp.client_exceptions import ClientResponseError
+from aiohttp.client_exceptions import (
+    ClientConnectionError,
+    ClientPayloadError,
+    ClientResponseError,
+)
+from django.conf import settings
 
-from pulpcore.plugin.download import http_giveup, HttpDownloader
+from pulpcore.plugin.download import DownloadResult, http_giveup, HttpDownloader
+from pulpcore.plugin.exceptions import DigestValidationError, SizeValidationError
+from pulpcore.plugin.models import Artifact
 
 
 log = getLogger(__name__)
 
 
+# Bodies up to this size are kept in memory when extra_data['buffer_body'] is set. Can be
+# overridden with the DOCKER_MAX_BUFFERED_BODY_SIZE setting.
+DEFAULT_MAX_BUFFERED_BODY_SIZE = 4 * 1024 * 1024
+
+# Blobs larger than this are downloaded with parallel range requests. Can be overridden with the
+# DOCKER_RANGED_DOWNLOAD_THRESHOLD setting.
+DEFAULT_RANGED_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+
+# Number of range requests a large blob is split into. Can be overridden with the
+# DOCKER_RANGED_DOWNLOAD_PARTS setting.
+DEFAULT_RANGED_DOWNLOAD_PARTS = 4
+
+# Size of the chunks read from responses and from downloaded files.
+CHUNK_SIZE = 1024 * 1024
+
+# Errors after which an interrupted download is resumed from the last byte received.
+TRANSIENT_ERRORS = (ClientConnectionError, ClientPayloadError, asyncio.TimeoutError)
+
+# Number of times a download, or a part of a ranged download, is attempted before the error of
+# the last attempt is raised.
+MAX_RESUME_ATTEMPTS = 5
+
+# Number of times a request is retried after the registry responded with 429 Too Many Requests.
+MAX_RATE_LIMITED_ATTEMPTS = 10
+
+# Longest delay in seconds before retrying a request that was rate limited without Retry-After.
+MAX_RATE_LIMITED_DELAY = 60
+
+# A request is not retried when Retry-After asks to wait longer than this many seconds. Can be
+# overridden with the DOCKER_MAX_RETRY_AFTER setting.
+DEFAULT_MAX_RETRY_AFTER = 300
+
+
+def giveup(exc):
+    """
+    Decide whether to give up on a request after an HTTP error.
+
+    Responses with 429 Too Many Requests are retried by the downloader itself, observing the
+    Retry-After header.
+
+    Args:
+        exc (aiohttp.ClientResponseError): The error of the request.
+
+    Returns:
+        bool: True if the request should not be retried.
+
+    """
+    return exc.status == 429 or http_giveup(exc)
+
+
 class TokenAuthHttpDownloader(HttpDownloader):
     """
     Custom Downloader that automatically handles Token Authentication.
 
     Additionally, use custom headers from DeclarativeArtifact.extra_data['headers']
-    """
 
-    token = {'token': None}
-    token_lock = asyncio.Lock()
+    When DeclarativeArtifact.extra_data['buffer_body'] is set, a small response body is also
+    kept in memory and stored in DeclarativeArtifact.extra_data['body'], so it can be used
+    without reading the downloaded file back.
+
+    When DeclarativeArtifact.extra_data['size'] is larger than the
+    DOCKER_RANGED_DOWNLOAD_THRESHOLD setting, the body is downloaded in parts with parallel range
+    requests. Registries that do not support range requests send the whole body instead.
+
+    A download interrupted by a connection error or a timeout is resumed with a range request
+    from the last byte received, keeping the partial file and the digests computed so far. The
+    download starts over if the registry sends the whole body again.
+
+    The downloader opens the file it writes to, so a download that starts over or is written in
+    parts can rewrite it. The size and digests of such a download are computed from the file.
+    """
 
     def __init__(self, *args, **kwargs):
         """
         Initialize the downloader.
         """
         self.remote = kwargs.pop('remote')
-        super().__init__(*args, **kwargs)
+        self.token_cache = self.remote.token_cache
+        self._body = None
+        self._file = kwargs.get('custom_file_object')
+        if self._file is None:
+            self._file = tempfile.NamedTemporaryFile(dir=os.getcwd(), delete=False)
+            kwargs['custom_file_object'] = self._file
+            super().__init__(*args, **kwargs)
+            self.path = self._file.name
+        else:
+            super().__init__(*args, **kwargs)
+        # Bytes of the body received so far.
+        self._received = 0
+        # Set when the file was not written in order, so its size and digests are computed from
+        # the file.
+        self._rewritten = False
+        self._file_attributes = None
 
-    @backoff.on_exception(backoff.expo, ClientResponseError, max_tries=10, giveup=http_giveup)
-    async def _run(self, handle_401=True, extra_data=None):
+    @backoff.on_exception(backoff.expo, ClientResponseError, max_tries=10, giveup=giveup)
+    @backoff.on_exception(backoff.expo, TRANSIENT_ERRORS, max_tries=MAX_RESUME_ATTEMPTS)
+    async def _run(self, handle_401=True, extra_data=None, rate_limited=0):
         """
         Download, validate, and compute digests on the `url`. This is a coroutine.
 
-        This method is decorated with a backoff-and-retry behavior to retry HTTP 429 errors. It
+        This method is decorated with a backoff-and-retry behavior to retry HTTP 5xx errors. It
         retries with exponential backoff 10 times before allowing a final exception to be raised.
+        Connection errors and timeouts are retried MAX_RESUME_ATTEMPTS times, resuming the
+        download where the previous attempt was interrupted.
+
+        Requests rejected with HTTP 429 are retried after the delay in the Retry-After header,
+        and make the remote lower the number of concurrent downloads.
 
         This method provides the same return object type and documented in
         :meth:`~pulpcore.plugin.download.BaseDownloader._run`.
 
         Args:
             handle_401(bool): If true, catch 401, request a new token and retry.
+            extra_data(dict): Optional `headers` to send, the HTTP `method` to use, which
+                defaults to 'get', whether to `buffer_body` in memory, and the expected `size`
+                of the body.
+            rate_limited(int): The number of times the request was rejected with HTTP 429.
         """
         headers = {}
+        method = 'get'
+        parts = None
         if extra_data is not None:
-            headers = extra_data.get('headers', headers)
-        this_token = self.token['token']
+            headers = dict(extra_data.get('headers', headers))
+            method = extra_data.get('method', method)
+            if extra_data.get('buffer_body'):
+                self._body = bytearray()
+            elif method == 'get':
+                parts = self.plan_parts(extra_data.get('size'))
+        challenge = self.token_cache.challenge
+        this_token = await self.get_token(challenge) if challenge else None
         auth_headers = self.auth_header(this_token)
-        headers.update(auth_headers)
-        async with self.session.get(self.url, headers=headers) as response:
+        resume_from = 0
+        if self._received:
+            # A previous attempt was interrupted after receiving part of the body.
+            if self._body is None:
+                resume_from = self._received
+                parts = None
+            else:
+                self._restart()
+        request_headers = dict(headers, **auth_headers)
+        if resume_from:
+            log.info(_("Resuming download of {url} from byte {start}").format(
+                url=self.url, start=resume_from))
+            request_headers['Range'] = 'bytes={start}-'.format(start=resume_from)
+        elif parts:
+            # The first part doubles as the probe for range support.
+            request_headers['Range'] = range_header(parts[0])
+        async with self.session.request(method, self.url, headers=request_headers) as response:
             try:
                 response.raise_for_status()
             except ClientResponseError as e:
                 response_auth_header = response.headers.get('www-authenticate')
                 # Need to retry request
                 if handle_401 and e.status == 401 and response_auth_header is not None:
-                    # Token has not been updated during request
-                    if self.token['token'] is None or \
-                       self.token['token'] == this_token:
-
-                        self.token['token'] = None
-                        await self.update_token(response_auth_header, this_token)
-                    return await self._run(handle_401=False)
+                    challenge = parse_challenge(response_auth_header)
+                    # Unless another request refreshed it already, the token is not valid.
+                    self.token_cache.invalidate(challenge, this_token)
+                    self.token_cache.challenge = challenge
+                    return await self._run(handle_401=False, extra_data=extra_data,
+                                           rate_limited=rate_limited)
+                elif e.status == 429 and rate_limited < MAX_RATE_LIMITED_ATTEMPTS:
+                    await response.release()
+                    await self.wait_after_rate_limit(response, rate_limited)
+                    return await self._run(handle_401=handle_401, extra_data=extra_data,
+                                           rate_limited=rate_limited + 1)
                 else:
                     raise
-            to_return = await self._handle_response(response)
+            self.remote.download_limiter.succeeded()
+            if resume_from:
+                self._check_resumed_response(response, resume_from)
+            if parts and response.status == 206:
+                to_return = await self._handle_ranged_response(response, parts, headers)
+            else:
+                to_return = await self._handle_response(response)
             await response.release()
             self.response_headers = response.headers
 
+        if self._body is not None:
+            extra_data['body'] = bytes(self._body)
+            self._body = None
+
         if self._close_session_on_finalize:
             self.session.close()
         return to_return
 
-    async def update_token(self, response_auth_header, used_token):
+    async def handle_data(self, data):
+        """
+        Write data to the file, and keep it in memory if the body is buffered.
+
+        Buffering stops once the body grows past the DOCKER_MAX_BUFFERED_BODY_SIZE setting.
+
+        Args:
+            data (bytes): The data to be handled by the downloader.
+        """
+        await super().handle_data(data)
+        self._received += len(data)
+        if self._body is not None:
+            max_size = getattr(settings, 'DOCKER_MAX_BUFFERED_BODY_SIZE',
+                               DEFAULT_MAX_BUFFERED_BODY_SIZE)
+            if len(self._body) + len(data) > max_size:
+                self._body = None
+            else:
+                self._body.extend(data)
+
+    async def wait_after_rate_limit(self, response, rate_limited):
+        """
+        Lower the download concurrency of the remote and wait before retrying a request.
+
+        Args:
+            response (aiohttp.ClientResponse): The 429 Too Many Requests response.
+            rate_limited (int): The number of times the request was rate limited before.
+
+        Raises:
+            aiohttp.ClientResponseError: When Retry-After asks to wait longer than the
+                DOCKER_MAX_RETRY_AFTER setting.
+
+        """
+        self.remote.download_limiter.throttled()
+        delay = parse_retry_after(response.headers.get('Retry-After'))
+        if delay is None:
+            delay = min(2 ** rate_limited, MAX_RATE_LIMITED_DELAY)
+        elif delay > getattr(settings, 'DOCKER_MAX_RETRY_AFTER', DEFAULT_MAX_RETRY_AFTER):
+            response.raise_for_status()
+        log.info(_("{url} is rate limited, retrying in {delay} seconds").format(
+            url=self.url, delay=delay))
+        await asyncio.sleep(delay)
+
+    def _check_resumed_response(self, response, resume_from):
+        """
+        Prepare to continue an interrupted download with the response to a range request.
+
+        Args:
+            response (aiohttp.ClientResponse): The response to the range request.
+            resume_from (int): The position of the first byte that was requested.
+
+        Raises:
+            IOError: When the registry responded with a different range.
+
+        """
+        if response.status != 206:
+            # The registry sent the whole body.
+            self._restart()
+        elif parse_content_range(response.headers.get('Content-Range'))[0] != resume_from:
+            raise IOError(_("{url} responded with an unexpected range for bytes "
+                            "{first}-.").format(url=self.url, first=resume_from))
+
+    def _restart(self):
+        """
+        Discard the partial body of an interrupted download.
+        """
+        self._file.seek(0)
+        self._file.truncate()
+        self._received = 0
+        self._rewritten = True
+
+    @staticmethod
+    def plan_parts(size):
+        """
+        Split a body into the parts to download with parallel range requests.
+
+        Args:
+            size (int): The expected size of the body in bytes, or None if it is not known.
+
+        Returns:
+            list: The (first, last) byte positions of each part, or None if the body is
+                downloaded with a single request.
+
+        """
+        threshold = getattr(settings, 'DOCKER_RANGED_DOWNLOAD_THRESHOLD',
+                            DEFAULT_RANGED_DOWNLOAD_THRESHOLD)
+        if not size or size <= threshold:
+            return None
+        count = getattr(settings, 'DOCKER_RANGED_DOWNLOAD_PARTS', DEFAULT_RANGED_DOWNLOAD_PARTS)
+        return split_ranges(size, count)
+
+    async def _handle_ranged_response(self, response, parts, headers):
+        """
+        Download the remaining parts of a body in parallel, the first part being the response.
+
+        The parts are written to their positions in the file. The size and digests are computed
+        from the whole file by :meth:`finalize`.
+
+        Args:
+            response (aiohttp.ClientResponse): The response to the request of the first part.
+            parts (list): The (first, last) byte positions of each part.
+            headers (dict): The headers to send with the requests of the remaining parts, except
+                the Authorization header.
+
+        Returns:
+            :class:`~pulpcore.plugin.download.DownloadResult`: The result of the download.
+
         """
-        Update the Bearer token to be used with all requests.
+        self._rewritten = True
+        self._file.truncate(parts[-1][1] + 1)
+        downloads = [asyncio.ensure_future(self._download_part(parts[0], headers,
+                                                               response=response))]
+        downloads.extend(asyncio.ensure_future(self._download_part(part, headers))
+                         for part in parts[1:])
+        try:
+            await asyncio.gather(*downloads)
+        finally:
+            # When a part fails, the others are of no use, so their requests are stopped.
+            for download in downloads:
+                download.cancel()
+            await asyncio.gather(*downloads, return_exceptions=True)
+        await self.finalize()
+        return DownloadResult(path=self.path, artifact_attributes=self.artifact_attributes,
+                              url=self.url, exception=None)
+
+    async def _download_part(self, part, headers, response=None):
         """
-        async with self.token_lock:
-            if self.token['token'] is not None and self.token['token'] == used_token:
+        Download one part of a body with a range request.
+
+        A part that is interrupted by a connection error or a timeout is resumed from the last
+        byte received. Each request gets a valid token, and a part rejected with HTTP 401 is
+        requested once more with a new token.
+
+        Args:
+            part (tuple): The first and last byte positions of the part.
+            headers (dict): The headers to send with the request, except the Authorization
+                header.
+            response (aiohttp.ClientResponse): The response to the request of the part, if it
+                was already requested.
+
+        Raises:
+            IOError: When the part could not be downloaded in MAX_RESUME_ATTEMPTS attempts.
+
+        """
+        first, last = part
+        attempt = 0
+        rate_limited = 0
+        handle_401 = True
+        while attempt < MAX_RESUME_ATTEMPTS:
+            attempt += 1
+            if response is not None:
+                first = await self._write_part(response, (first, last))
+            else:
+                challenge = self.token_cache.challenge
+                token = await self.get_token(challenge) if challenge else None
+                part_headers = dict(headers, Range=range_header((first, last)),
+                                    **self.auth_header(token))
+                try:
+                    async with self.session.get(self.url, headers=part_headers) as response:
+                        response_auth_header = response.headers.get('www-authenticate')
+                        unauthorized = response.status == 401 and response_auth_header is not None
+                        if unauthorized and handle_401:
+                            await response.release()
+                            challenge = parse_challenge(response_auth_header)
+                            # Unless another request refreshed it already, the token is not valid.
+                            self.token_cache.invalidate(challenge, token)
+                            self.token_cache.challenge = challenge
+                            handle_401 = False
+                            attempt -= 1
+                            response = None
+                            continue
+                        if response.status == 429 and rate_limited < MAX_RATE_LIMITED_ATTEMPTS:
+                            await response.release()
+                            await self.wait_after_rate_limit(response, rate_limited)
+                            rate_limited += 1
+                            attempt -= 1
+                            response = None
+                            continue
+                        response.raise_for_status()
+                        if response.status != 206:
+                            raise IOError(_("{url} did not respond to a range request with "
+                                            "partial content.").format(url=self.url))
+                        first = await self._write_part(response, (first, last))
+                except TRANSIENT_ERRORS as exc:
+                    log.info(_("Request for bytes {first}-{last} of {url} failed: {exc}").format(
+                        first=first, last=last, url=self.url, exc=exc))
+            response = None
+            if first > last:
                 return
-            log.info("Updating bearer token")
-            bearer_info_string = response_auth_header[len("Bearer "):]
-            bearer_info_list = re.split(',(?=[^=,]+=)', bearer_info_string)
-
-            # The remaining string consists of comma seperated key=value pairs
-            auth_query_dict = {}
-            for key, value in (item.split('=') for item in bearer_info_list):
-                # The value is a string within a string, ex: '"value"'
-                auth_query_dict[key] = json.loads(value)
-            try:
-                token_base_url = auth_query_dict.pop('realm')
-            except KeyError:
-                raise IOError(_("No realm specified for token auth challenge."))
+            if attempt < MAX_RESUME_ATTEMPTS:
+                await asyncio.sleep(2 ** attempt)
+        raise IOError(_("Bytes {first}-{last} of {url} could not be downloaded in {attempts} "
+                        "attempts.").format(first=first, last=last, url=self.url,
+                                            attempts=MAX_RESUME_ATTEMPTS))
+
+    async def _write_part(self, response, part):
+        """
+        Write the body of a response to the position of its part in the file.
+
+        Args:
+            response (aiohttp.ClientResponse): A partial content response.
+            part (tuple): The first and last byte positions of the part.
+
+        Returns:
+            int: The position after the last byte written. It is short of the end of the part
+                when the transfer was interrupted by a connection error or a timeout.
+
+        Raises:
+            IOError: When the response is not for the part, or longer than the part.
+
+        """
+        first, last = part
+        if parse_content_range(response.headers.get('Content-Range'))[:2] != part:
+            raise IOError(_("{url} responded with an unexpected range for bytes "
+                            "{first}-{last}.").format(url=self.url, first=first, last=last))
+        fd = self._file.fileno()
+        position = first
+        try:
+            while True:
+                chunk = await response.content.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                os.pwrite(fd, chunk, position)
+                position += len(chunk)
+        except TRANSIENT_ERRORS as exc:
+            log.info(_("Download of bytes {first}-{last} of {url} was interrupted at byte "
+                       "{position}: {exc}").format(first=first, last=last, url=self.url,
+                                                   position=position, exc=exc))
+            return position
+        if position != last + 1:
+            raise IOError(_("{url} sent {received} of {expected} bytes of a range.").format(
+                url=self.url, received=position - first, expected=last + 1 - first))
+        return position
+
+    async def finalize(self):
+        """
+        Compute the size and digests of a rewritten file, then close and validate the file.
+        """
+        if self._rewritten:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self._record_file_size_and_digests)
+        await super().finalize()
+
+    def _record_file_size_and_digests(self):
+        """
+        Compute the size and digests of the downloaded file.
+        """
+        digests = {name: hashlib.new(name) for name in Artifact.DIGEST_FIELDS}
+        size = 0
+        self._file.flush()
+        self._file.seek(0)
+        while True:
+            chunk = self._file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            for digest in digests.values():
+                digest.update(chunk)
+        self._file_attributes = {name: digest.hexdigest() for name, digest in digests.items()}
+        self._file_attributes['size'] = size
 
-            # Construct a url with query parameters containing token auth challenge info
-            parsed_url = parse.urlparse(token_base_url)
-            # Add auth query params to query dict and urlencode into a string
-            new_query = parse.urlencode({**parse.parse_qs(parsed_url.query), **auth_query_dict})
-            updated_parsed = parsed_url._replace(query=new_query)
-            token_url = parse.urlunparse(updated_parsed)
+    @property
+    def artifact_attributes(self):
+        """
+        The size and digests of the download, computed from the file if it was rewritten.
+        """
+        if self._file_attributes is None:
+            return super().artifact_attributes
+        return dict(self._file_attributes)
+
+    def validate_digests(self):
+        """
+        Validate the digests of the download against the expected digests.
 
-            async with self.session.get(token_url, raise_for_status=True) as token_response:
-                token_data = await token_response.text()
+        Raises:
+            :class:`~pulpcore.plugin.exceptions.DigestValidationError`: When a digest does not
+                match.
 
-            self.token['token'] = json.loads(token_data)['token']
+        """
+        if self._file_attributes is None:
+            return super().validate_digests()
+        for algorithm, expected_digest in (self.expected_digests or {}).items():
+            if self._file_attributes[algorithm] != expected_digest:
+                raise DigestValidationError()
+
+    def validate_size(self):
+        """
+        Validate the size of the download against the expected size.
+
+        Raises:
+            :class:`~pulpcore.plugin.exceptions.SizeValidationError`: When the size does not
+                match.
+
+        """
+        if self._file_attributes is None:
+            return super().validate_size()
+        if self.expected_size and self._file_attributes['size'] != self.expected_size:
+            raise SizeValidationError()
+
+    async def get_token(self, challenge):
+        """
+        Return a Bearer token for an auth challenge, requesting one if needed.
+
+        Args:
+            challenge (tuple): The (realm, service, scope) of a token auth challenge.
+
+        Returns:
+            str: The Bearer token.
+
+        """
+        return await self.token_cache.get_token(challenge, self.fetch_token)
+
+    async def fetch_token(self, challenge):
+        """
+        Request a new Bearer token from the token server.
+
+        Args:
+            challenge (tuple): The (realm, service, scope) of a token auth challenge.
+
+        Returns:
+            tuple: The token and the number of seconds it is valid for.
+
+        """
+        log.info("Updating bearer token")
+        realm, service, scope = challenge
+        auth_query_dict = {key: value for key, value in (('service', service), ('scope', scope))
+                           if value is not None}
+
+        # Construct a url with query parameters containing token auth challenge info
+        parsed_url = parse.urlparse(realm)
+        # Add auth query params to query dict and urlencode into a string
+        new_query = parse.urlencode({**parse.parse_qs(parsed_url.query), **auth_query_dict},
+                                    doseq=True)
+        updated_parsed = parsed_url._replace(query=new_query)
+        token_url = parse.urlunparse(updated_parsed)
+
+        async with self.session.get(token_url, raise_for_status=True) as token_response:
+            token_data = json.loads(await token_response.text())
+
+        token = token_data.get('token') or token_data.get('access_token')
+        return token, token_data.get('expires_in') or TokenCache.DEFAULT_EXPIRES_IN
 
     @staticmethod
     def auth_header(token):
@@ -123,3 +568,297 @@ class TokenAuthHttpDownloader(HttpDownloader):
         if token is not None:
             return {'Authorization': 'Bearer {token}'.format(token=token)}
         return {}
+
+
+def split_ranges(size, count):
+    """
+    Split a body into consecutive byte ranges of about the same size.
+
+    Args:
+        size (int): The size of the body in bytes.
+        count (int): The number of ranges to split it into.
+
+    Returns:
+        list: The (first, last) byte positions of each range, inclusive.
+
+    """
+    part_size = math.ceil(size / max(count, 1))
+    return [(first, min(first + part_size, size) - 1) for first in range(0, size, part_size)]
+
+
+def range_header(part):
+    """
+    Create the value of a `Range` header.
+
+    Args:
+        part (tuple): The first and last byte positions of the range, inclusive.
+
+    Returns:
+        str: The header value, e.g. 'bytes=0-1023'.
+
+    """
+    return 'bytes={first}-{last}'.format(first=part[0], last=part[1])
+
+
+def parse_content_range(content_range):
+    """
+    Parse the `Content-Range` header of a partial content response.
+
+    Args:
+        content_range (str): Value of the header, e.g. 'bytes 0-1023/4096'.
+
+    Returns:
+        tuple: The first and last byte positions of the range and the size of the whole body.
+            The size is None if it is not known. All are None if the header cannot be parsed.
+
+    """
+    match = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)$', (content_range or '').strip())
+    if match is None:
+        return None, None, None
+    first, last, size = match.groups()
+    return int(first), int(last), None if size == '*' else int(size)
+
+
+def parse_retry_after(retry_after):
+    """
+    Parse the `Retry-After` header of a response.
+
+    Args:
+        retry_after (str): Value of the header, either a number of seconds or an HTTP date.
+
+    Returns:
+        float: The number of seconds to wait, or None if the header is missing or invalid.
+
+    """
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+def parse_challenge(response_auth_header):
+    """
+    Parse the `www-authenticate` header of a token auth challenge.
+
+    Args:
+        response_auth_header (str): Value of the header, e.g.
+            'Bearer realm="https://auth.docker.io/token",service="registry.docker.io"'
+
+    Returns:
+        tuple: The realm, service and scope of the challenge. Service and scope may be None.
+
+    Raises:
+        IOError: When the challenge does not specify a realm.
+
+    """
+    bearer_info_string = response_auth_header[len("Bearer "):]
+    bearer_info_list = re.split(',(?=[^=,]+=)', bearer_info_string)
+
+    # The remaining string consists of comma seperated key=value pairs
+    auth_query_dict = {}
+    for key, value in (item.split('=', 1) for item in bearer_info_list):
+        # The value is a string within a string, ex: '"value"'
+        auth_query_dict[key.strip()] = json.loads(value)
+    try:
+        realm = auth_query_dict['realm']
+    except KeyError:
+        raise IOError(_("No realm specified for token auth challenge."))
+    return realm, auth_query_dict.get('service'), auth_query_dict.get('scope')
+
+
+class TokenCache:
+    """
+    Bearer tokens of a remote, keyed by the (realm, service, scope) of their auth challenge.
+
+    Tokens are requested again shortly before they expire, and concurrent requests for the
+    token of the same challenge share a single request to the token server.
+
+    Attributes:
+        challenge (tuple): The most recent auth challenge of the upstream registry, or None
+            until the registry asked for a token.
+    """
+
+    # Tokens are refreshed this many seconds before they expire, or halfway through their
+    # lifetime if they are valid for less than twice as long.
+    REFRESH_MARGIN = 10
+
+    # Lifetime of tokens issued without `expires_in`, as defined by the token specification.
+    DEFAULT_EXPIRES_IN = 60
+
+    def __init__(self):
+        """Initialize an empty cache."""
+        self.challenge = None
+        self._tokens = {}
+        self._requests = {}
+
+    def get(self, challenge):
+        """
+        Return the cached token for a challenge.
+
+        Args:
+            challenge (tuple): The (realm, service, scope) of a token auth challenge.
+
+        Returns:
+            str: The token, or None if there is none or it is about to expire.
+
+        """
+        token, refresh_at = self._tokens.get(challenge, (None, 0))
+        if time.monotonic() >= refresh_at:
+            return None
+        return token
+
+    async def get_token(self, challenge, fetch):
+        """
+        Return a valid token for a challenge, requesting one if needed.
+
+        Args:
+            challenge (tuple): The (realm, service, scope) of a token auth challenge.
+            fetch (coroutine function): Called with the challenge to request a new token. Returns
+                the token and the number of seconds it is valid for.
+
+        Returns:
+            str: The token.
+
+        """
+        token = self.get(challenge)
+        if token is not None:
+            return token
+        request = self._requests.get(challenge)
+        if request is None:
+            request = asyncio.ensure_future(self._request(challenge, fetch))
+            self._requests[challenge] = request
+        return await asyncio.shield(request)
+
+    async def _request(self, challenge, fetch):
+        try:
+            token, expires_in = await fetch(challenge)
+            margin = min(self.REFRESH_MARGIN, expires_in / 2)
+            self._tokens[challenge] = (token, time.monotonic() + expires_in - margin)
+            return token
+        finally:
+            del self._requests[challenge]
+
+    def share(self, other):
+        """
+        Use the tokens of another cache, for a remote of the same registry.
+
+        Tokens are keyed by their scope, so each remote still gets tokens for its own upstream
+        repository, but tokens of the same scope are only requested once. The most recent
+        challenge is not shared.
+
+        Args:
+            other (TokenCache): The cache whose tokens to use.
+        """
+        self._tokens = other._tokens
+        self._requests = other._requests
+
+    def invalidate(self, challenge, token):
+        """
+        Forget the token of a challenge if it is the given token.
+
+        Args:
+            challenge (tuple): The (realm, service, scope) of a token auth challenge.
+            token (str): The token the registry did not accept.
+        """
+        if self._tokens.get(challenge, (None, 0))[0] == token:
+            del self._tokens[challenge]
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Limit the number of concurrent downloads of a remote, adapting to rate limiting.
+
+    It is used as the semaphore of the downloaders. The limit is halved when the registry
+    rejects a request with 429 Too Many Requests, and raised by one after each limit of
+    successful responses, but never above the initial limit.
+
+    Attributes:
+        limit (int): The current number of downloads allowed to run concurrently.
+        maximum (int): The highest limit.
+        parent: An asynchronous context manager, such as an asyncio.Semaphore, that every
+            download also has to enter, or None. It limits the downloads of several remotes.
+    """
+
+    # The limit is not lowered again for this many seconds, so a burst of rejected concurrent
+    # requests only halves it once.
+    COOLDOWN = 1
+
+    def __init__(self, maximum):
+        """
+        Initialize the limiter.
+
+        Args:
+            maximum (int): The highest, and initial, number of concurrent downloads.
+        """
+        self.maximum = max(maximum, 1)
+        self.limit = self.maximum
+        self.in_use = 0
+        self._successes = 0
+        self._throttled_at = None
+        self._condition = None
+        self.parent = None
+
+    async def __aenter__(self):
+        """Wait until a download is allowed to start."""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_use < self.limit)
+            self.in_use += 1
+        if self.parent is not None:
+            try:
+                await self.parent.__aenter__()
+            except BaseException:
+                await self._release()
+                raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """Let the next download start."""
+        if self.parent is not None:
+            await self.parent.__aexit__(exc_type, exc, tb)
+        await self._release()
+
+    async def _release(self):
+        async with self._condition:
+            self.in_use -= 1
+            self._condition.notify(max(self.limit - self.in_use, 0))
+
+    async def wait_idle(self):
+        """Wait until no download is running."""
+        if self._condition is None:
+            return
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_use == 0)
+
+    def throttled(self):
+        """
+        Halve the limit after a request was rejected with 429 Too Many Requests.
+        """
+        now = time.monotonic()
+        if self._throttled_at is not None and now - self._throttled_at < self.COOLDOWN:
+            return
+        self._throttled_at = now
+        self._successes = 0
+        self.limit = max(self.limit // 2, 1)
+        log.info(_("Lowered download concurrency to {limit}").format(limit=self.limit))
+
+    def succeeded(self):
+        """
+        Raise the limit by one after a window of successful responses.
+        """
+        if self.limit >= self.maximum:
+            return
+        self._successes += 1
+        if self._successes >= self.limit:
+            self._successes = 0
+            # Waiting downloads are let in as running ones finish.
+            self.limit += 1
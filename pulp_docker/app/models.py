@@ -1,10 +1,13 @@
+from fnmatch import fnmatchcase
 from logging import getLogger
 from types import SimpleNamespace
 
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 
 from pulpcore.plugin.download import DownloaderFactory
-from pulpcore.plugin.models import BaseDistribution, Content, Remote, Publisher
+from pulpcore.plugin.models import (BaseDistribution, Content, Remote, Publisher, Repository,
+                                    Task)
 
 from . import downloaders
 
@@ -22,6 +25,22 @@ MEDIA_TYPE = SimpleNamespace(
 )
 
 
+def _split_patterns(patterns):
+    """
+    Split a comma separated list of glob patterns.
+
+    Args:
+        patterns (str): Comma separated patterns, or None.
+
+    Returns:
+        list: The non-empty patterns.
+
+    """
+    if not patterns:
+        return []
+    return [pattern.strip() for pattern in patterns.split(',') if pattern.strip()]
+
+
 class SingleArtifact:
     """
     Mixin for Content with only 1 artifact.
@@ -31,8 +50,13 @@ class SingleArtifact:
     def _artifact(self):
         """
         Return the artifact (there is only one for this content type).
+
+        Returns None when the artifact has not been downloaded yet.
         """
-        return self._artifacts.get()
+        try:
+            return self._artifacts.get()
+        except ObjectDoesNotExist:
+            return None
 
 
 class ManifestBlob(Content, SingleArtifact):
@@ -157,12 +181,12 @@ class ManifestListManifest(models.Model):
         manifest_list (models.ForeignKey): Many-to-one relationship with ManifestList.
     """
 
-    architecture = models.CharField(max_length=255)
-    os = models.CharField(max_length=255)
-    os_version = models.CharField(max_length=255)
+    architecture = models.CharField(max_length=255, db_index=True)
+    os = models.CharField(max_length=255, db_index=True)
+    os_version = models.CharField(max_length=255, default='', blank=True)
     os_features = models.TextField(default='', blank=True)
     features = models.TextField(default='', blank=True)
-    variant = models.CharField(max_length=255)
+    variant = models.CharField(max_length=255, default='', blank=True, db_index=True)
 
     manifest = models.ForeignKey(
         ImageManifest, related_name='manifests', on_delete=models.CASCADE)
@@ -236,9 +260,36 @@ class DockerPublisher(Publisher):
 class DockerRemote(Remote):
     """
     A Remote for DockerContent.
+
+    Fields:
+        upstream_name (models.CharField): The name of the upstream repository.
+        include_tags (models.TextField): Comma separated glob patterns of tags to sync.
+        exclude_tags (models.TextField): Comma separated glob patterns of tags not to sync.
+        token_realm (models.TextField): The realm of the last token auth challenge of the
+            upstream registry.
+        token_service (models.TextField): The service of the last token auth challenge of the
+            upstream registry.
+        download_policy (models.CharField): 'immediate' to download blobs during sync, or
+            'on_demand' to download them when they are first pulled.
+        platforms (models.TextField): Comma separated platforms of the manifests to sync from
+            manifest lists, e.g. 'linux/amd64,linux/arm64/v8'.
     """
 
+    IMMEDIATE = 'immediate'
+    ON_DEMAND = 'on_demand'
+    DOWNLOAD_POLICY_CHOICES = (
+        (IMMEDIATE, 'When syncing, download all blobs.'),
+        (ON_DEMAND, 'When syncing, only create RemoteArtifacts for blobs.'),
+    )
+
     upstream_name = models.CharField(max_length=255, db_index=True)
+    include_tags = models.TextField(null=True)
+    exclude_tags = models.TextField(null=True)
+    token_realm = models.TextField(null=True)
+    token_service = models.TextField(null=True)
+    download_policy = models.CharField(max_length=255, choices=DOWNLOAD_POLICY_CHOICES,
+                                       default=IMMEDIATE)
+    platforms = models.TextField(null=True)
 
     TYPE = 'docker'
 
@@ -269,6 +320,90 @@ class DockerRemote(Remote):
             )
             return self._download_factory
 
+    @property
+    def token_cache(self):
+        """
+        Return the cache of Bearer tokens used by the downloaders of this remote.
+
+        Upon first access, the TokenCache is instantiated and saved internally.
+
+        Returns:
+            TokenCache: The bearer tokens of this remote.
+
+        """
+        try:
+            return self._token_cache
+        except AttributeError:
+            self._token_cache = downloaders.TokenCache()
+            if self.token_realm:
+                self._token_cache.challenge = (self.token_realm, self.token_service,
+                                               self.pull_scope)
+            return self._token_cache
+
+    @property
+    def download_limiter(self):
+        """
+        Return the limit on concurrent downloads of this remote.
+
+        Upon first access, the AdaptiveConcurrencyLimiter is instantiated and saved internally.
+        It starts at the connection limit of the remote and is lowered when the registry rate
+        limits the downloads.
+
+        Returns:
+            AdaptiveConcurrencyLimiter: The limiter used as the semaphore of the downloaders.
+
+        """
+        try:
+            return self._download_limiter
+        except AttributeError:
+            self._download_limiter = downloaders.AdaptiveConcurrencyLimiter(self.connection_limit)
+            return self._download_limiter
+
+    @property
+    def pull_scope(self):
+        """
+        Returns the token scope needed to pull from the upstream repository.
+        """
+        return 'repository:{name}:pull'.format(name=self.namespaced_upstream_name)
+
+    def remember_token_challenge(self):
+        """
+        Save the realm and service of the last token auth challenge of the upstream registry.
+
+        The next sync requests its token up front instead of waiting for the registry to reject
+        its first request.
+        """
+        challenge = self.token_cache.challenge
+        if challenge is None:
+            return
+        realm, service, scope = challenge
+        if (realm, service) != (self.token_realm, self.token_service):
+            self.token_realm, self.token_service = realm, service
+            self.save(update_fields=['token_realm', 'token_service'])
+
+    def share_downloads(self, other):
+        """
+        Download with the session, concurrency limit and tokens of another remote.
+
+        Both remotes must have the same connection settings.
+
+        Args:
+            other (DockerRemote): The remote whose downloads to share.
+        """
+        self._download_factory = other.download_factory
+        self._download_limiter = other.download_limiter
+        self.token_cache.share(other.token_cache)
+
+    async def close_downloads(self):
+        """
+        Close the session of the downloaders of this remote once its running downloads finish.
+        """
+        session = getattr(self, '_download_session', None)
+        if session is None:
+            return
+        await self.download_limiter.wait_idle()
+        await session.close()
+
     def get_downloader(self, url, **kwargs):
         """
         Get a downloader for this url.
@@ -282,7 +417,62 @@ class DockerRemote(Remote):
 
         """
         kwargs['remote'] = self
-        return self.download_factory.build(url, **kwargs)
+        kwargs.setdefault('semaphore', self.download_limiter)
+        downloader = self.download_factory.build(url, **kwargs)
+        # All HTTP downloaders of the factory share its session, which is closed by
+        # close_downloads().
+        self._download_session = getattr(downloader, 'session', None)
+        return downloader
+
+    def filter_tags(self, tag_names):
+        """
+        Filter tag names with the include and exclude patterns of this remote.
+
+        A tag is kept when it matches any include pattern (or there are none), and does not
+        match any exclude pattern.
+
+        Args:
+            tag_names (iterable): Names of upstream tags.
+
+        Returns:
+            list: The names of the tags to sync.
+
+        """
+        include = _split_patterns(self.include_tags)
+        exclude = _split_patterns(self.exclude_tags)
+        kept = []
+        for name in tag_names:
+            included = not include or any(fnmatchcase(name, pattern) for pattern in include)
+            excluded = any(fnmatchcase(name, pattern) for pattern in exclude)
+            if included and not excluded:
+                kept.append(name)
+        return kept
+
+    def accepts_platform(self, platform):
+        """
+        Check a platform of a manifest in a manifest list against the platforms of this remote.
+
+        A platform without a variant, e.g. 'linux/arm64', accepts all variants.
+
+        Args:
+            platform (dict): The `platform` of the manifest.
+
+        Returns:
+            bool: True when the manifest should be synced.
+
+        """
+        allowed = _split_patterns(self.platforms)
+        if not allowed:
+            return True
+        for allowed_platform in allowed:
+            os, _, architecture = allowed_platform.partition('/')
+            architecture, _, variant = architecture.partition('/')
+            same_os = os == platform.get('os')
+            same_architecture = architecture == platform.get('architecture')
+            same_variant = not variant or variant == platform.get('variant')
+            if same_os and same_architecture and same_variant:
+                return True
+        return False
 
     @property
     def namespaced_upstream_name(self):
@@ -302,7 +492,47 @@ class DockerRemote(Remote):
 class DockerDistribution(BaseDistribution):
     """
     A docker distribution defines how a publication is distributed by Pulp's webserver.
+
+    A distribution with a remote is a pull-through cache. Content that it does not serve yet is
+    fetched from the remote when it is requested, and pulled tags are added to the repository
+    of the distribution.
+
+    Fields:
+        remote (models.ForeignKey): The remote to fetch missing content from.
     """
 
+    remote = models.ForeignKey(DockerRemote, null=True, on_delete=models.SET_NULL)
+
     class Meta:
         default_related_name = 'docker_distributions'
+
+
+class SyncShard(models.Model):
+    """
+    A shard of a sharded sync, synced by its own task into a scratch repository.
+
+    The shards of a sync record their outcome here, so that the last one to finish merges them.
+
+    Fields:
+        sync_id (models.UUIDField): Identifies the sharded sync.
+        state (models.CharField): Whether the shard is still syncing, completed, or failed.
+
+    Relations:
+        repository (models.OneToOneField): The scratch repository the shard is synced into.
+        target (models.ForeignKey): The repository the shards are merged into.
+        task (models.ForeignKey): The task syncing the shard, once it is enqueued.
+    """
+
+    WAITING = 'waiting'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    STATES = ((WAITING, WAITING), (COMPLETED, COMPLETED), (FAILED, FAILED))
+
+    sync_id = models.UUIDField(db_index=True)
+    state = models.CharField(max_length=255, choices=STATES, default=WAITING)
+
+    repository = models.OneToOneField(
+        Repository, related_name='docker_sync_shard', on_delete=models.CASCADE)
+    target = models.ForeignKey(
+        Repository, related_name='docker_sync_shards', on_delete=models.CASCADE)
+    task = models.ForeignKey(Task, null=True, related_name='+', on_delete=models.SET_NULL)
@@ -0,0 +1,359 @@
+"""
+Download content that is not in Pulp yet from a remote, while serving it.
+
+Concurrent requests for the same blob share a single download. Each response streams from the
+file the download is written to, and the file is saved as an Artifact once the download is
+complete.
+"""
+from gettext import gettext as _
+from urllib.parse import urljoin
+import asyncio
+import logging
+import os
+import tempfile
+
+from aiohttp import web
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from pulpcore.plugin.models import Artifact, ContentArtifact, RemoteArtifact
+
+from pulp_docker.app.tasks.download_stages import remove_unsaved_file
+from pulp_docker.app.tasks.sync_stages import V2_ACCEPT_HEADERS
+
+
+log = logging.getLogger(__name__)
+
+
+# Size of the chunks streamed to clients.
+CHUNK_SIZE = 1024 * 1024
+
+# The remotes that content is fetched from by this process, keyed by PK. Each keeps its session,
+# tokens and concurrency limit between requests.
+_remotes = {}
+
+
+def shared_remote(remote):
+    """
+    Return the instance of a remote that the requests of this process share.
+
+    The instance is replaced when the remote has been updated since, and the session of the
+    replaced instance is closed once its running downloads finish.
+
+    Args:
+        remote (pulp_docker.app.models.DockerRemote): The remote, as loaded by a request, or None.
+
+    Returns:
+        pulp_docker.app.models.DockerRemote: The shared instance, or None.
+
+    """
+    if remote is None:
+        return None
+    shared = _remotes.get(remote.pk)
+    if shared is not None and shared._last_updated == remote._last_updated:
+        return shared
+    if shared is not None:
+        asyncio.ensure_future(shared.close_downloads())
+    _remotes[remote.pk] = remote
+    return remote
+
+
+class ProgressFile:
+    """
+    A file that notifies the readers of a download whenever data is written to it.
+    """
+
+    def __init__(self, fetch, file):
+        """
+        Wrap a file.
+
+        Args:
+            fetch (BlobFetch): The download to notify.
+            file (file): The open file the download is written to.
+        """
+        self._fetch = fetch
+        self._file = file
+
+    def write(self, data):
+        """
+        Write data and make it visible to the readers.
+
+        Args:
+            data (bytes): The data received by the downloader.
+
+        Returns:
+            int: The number of bytes written.
+
+        """
+        written = self._file.write(data)
+        self._file.flush()
+        self._fetch.notify()
+        return written
+
+    def truncate(self, size=None):
+        """
+        Truncate the file, which makes the data sent by the readers so far invalid.
+
+        Args:
+            size (int): The new size of the file.
+
+        Returns:
+            int: The new size of the file.
+
+        """
+        self._fetch.generation += 1
+        self._fetch.notify()
+        return self._file.truncate(size)
+
+    def __getattr__(self, name):
+        """Delegate everything else to the wrapped file."""
+        return getattr(self._file, name)
+
+
+def save_artifact(path, artifact_attributes):
+    """
+    Save a downloaded file as an Artifact.
+
+    Args:
+        path (str): The downloaded file. It is moved into storage.
+        artifact_attributes (dict): The size and digests of the file.
+
+    Returns:
+        Artifact: The saved Artifact, or the existing one with the same digest.
+
+    """
+    artifact = Artifact(file=path, **artifact_attributes)
+    try:
+        with transaction.atomic():
+            artifact.save()
+    except IntegrityError:
+        # Another process downloaded the same Artifact first.
+        existing = Artifact.objects.get(sha256=artifact.sha256)
+        remove_unsaved_file(artifact, existing)
+        artifact = existing
+    return artifact
+
+
+async def fetch_manifest(remote, reference, accepted_media_types):
+    """
+    Download a manifest from a remote and save it as an Artifact.
+
+    Args:
+        remote (pulp_docker.app.models.DockerRemote): The remote to download from.
+        reference (str): A tag name or a digest.
+        accepted_media_types (list): The media types accepted by the client.
+
+    Returns:
+        tuple: The body, the media type and the digest of the manifest.
+
+    """
+    relative_url = '/v2/{name}/manifests/{reference}'.format(
+        name=remote.namespaced_upstream_name, reference=reference)
+    validation_kwargs = {}
+    if reference.startswith('sha256:'):
+        validation_kwargs['expected_digests'] = {'sha256': reference[len('sha256:'):]}
+    downloader = remote.get_downloader(url=urljoin(remote.url, relative_url), **validation_kwargs)
+    extra_data = {
+        'headers': {'accept': ','.join(accepted_media_types or V2_ACCEPT_HEADERS.values())},
+        'buffer_body': True,
+    }
+    result = await downloader.run(extra_data=extra_data)
+    body = extra_data.get('body')
+    if body is None:
+        with open(result.path, 'rb') as manifest_file:
+            body = manifest_file.read()
+    loop = asyncio.get_event_loop()
+    artifact = await loop.run_in_executor(None, save_artifact, result.path,
+                                          result.artifact_attributes)
+    media_type = downloader.response_headers.get('Content-Type')
+    return body, media_type, 'sha256:{digest}'.format(digest=artifact.sha256)
+
+
+class BlobFetch:
+    """
+    A download of a blob from a remote that any number of responses stream from.
+
+    Attributes:
+        remote (pulp_docker.app.models.DockerRemote): The remote to download from.
+        url (str): The url of the blob.
+        sha256 (str): The expected sha256 digest of the blob.
+        size (int): The expected size of the blob, or None if it is not known.
+        path (str): The file the download is written to.
+        generation (int): Incremented whenever the download starts over.
+        task (asyncio.Task): The download.
+    """
+
+    # In-flight downloads of this process, keyed by their sha256 digest.
+    in_flight = {}
+
+    def __init__(self, remote, url, sha256, size=None):
+        """
+        Start downloading an Artifact.
+
+        Args:
+            remote (pulp_docker.app.models.DockerRemote): The remote to download from.
+            url (str): The url of the blob.
+            sha256 (str): The expected sha256 digest of the blob.
+            size (int): The expected size of the blob, or None if it is not known.
+        """
+        self.remote = remote
+        self.url = url
+        self.sha256 = sha256
+        self.size = size
+        self._file = tempfile.NamedTemporaryFile(dir=settings.FILE_UPLOAD_TEMP_DIR, delete=False)
+        self.path = self._file.name
+        self.generation = 0
+        self._progress = asyncio.Event()
+        self.in_flight[sha256] = self
+        self.task = asyncio.ensure_future(self._fetch())
+
+    @classmethod
+    def get_or_start(cls, content_artifact):
+        """
+        Return the in-flight download of a ContentArtifact, starting one if needed.
+
+        Args:
+            content_artifact (ContentArtifact): A ContentArtifact without an Artifact.
+
+        Returns:
+            BlobFetch: The download, or None if the content cannot be downloaded.
+
+        """
+        remote_artifact = RemoteArtifact.objects.filter(
+            content_artifact=content_artifact).select_related('remote').first()
+        if remote_artifact is None:
+            return None
+        fetch = cls.in_flight.get(remote_artifact.sha256)
+        if fetch is not None:
+            return fetch
+        return cls(shared_remote(remote_artifact.remote.cast()), remote_artifact.url,
+                   remote_artifact.sha256, size=remote_artifact.size)
+
+    @classmethod
+    def get_or_start_upstream(cls, remote, digest):
+        """
+        Return the in-flight download of a blob, starting one from a remote if needed.
+
+        Args:
+            remote (pulp_docker.app.models.DockerRemote): The remote to download from.
+            digest (str): The digest of the blob, e.g. 'sha256:...'.
+
+        Returns:
+            BlobFetch: The download.
+
+        """
+        sha256 = digest[len('sha256:'):]
+        fetch = cls.in_flight.get(sha256)
+        if fetch is not None:
+            return fetch
+        relative_url = '/v2/{name}/blobs/{digest}'.format(
+            name=remote.namespaced_upstream_name, digest=digest)
+        return cls(remote, urljoin(remote.url, relative_url), sha256)
+
+    def notify(self):
+        """
+        Wake up the readers waiting for more data.
+        """
+        progress, self._progress = self._progress, asyncio.Event()
+        progress.set()
+
+    async def _fetch(self):
+        """
+        Download the Artifact and save it.
+
+        Returns:
+            Artifact: The saved Artifact.
+
+        """
+        try:
+            downloader = self.remote.get_downloader(
+                url=self.url,
+                custom_file_object=ProgressFile(self, self._file),
+                expected_digests={'sha256': self.sha256},
+            )
+            result = await downloader.run(extra_data={'headers': V2_ACCEPT_HEADERS})
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, self._save, result.artifact_attributes)
+        except Exception:
+            log.exception(_("Downloading {url} failed.").format(url=self.url))
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            raise
+        finally:
+            del self.in_flight[self.sha256]
+            self.notify()
+
+    def _save(self, artifact_attributes):
+        """
+        Save the downloaded file, and add it to all content of the blob.
+
+        Args:
+            artifact_attributes (dict): The size and digests of the file.
+
+        Returns:
+            Artifact: The saved Artifact.
+
+        """
+        artifact = save_artifact(self.path, artifact_attributes)
+        # Add the Artifact to all content of the blob, wherever it came from.
+        ContentArtifact.objects.filter(
+            relative_path='sha256:{digest}'.format(digest=self.sha256),
+            artifact__isnull=True,
+        ).update(artifact=artifact)
+        return artifact
+
+    async def stream(self, request, headers):
+        """
+        Stream the download to a client as it progresses.
+
+        Args:
+            request (:class:`~aiohttp.web.Request`): The request to respond to.
+            headers (dict): The headers to send with the response.
+
+        Returns:
+            :class:`aiohttp.web.StreamResponse`: The response streamed back to the client.
+
+        Raises:
+            :class:`aiohttp.web.HTTPBadGateway`: When the download failed before any data was
+                received.
+
+        """
+        # The file is opened right away, it is moved into storage when the download completes.
+        with open(self.path, 'rb') as blob_file:
+            generation = self.generation
+            chunk = await self._read(blob_file, generation)
+            if chunk is None:
+                raise web.HTTPBadGateway()
+            response = web.StreamResponse(headers=headers)
+            if self.size:
+                response.content_length = self.size
+            await response.prepare(request)
+            while chunk:
+                await response.write(chunk)
+                chunk = await self._read(blob_file, generation)
+                if chunk is None:
+                    raise IOError(_("Downloading {url} failed.").format(url=self.url))
+        await response.write_eof()
+        return response
+
+    async def _read(self, blob_file, generation):
+        """
+        Read the next chunk of the download, waiting for it to arrive.
+
+        Args:
+            blob_file (file): The file of the download, opened for reading.
+            generation (int): The generation of the download the file was opened for.
+
+        Returns:
+            bytes: The next chunk, empty once the download is complete, or None if it failed.
+
+        """
+        while True:
+            progress = self._progress
+            chunk = blob_file.read(CHUNK_SIZE)
+            if self.generation != generation:
+                return None
+            if chunk:
+                return chunk
+            if self.task.done():
+                return None if self.task.exception() else chunk
+            await progress.wait()
@@ -6,13 +6,22 @@ from django.core.exceptions import ObjectDoesNotExist
 from gettext import gettext as _
 from multidict import MultiDict
 
-from pulpcore.plugin.models import ContentArtifact
+from pulpcore.constants import TASK_FINAL_STATES
+from pulpcore.plugin.models import Content, ContentArtifact, Task
+from pulpcore.plugin.tasking import enqueue_with_reservation
+from pulp_docker.app import tasks
 from pulp_docker.app.models import DockerDistribution, ManifestTag, ManifestListTag, MEDIA_TYPE
+from pulp_docker.app.pull_through import BlobFetch, fetch_manifest, shared_remote
 
 
 log = logging.getLogger(__name__)
 
 
+# Number of pulled tags and manifests remembered with the task adding them to a repository,
+# before the ones whose tasks have finished are forgotten.
+MAX_PENDING_PULLS = 1000
+
+
 class PathNotResolved(web_exceptions.HTTPNotFound):
     """
     The path could not be resolved to a published file.
@@ -38,8 +47,18 @@ class ArtifactNotFound(Exception):
 class Registry:
     """
     A set of handlers for the Docker v2 API.
+
+    Distributions with a remote are pull-through caches. Tags, manifests and blobs they do not
+    serve yet are fetched from the remote, and pulled tags are added to the repository of the
+    distribution in the background.
+
+    Attributes:
+        pending_pulls (dict): Maps (repository PK, tag name or digest) to the PK of the task
+            adding the pulled tag or manifest to the repository.
     """
 
+    pending_pulls = {}
+
     @staticmethod
     async def get_accepted_media_types(request):
         """
@@ -79,6 +98,29 @@ class Registry:
             log.debug(_('DockerDistribution not matched for {path}.').format(path=path))
             raise PathNotResolved(path)
 
+    @staticmethod
+    def served_content(distribution):
+        """
+        Return the content served by a distribution.
+
+        Pull-through distributions serve the latest version of their repository, which pulled
+        content is added to, so it is served before it is published.
+
+        Args:
+            distribution (DockerDistribution): The distribution.
+
+        Returns:
+            QuerySet: The served Content.
+
+        """
+        if distribution.remote_id is not None and distribution.repository is not None:
+            version = distribution.repository.latest_version()
+            if version is not None:
+                return version.content
+        if distribution.publication is not None:
+            return distribution.publication.repository_version.content
+        return Content.objects.none()
+
     @staticmethod
     async def _dispatch(path, headers):
         """
@@ -121,7 +163,7 @@ class Registry:
         path = request.match_info['path']
         distribution = await Registry.match_distribution(path)
         tags = {'name': path, 'tags': set()}
-        for c in distribution.publication.repository_version.content:
+        for c in Registry.served_content(distribution):
             c = c.cast()
             if isinstance(c, ManifestTag) or isinstance(c, ManifestListTag):
                 tags['tags'].add(c.name)
@@ -149,10 +191,87 @@ class Registry:
         tag_name = request.match_info['tag_name']
         distribution = await Registry.match_distribution(path)
         accepted_media_types = await Registry.get_accepted_media_types(request)
+        try:
+            return await Registry.get_served_tag(distribution, tag_name, accepted_media_types)
+        except PathNotResolved:
+            remote = shared_remote(distribution.remote)
+            if remote is None or not remote.filter_tags([tag_name]):
+                raise
+        response = await Registry.pull_through_manifest(remote, tag_name, accepted_media_types)
+        Registry.add_pulled(distribution, remote, tag_name=tag_name)
+        return response
+
+    @staticmethod
+    def add_pulled(distribution, remote, tag_name=None, digest=None):
+        """
+        Add a pulled tag or manifest to the repository of a distribution in the background.
+
+        No task is enqueued while an earlier one adding the same tag or manifest to the same
+        repository is waiting or running, so clients pulling it at the same time share a task.
+
+        Args:
+            distribution (DockerDistribution): The distribution the content was pulled through.
+            remote (pulp_docker.app.models.DockerRemote): The remote it was pulled from.
+            tag_name (str): The name of the pulled tag.
+            digest (str): The digest of the manifest or manifest list pulled by digest.
+        """
+        repository = distribution.repository
+        if repository is None:
+            return
+        key = (repository.pk, tag_name or digest)
+        task_pk = Registry.pending_pulls.get(key)
+        if task_pk is not None and Task.objects.filter(pk=task_pk).exclude(
+                state__in=TASK_FINAL_STATES).exists():
+            return
+        if len(Registry.pending_pulls) >= MAX_PENDING_PULLS:
+            Registry.forget_finished_pulls()
+        result = enqueue_with_reservation(
+            tasks.synchronize_tags, [repository, remote],
+            kwargs={
+                'remote_pk': remote.pk,
+                'repository_pk': repository.pk,
+                'tag_names': [tag_name] if tag_name else [],
+                'digests': [digest] if digest else [],
+            }
+        )
+        Registry.pending_pulls[key] = str(result.id)
+
+    @staticmethod
+    def forget_finished_pulls():
+        """
+        Forget the pulled tags and manifests whose tasks have finished.
+        """
+        finished = {str(pk) for pk in Task.objects.filter(
+            pk__in=Registry.pending_pulls.values(),
+            state__in=TASK_FINAL_STATES).values_list('pk', flat=True)}
+        Registry.pending_pulls = {
+            key: task_pk for key, task_pk in Registry.pending_pulls.items()
+            if task_pk not in finished
+        }
+
+    @staticmethod
+    async def get_served_tag(distribution, tag_name, accepted_media_types):
+        """
+        Stream either the Manifest or the ManifestList of a Tag served by a distribution.
+
+        Args:
+            distribution (DockerDistribution): The distribution to serve the Tag from.
+            tag_name (str): The name of the Tag.
+            accepted_media_types (list): The media types accepted by the client.
+
+        Raises:
+            PathNotResolved: The distribution does not serve the Tag.
+
+        Returns:
+            :class:`aiohttp.web.StreamResponse` or :class:`aiohttp.web.FileResponse`: The response
+                streamed back to the client.
+
+        """
+        served_content = Registry.served_content(distribution)
         if MEDIA_TYPE.MANIFEST_LIST in accepted_media_types:
             try:
                 tag = ManifestListTag.objects.get(
-                    pk__in=distribution.publication.repository_version.content,
+                    pk__in=served_content,
                     name=tag_name
                 )
             # If there is no manifest list tag, try again with manifest tag.
@@ -165,7 +284,7 @@ class Registry:
         if MEDIA_TYPE.MANIFEST_V2 in accepted_media_types:
             try:
                 tag = ManifestTag.objects.get(
-                    pk__in=distribution.publication.repository_version.content,
+                    pk__in=served_content,
                     name=tag_name
                 )
             except ObjectDoesNotExist:
@@ -177,7 +296,29 @@ class Registry:
         else:
             # This is where we could eventually support on-the-fly conversion to schema 1.
             log.warn("Client does not accept Docker V2 Schema 2 and is not currently supported.")
-            raise PathNotResolved(path)
+            raise PathNotResolved(distribution.base_path)
+
+    @staticmethod
+    async def pull_through_manifest(remote, reference, accepted_media_types):
+        """
+        Fetch a manifest from a remote and send it to the client.
+
+        Args:
+            remote (pulp_docker.app.models.DockerRemote): The remote to fetch from.
+            reference (str): A tag name or a digest.
+            accepted_media_types (list): The media types accepted by the client.
+
+        Returns:
+            :class:`aiohttp.web.Response`: The response sent back to the client.
+
+        """
+        body, media_type, digest = await fetch_manifest(remote, reference, accepted_media_types)
+        headers = {
+            'Content-Type': media_type,
+            'Docker-Content-Digest': digest,
+            'Docker-Distribution-API-Version': 'registry/2.0',
+        }
+        return web.Response(body=body, headers=headers)
 
     @staticmethod
     async def dispatch_tag(tag, response_headers):
@@ -204,21 +345,44 @@ class Registry:
     async def get_by_digest(request):
         """
         Return a response to the "GET" action.
+
+        Content that was synced with the 'on_demand' download policy is downloaded from the
+        remote on the first request, and streamed to the client while it is downloaded.
+
+        Only content served by the distribution is returned. Pull-through distributions fetch
+        anything else from their remote, and add manifests pulled by digest to their repository.
         """
         path = request.match_info['path']
         digest = "sha256:{digest}".format(digest=request.match_info['digest'])
         distribution = await Registry.match_distribution(path)
         log.info(digest)
-        try:
-            ca = ContentArtifact.objects.get(
-                content__in=distribution.publication.repository_version.content,
-                relative_path=digest)
-            headers = {'Content-Type': ca.content.cast().media_type}
-        except ObjectDoesNotExist:
-            raise PathNotResolved(path)
+        ca = ContentArtifact.objects.filter(
+            relative_path=digest,
+            content__in=Registry.served_content(distribution),
+        ).select_related('artifact').first()
+        if ca is None:
+            remote = shared_remote(distribution.remote)
+            if remote is None:
+                raise PathNotResolved(path)
+            if '/manifests/' in request.path:
+                accepted_media_types = await Registry.get_accepted_media_types(request)
+                response = await Registry.pull_through_manifest(
+                    remote, digest, accepted_media_types)
+                Registry.add_pulled(distribution, remote, digest=digest)
+                return response
+            fetch = BlobFetch.get_or_start_upstream(remote, digest)
+            headers = {
+                'Content-Type': 'application/octet-stream',
+                'Docker-Content-Digest': digest,
+                'Docker-Distribution-API-Version': 'registry/2.0',
+            }
+            return await fetch.stream(request, headers)
         else:
-            artifact = ca.artifact
-            if artifact:
-                return await Registry._dispatch(artifact.file.name, headers)
-            else:
+            headers = {'Content-Type': ca.content.cast().media_type}
+            if ca.artifact:
+                return await Registry._dispatch(ca.artifact.file.name, headers)
+            fetch = BlobFetch.get_or_start(ca)
+            if fetch is None:
                 raise ArtifactNotFound(path)
+            headers['Docker-Distribution-API-Version'] = 'registry/2.0'
+            return await fetch.stream(request, headers)
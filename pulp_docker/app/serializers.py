@@ -171,12 +171,180 @@ class DockerRemoteSerializer(platform.RemoteSerializer):
         allow_blank=False,
         help_text=_("Name of the upstream repository")
     )
+    include_tags = serializers.CharField(
+        required=False,
+        allow_null=True,
+        allow_blank=True,
+        help_text=_("A comma separated list of glob patterns, e.g. '3.*,*-alpine'. Only tags "
+                    "matching one of them are synced. All tags are synced if not set.")
+    )
+    exclude_tags = serializers.CharField(
+        required=False,
+        allow_null=True,
+        allow_blank=True,
+        help_text=_("A comma separated list of glob patterns. Tags matching any of them are "
+                    "not synced.")
+    )
+    platforms = serializers.CharField(
+        required=False,
+        allow_null=True,
+        allow_blank=True,
+        help_text=_("A comma separated list of platforms, e.g. 'linux/amd64,linux/arm64/v8'. "
+                    "Only the manifests for these platforms are synced from manifest lists. "
+                    "All are synced if not set.")
+    )
+    download_policy = serializers.ChoiceField(
+        required=False,
+        choices=models.DockerRemote.DOWNLOAD_POLICY_CHOICES,
+        default=models.DockerRemote.IMMEDIATE,
+        help_text=_("'immediate' downloads all blobs during sync. 'on_demand' only syncs "
+                    "manifests, blobs are downloaded when they are first pulled.")
+    )
 
     class Meta:
-        fields = platform.RemoteSerializer.Meta.fields + ('upstream_name',)
+        fields = platform.RemoteSerializer.Meta.fields + (
+            'upstream_name', 'include_tags', 'exclude_tags', 'platforms', 'download_policy',
+        )
         model = models.DockerRemote
 
 
+class DockerSyncSerializer(platform.RepositorySyncURLSerializer):
+    """
+    Serializer for the parameters of a docker sync.
+    """
+
+    repository = platform.RelatedField(
+        required=False,
+        help_text=_('A URI of the repository to be synchronized. Required unless dry_run is '
+                    'set.'),
+        queryset=Repository.objects.all(),
+        view_name='repositories-detail',
+    )
+    incremental = serializers.BooleanField(
+        required=False,
+        default=False,
+        help_text=_("Only download the manifests of tags whose digests are not already known "
+                    "to Pulp.")
+    )
+    dry_run = serializers.BooleanField(
+        required=False,
+        default=False,
+        help_text=_("Only report how many blobs, and how many bytes, the sync would download for "
+                    "each tag. Nothing is downloaded besides manifests, and the repository is "
+                    "not changed.")
+    )
+    shards = serializers.IntegerField(
+        required=False,
+        default=1,
+        min_value=1,
+        help_text=_("Split the upstream tags into this many shards, each synced by its own task. "
+                    "A final task creates the new repository version once all shards are "
+                    "synced.")
+    )
+
+    def validate(self, data):
+        """
+        Check the combination of the sync parameters.
+
+        A repository is required unless it is a dry run, and a sharded sync is neither incremental
+        nor a dry run.
+
+        Args:
+            data (dict): The validated fields.
+
+        Returns:
+            dict: The validated fields.
+
+        Raises:
+            ValidationError: If the repository is missing for a sync that is not a dry run, or
+                if more than one shard is combined with incremental or dry_run.
+
+        """
+        data = super().validate(data)
+        if not data.get('dry_run') and data.get('repository') is None:
+            raise serializers.ValidationError(
+                {'repository': _('The repository URI must be specified.')})
+        if data.get('shards', 1) > 1 and (data.get('incremental') or data.get('dry_run')):
+            raise serializers.ValidationError(
+                _('A sync with more than one shard cannot be incremental or a dry run.'))
+        return data
+
+
+class DockerBatchSyncEntrySerializer(serializers.Serializer):
+    """
+    Serializer for a repository of a batch sync and the remote to sync it from.
+    """
+
+    remote = platform.DetailRelatedField(
+        help_text=_('The remote to sync from.'),
+        queryset=models.DockerRemote.objects.all(),
+    )
+    repository = platform.RelatedField(
+        help_text=_('The repository to create a new version of.'),
+        queryset=Repository.objects.all(),
+        view_name='repositories-detail',
+    )
+
+    def validate_remote(self, remote):
+        """
+        Check that the remote can be synced from.
+
+        Args:
+            remote (DockerRemote): The remote.
+
+        Returns:
+            DockerRemote: The remote.
+
+        Raises:
+            ValidationError: If the remote has no URL.
+
+        """
+        if not remote.url:
+            raise serializers.ValidationError(
+                _('A remote must have a url specified to synchronize.'))
+        return remote
+
+
+class DockerBatchSyncSerializer(serializers.Serializer):
+    """
+    Serializer for the parameters of a sync of many repositories.
+    """
+
+    syncs = DockerBatchSyncEntrySerializer(
+        many=True,
+        help_text=_("The repositories to sync, each with the remote to sync it from. A new "
+                    "version is created for each repository.")
+    )
+    incremental = serializers.BooleanField(
+        required=False,
+        default=False,
+        help_text=_("Only download the manifests of tags whose digests are not already known "
+                    "to Pulp.")
+    )
+
+    def validate_syncs(self, syncs):
+        """
+        Check that there is at least one repository, and that none appears twice.
+
+        Args:
+            syncs (list): List of dicts with a `remote` and a `repository`.
+
+        Returns:
+            list: The syncs.
+
+        Raises:
+            ValidationError: If there are no syncs, or a repository appears more than once.
+
+        """
+        if not syncs:
+            raise serializers.ValidationError(_('At least one repository must be synced.'))
+        repositories = [sync['repository'].pk for sync in syncs]
+        if len(set(repositories)) != len(repositories):
+            raise serializers.ValidationError(
+                _('Each repository can only be synced once in a batch.'))
+        return syncs
+
+
 class DockerPublisherSerializer(platform.PublisherSerializer):
     """
     A Serializer for DockerPublisher.
@@ -246,6 +414,13 @@ class DockerDistributionSerializer(platform.ModelSerializer):
         view_name='repositories-detail',
         allow_null=True
     )
+    remote = platform.DetailRelatedField(
+        required=False,
+        help_text=_('A remote to fetch content from when it is not served yet. Pulled tags are '
+                    'added to the repository of this distribution.'),
+        queryset=models.DockerRemote.objects.all(),
+        allow_null=True
+    )
     registry_path = RegistryPathField(
         source='base_path', read_only=True,
         help_text=_('The Registry hostame:port/name/ to use with docker pull command defined by '
@@ -262,6 +437,7 @@ class DockerDistributionSerializer(platform.ModelSerializer):
             'registry_path',
             'repository',
             'content_guard',
+            'remote',
         )
 
     def _validate_path_overlap(self, path):
@@ -1,2 +1,5 @@
+from .batch import synchronize_batch  # noqa
+from .plan import plan_synchronize  # noqa
 from .publishing import publish  # noqa
-from .synchronize import synchronize  # noqa
+from .sharding import merge_shards, synchronize_shard, synchronize_sharded  # noqa
+from .synchronize import synchronize, synchronize_tags  # noqa
@@ -0,0 +1,168 @@
+"""
+Sync many repositories in a single task.
+
+Syncs of remotes with the same connection settings share the session, the concurrency limit and
+the Bearer tokens of their downloads. All syncs share the Artifacts, units and relations known to
+be saved, the threads for blocking work, and a limit on the number of concurrent downloads. Each
+repository gets its own new version, and a sync that fails does not stop the others.
+"""
+from gettext import gettext as _
+from urllib.parse import urlsplit
+import asyncio
+import logging
+
+from django.conf import settings
+from pulpcore.plugin.models import ProgressBar, Repository
+from pulpcore.plugin.tasking import WorkingDirectory
+
+from pulp_docker.app.models import DockerRemote, ManifestListTag, ManifestTag
+from pulp_docker.app.tasks.content_cache import ContentCache
+from pulp_docker.app.tasks.executor import BlockingExecutor
+from pulp_docker.app.tasks.synchronize import DockerDeclarativeVersion
+
+
+log = logging.getLogger(__name__)
+
+
+# Default number of repositories synced concurrently by a batch sync, configurable with
+# DOCKER_BATCH_SYNC_REPOSITORIES.
+DEFAULT_BATCH_SYNC_REPOSITORIES = 10
+
+# Default number of concurrent downloads of a batch sync, configurable with
+# DOCKER_BATCH_SYNC_DOWNLOADS.
+DEFAULT_BATCH_SYNC_DOWNLOADS = 100
+
+
+def synchronize_batch(syncs, incremental=False):
+    """
+    Sync many repositories, each from its remote, creating a new version of each repository.
+
+    Args:
+        syncs (list): List of (remote PK, repository PK) pairs. A repository appears only once.
+        incremental (bool): Skip downloading manifests of tags that are already known to Pulp.
+
+    Raises:
+        ValueError: If a remote does not specify a URL to sync
+        RuntimeError: If the sync of any repository failed. The other repositories are synced.
+
+    """
+    pairs = []
+    for remote_pk, repository_pk in syncs:
+        remote = DockerRemote.objects.get(pk=remote_pk)
+        if not remote.url:
+            raise ValueError(_('A remote must have a url specified to synchronize.'))
+        pairs.append((remote, Repository.objects.get(pk=repository_pk)))
+
+    downloads = SharedDownloads()
+    cache = ContentCache()
+    executor = BlockingExecutor()
+    remove_duplicate_tags = [{'model': ManifestTag, 'field_names': ['name']},
+                             {'model': ManifestListTag, 'field_names': ['name']}]
+    versions = []
+    for remote, repository in pairs:
+        downloads.attach(remote)
+        dv = DockerDeclarativeVersion(repository, remote, remove_duplicates=remove_duplicate_tags,
+                                      incremental=incremental, cache=cache, instrument=False)
+        dv.executor = executor
+        versions.append(dv)
+
+    try:
+        with WorkingDirectory():
+            with ProgressBar(message=_('Syncing repositories'), total=len(versions)) as progress:
+                loop = asyncio.get_event_loop()
+                errors = loop.run_until_complete(run_batch(versions, progress))
+    finally:
+        executor.shutdown()
+
+    log.info(_("Synced {synced} of {total} repositories, {hits} cached lookups").format(
+        synced=len(versions) - len(errors), total=len(versions), hits=cache.hits))
+    if errors:
+        raise RuntimeError(_("The sync of {count} repositories failed: {names}").format(
+            count=len(errors), names=', '.join(sorted(errors))))
+
+
+async def run_batch(versions, progress):
+    """
+    Run the syncs, at most DOCKER_BATCH_SYNC_REPOSITORIES at a time.
+
+    Args:
+        versions (list): List of :class:`DockerDeclarativeVersion`.
+        progress (:class:`~pulpcore.plugin.models.ProgressBar`): Counts the finished syncs.
+
+    Returns:
+        dict: Maps the names of the repositories whose sync failed to the error.
+
+    """
+    slots = asyncio.Semaphore(getattr(settings, 'DOCKER_BATCH_SYNC_REPOSITORIES',
+                                      DEFAULT_BATCH_SYNC_REPOSITORIES))
+    errors = {}
+
+    async def run(dv):
+        async with slots:
+            try:
+                await dv.create_in_loop()
+            except Exception as exc:
+                log.exception(_("The sync of repository {name} failed").format(
+                    name=dv.repository.name))
+                errors[dv.repository.name] = exc
+            progress.increment()
+
+    await asyncio.gather(*(run(dv) for dv in versions))
+    return errors
+
+
+def connection_key(remote):
+    """
+    Return the settings that the download session of a remote depends on.
+
+    Args:
+        remote (DockerRemote): The remote.
+
+    Returns:
+        tuple: The settings. Remotes with equal keys can share a session.
+
+    """
+    url = urlsplit(remote.url)
+    return (
+        url.scheme, url.netloc, remote.ssl_ca_certificate, remote.ssl_client_certificate,
+        remote.ssl_client_key, remote.ssl_validation, remote.proxy_url, remote.username,
+        remote.password, remote.connection_limit,
+    )
+
+
+class SharedDownloads:
+    """
+    The download state shared by the remotes of a batch sync.
+
+    The first remote of each set of connection settings keeps its own download factory, limiter
+    and tokens, and the other remotes use them. All limiters share a global limit of
+    DOCKER_BATCH_SYNC_DOWNLOADS concurrent downloads.
+    """
+
+    def __init__(self, max_downloads=None):
+        """
+        Initialize the shared state.
+
+        Args:
+            max_downloads (int): The number of concurrent downloads of all remotes. Defaults to
+                the DOCKER_BATCH_SYNC_DOWNLOADS setting.
+        """
+        if max_downloads is None:
+            max_downloads = getattr(settings, 'DOCKER_BATCH_SYNC_DOWNLOADS',
+                                    DEFAULT_BATCH_SYNC_DOWNLOADS)
+        self.semaphore = asyncio.Semaphore(max_downloads)
+        self.remotes = {}
+
+    def attach(self, remote):
+        """
+        Make a remote download with the state of the first remote of its connection settings.
+
+        Args:
+            remote (DockerRemote): The remote.
+        """
+        key = connection_key(remote)
+        first = self.remotes.setdefault(key, remote)
+        if first is remote:
+            first.download_limiter.parent = self.semaphore
+        else:
+            remote.share_downloads(first)
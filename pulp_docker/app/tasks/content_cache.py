@@ -0,0 +1,81 @@
+"""
+Remember the Content saved during a sync, so that repeated units are not looked up again.
+"""
+from collections import OrderedDict
+import threading
+
+from django.conf import settings
+
+
+# Default number of units remembered by each sync, configurable with DOCKER_SYNC_CACHE_SIZE.
+DEFAULT_SYNC_CACHE_SIZE = 10000
+
+
+class ContentCache:
+    """
+    A bounded least recently used mapping of (model, natural key) to saved rows.
+
+    One cache is shared by the stages of a sync. Only rows that are committed to the database may
+    be added, so that a rolled back transaction never leaves unsaved units behind. The cache can
+    be used from several threads.
+    """
+
+    def __init__(self, max_size=None):
+        """
+        Create an empty cache.
+
+        Args:
+            max_size (int): The number of entries to remember. Defaults to the
+                DOCKER_SYNC_CACHE_SIZE setting.
+        """
+        if max_size is None:
+            max_size = getattr(settings, 'DOCKER_SYNC_CACHE_SIZE', DEFAULT_SYNC_CACHE_SIZE)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """Return the number of entries."""
+        return len(self._entries)
+
+    def get_many(self, model_type, keys):
+        """
+        Look up the saved rows of several natural keys.
+
+        Args:
+            model_type (type): The model of the rows.
+            keys (iterable): Natural keys, as returned by
+                :func:`~pulp_docker.app.tasks.dedupe_save.natural_key`.
+
+        Returns:
+            dict: Maps the natural keys that are in the cache to their rows.
+
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                value = self._entries.get((model_type, key))
+                if value is None:
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end((model_type, key))
+                self.hits += 1
+                found[key] = value
+        return found
+
+    def add_many(self, model_type, values):
+        """
+        Remember committed rows, forgetting the least recently used ones beyond the size limit.
+
+        Args:
+            model_type (type): The model of the rows.
+            values (dict): Maps natural keys to rows.
+        """
+        with self._lock:
+            for key, value in values.items():
+                self._entries[(model_type, key)] = value
+                self._entries.move_to_end((model_type, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
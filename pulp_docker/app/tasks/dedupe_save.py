@@ -7,19 +7,88 @@ duplicates within the stream. The entire module should be deleted after #4060 is
 https://pulp.plan.io/issues/4060
 
 """
-from django.db import IntegrityError
+from collections import OrderedDict, defaultdict
+from functools import reduce
+import operator
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 from pulpcore.plugin.stages import Stage
-from pulpcore.plugin.models import ContentArtifact, RemoteArtifact
+from pulpcore.plugin.models import Artifact, ContentArtifact, RemoteArtifact
+
+from pulp_docker.app.tasks.content_cache import ContentCache
+from pulp_docker.app.tasks.executor import run_blocking
 
 import logging
 log = logging.getLogger(__name__)
 
 
-class SerialContentSave(Stage):
+# Number of times a batch is retried when a concurrent sync saves the same Content first.
+MAX_BATCH_ATTEMPTS = 3
+
+
+def natural_key(content):
+    """
+    Return the natural key of a Content unit as a hashable tuple.
+
+    Relations are represented by their primary key so that building the key never triggers a
+    query.
+
+    Args:
+        content (:class:`~pulpcore.plugin.models.Content`): The unit to build a key for.
+
+    Returns:
+        tuple: The values of the natural key fields of the unit.
+
+    """
+    return tuple(
+        getattr(content, content._meta.get_field(name).attname)
+        for name in content.natural_key_fields()
+    )
+
+
+def reset_pk(content):
+    """
+    Mark a Content unit as unsaved after the transaction that saved it has been rolled back.
+
+    Args:
+        content (:class:`~pulpcore.plugin.models.Content`): The unit to reset.
+    """
+    for parent in content._meta.get_parent_list():
+        setattr(content, parent._meta.pk.attname, None)
+    content.pk = None
+    content._state.adding = True
+
+
+class BatchContentSave(Stage):
     """
-    Save Content one at a time, combining duplicates.
+    Save Content in batches, combining duplicates.
+
+    Existing units are looked up with one query per Content type in each batch, new units are
+    saved in a single transaction, and their ContentArtifacts and RemoteArtifacts are created
+    with bulk inserts.
+
+    Artifacts that are downloaded on demand (`extra_data['deferred']`) do not need to be saved.
+    Their ContentArtifacts reference the Artifact if it is already in Pulp, and none otherwise.
+
+    Units saved or found earlier are taken from a :class:`ContentCache` without any query. Their
+    ContentArtifacts and RemoteArtifacts are still checked, since the cache may be shared with the
+    syncs of other remotes or download policies.
     """
 
+    def __init__(self, cache=None, executor=None):
+        """
+        Initialize the stage.
+
+        Args:
+            cache (ContentCache): The cache of units shared by the stages of the sync. A private
+                cache is used by default.
+            executor (BlockingExecutor): The threads that batches are saved in. Batches are
+                saved in the event loop by default.
+        """
+        self.cache = cache if cache is not None else ContentCache()
+        self.executor = executor
+
     async def __call__(self, in_q, out_q):
         """
         The coroutine for this stage.
@@ -33,98 +102,229 @@ class SerialContentSave(Stage):
             The coroutine for this stage.
 
         """
-        while True:
-            dc = await in_q.get()
-            # finished
-            if dc is None:
-                break
-
-            # Do not save Content that contains Artifacts which have not been downloaded
-            if not self.settled(dc):
-                await out_q.put(dc)
-            # already saved
-            elif dc.content.pk is not None:
-                await out_q.put(dc)
-            else:
-                self.save_and_dedupe_content(dc)
+        async for batch in self.batches(in_q):
+            # Do not save Content that contains Artifacts which have not been downloaded, or
+            # Content that has already been saved.
+            unsaved = [dc for dc in batch if self.settled(dc) and dc.content.pk is None]
+            if unsaved:
+                await run_blocking(self.executor, self.save_and_dedupe_content, unsaved)
+            for dc in batch:
                 await out_q.put(dc)
         await out_q.put(None)
 
-    def save_and_dedupe_content(self, dc):
+    def save_and_dedupe_content(self, dcs):
         """
         Combine duplicate Content, save unique Content.
 
         Args:
-            dc (class:`~pulpcore.plugin.stages.DeclarativeContent`): Object containing Content to
-                                                                     be saved.
+            dcs (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent` containing
+                unsaved Content to be saved.
+        """
+        unsaved_content = [dc.content for dc in dcs]
+        for attempt in range(1, MAX_BATCH_ATTEMPTS + 1):
+            try:
+                with transaction.atomic():
+                    saved = self._save_batch(dcs)
+            except IntegrityError:
+                # Another sync saved some of the same Content after it was looked up. Reset the
+                # batch and try again, the existing rows are visible now.
+                if attempt == MAX_BATCH_ATTEMPTS:
+                    raise
+                for dc, content in zip(dcs, unsaved_content):
+                    reset_pk(content)
+                    dc.content = content
+            else:
+                # Only committed units are cached.
+                for model_type, values in saved.items():
+                    self.cache.add_many(model_type, values)
+                return
+
+    def _save_batch(self, dcs):
+        """
+        Save a batch of unsaved Content within the current transaction.
+
+        Args:
+            dcs (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent` containing
+                unsaved Content to be saved.
+
+        Returns:
+            dict: Maps each Content type to a dict of natural key to the saved units that were
+                not cached yet.
+
+        """
+        self.find_deferred_artifacts(dcs)
+        units = self.dedupe(dcs)
+        saved = defaultdict(dict)
+        for model_type, keyed_units in units.items():
+            keys = [key for key in keyed_units if None not in key]
+            cached = self.cache.get_many(model_type, keys)
+            existing = self.query_existing(model_type, [key for key in keys if key not in cached])
+            for key, unit_dcs in keyed_units.items():
+                content = cached.get(key)
+                if content is None:
+                    content = existing.get(key)
+                    if content is None:
+                        content = unit_dcs[0].content
+                        content.save()
+                    if None not in key:
+                        saved[model_type][key] = content
+                for dc in unit_dcs:
+                    dc.content = content
+        # Cached units too: another remote of a batch sync, or an on_demand sync, may have cached
+        # them without this remote's RemoteArtifacts or the downloaded Artifacts.
+        self.create_content_artifacts(dcs)
+        return saved
+
+    @staticmethod
+    def dedupe(dcs):
         """
-        model_type = type(dc.content)
-        unit_key = dc.content.natural_key_dict()
-        try:
-            dc.content.save()
-        except IntegrityError:
-            existing_content = model_type.objects.get(**unit_key)
-            dc.content = existing_content
-            assert dc.content.pk is not None
+        Group DeclarativeContent by Content type and natural key.
 
-        self.create_content_artifacts(dc)
+        Units with an unset natural key field (e.g. a Tag that is not related to its Manifest
+        yet) are never combined, since the database does not consider them duplicates either.
 
-    def create_content_artifacts(self, dc):
+        Args:
+            dcs (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
+
+        Returns:
+            dict: Maps each Content type to an ordered dict of natural key to the list of dcs
+                sharing that key.
+
+        """
+        units = defaultdict(OrderedDict)
+        for dc in dcs:
+            key = natural_key(dc.content)
+            if None in key:
+                key = (None, id(dc))
+            units[type(dc.content)].setdefault(key, []).append(dc)
+        return units
+
+    @staticmethod
+    def find_deferred_artifacts(dcs):
         """
-        Create ContentArtifacts to associate saved Content to saved Artifacts.
+        Use the saved Artifacts of deferred downloads that are already in Pulp.
 
         Args:
-            dc (class:`~pulpcore.plugin.stages.DeclarativeContent`): Object containing Content and
-                                                                     Artifacts to relate.
+            dcs (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent`.
         """
-        for da in dc.d_artifacts:
-            content_artifact = ContentArtifact(
-                content=dc.content,
-                artifact=da.artifact,
-                relative_path=da.relative_path
-            )
-            try:
-                content_artifact.save()
-            except IntegrityError:
-                content_artifact = ContentArtifact.objects.get(
-                    content=dc.content,
-                    artifact=da.artifact,
-                    relative_path=da.relative_path
-                )
-
-            remote_artifact_data = {
-                'url': da.url,
-                'size': da.artifact.size,
-                'md5': da.artifact.md5,
-                'sha1': da.artifact.sha1,
-                'sha224': da.artifact.sha224,
-                'sha256': da.artifact.sha256,
-                'sha384': da.artifact.sha384,
-                'sha512': da.artifact.sha512,
-                'remote': da.remote,
-            }
-            new_remote_artifact = RemoteArtifact(
-                content_artifact=content_artifact, **remote_artifact_data
-            )
-            try:
-                new_remote_artifact.save()
-            except IntegrityError:
-                pass
+        deferred = [
+            da for dc in dcs for da in dc.d_artifacts
+            if da.artifact.pk is None and da.extra_data.get('deferred')
+        ]
+        if not deferred:
+            return
+        artifacts = {
+            artifact.sha256: artifact
+            for artifact in Artifact.objects.filter(
+                sha256__in={da.artifact.sha256 for da in deferred})
+        }
+        for da in deferred:
+            da.artifact = artifacts.get(da.artifact.sha256, da.artifact)
+
+    @staticmethod
+    def query_existing(model_type, keys):
+        """
+        Find saved Content for a set of natural keys with a single query.
+
+        Args:
+            model_type (type): The Content type to query.
+            keys (iterable): Natural keys, as returned by :func:`natural_key`.
+
+        Returns:
+            dict: Maps natural keys to saved Content.
+
+        """
+        fields = [model_type._meta.get_field(name).attname
+                  for name in model_type.natural_key_fields()]
+        lookups = [Q(**dict(zip(fields, key))) for key in keys if None not in key]
+        if not lookups:
+            return {}
+        query = reduce(operator.or_, lookups)
+        return {natural_key(content): content for content in model_type.objects.filter(query)}
+
+    def create_content_artifacts(self, dcs):
+        """
+        Create ContentArtifacts and RemoteArtifacts for a batch of saved Content.
+
+        Content that already existed may already have some of these, so those are looked up
+        first and only the missing rows are inserted. Existing ContentArtifacts without an
+        Artifact are updated when the Artifact has been downloaded since.
+
+        Args:
+            dcs (list): List of :class:`~pulpcore.plugin.stages.DeclarativeContent` with saved
+                Content and Artifacts to relate.
+        """
+        if not dcs:
+            return
+        content_pks = {dc.content.pk for dc in dcs}
+        content_artifacts = {
+            (ca.content_id, ca.relative_path): ca
+            for ca in ContentArtifact.objects.filter(content__pk__in=content_pks)
+        }
+        new_content_artifacts = []
+        for dc in dcs:
+            for da in dc.d_artifacts:
+                artifact = da.artifact if da.artifact.pk is not None else None
+                key = (dc.content.pk, da.relative_path)
+                content_artifact = content_artifacts.get(key)
+                if content_artifact is None:
+                    content_artifact = ContentArtifact(
+                        content=dc.content,
+                        artifact=artifact,
+                        relative_path=da.relative_path
+                    )
+                    content_artifacts[key] = content_artifact
+                    new_content_artifacts.append(content_artifact)
+                elif content_artifact.artifact_id is None and artifact is not None:
+                    content_artifact.artifact = artifact
+                    content_artifact.save(update_fields=['artifact'])
+        ContentArtifact.objects.bulk_create(new_content_artifacts)
+        if any(ca.pk is None for ca in new_content_artifacts):
+            # Not every database backend returns primary keys from bulk inserts.
+            content_artifacts.update({
+                (ca.content_id, ca.relative_path): ca
+                for ca in ContentArtifact.objects.filter(content__pk__in=content_pks)
+            })
+
+        remote_artifacts = set(RemoteArtifact.objects.filter(
+            content_artifact__in=list(content_artifacts.values())
+        ).values_list('content_artifact_id', 'remote_id'))
+        new_remote_artifacts = []
+        for dc in dcs:
+            for da in dc.d_artifacts:
+                content_artifact = content_artifacts[(dc.content.pk, da.relative_path)]
+                key = (content_artifact.pk, da.remote.pk)
+                if key in remote_artifacts:
+                    continue
+                remote_artifacts.add(key)
+                new_remote_artifacts.append(RemoteArtifact(
+                    content_artifact=content_artifact,
+                    url=da.url,
+                    size=da.artifact.size,
+                    md5=da.artifact.md5,
+                    sha1=da.artifact.sha1,
+                    sha224=da.artifact.sha224,
+                    sha256=da.artifact.sha256,
+                    sha384=da.artifact.sha384,
+                    sha512=da.artifact.sha512,
+                    remote=da.remote,
+                ))
+        RemoteArtifact.objects.bulk_create(new_remote_artifacts)
 
     def settled(self, dc):
         """
-        Indicates that all Artifacts in this dc are saved.
+        Indicates that all Artifacts in this dc are saved, or downloaded on demand.
 
         Args:
             dc (class:`~pulpcore.plugin.stages.DeclarativeContent`): Object containing Artifacts
                                                                      that may be saved.
 
         Returns:
-            bool: True when all Artifacts have been saved, False otherwise.
+            bool: True when all Artifacts have been saved or are deferred, False otherwise.
 
         """
         settled_dc = True
         for da in dc.d_artifacts:
-            if da.artifact.pk is None:
+            if da.artifact.pk is None and not da.extra_data.get('deferred'):
                 settled_dc = False
         return settled_dc
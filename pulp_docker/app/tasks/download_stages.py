@@ -0,0 +1,405 @@
+from gettext import gettext as _
+import asyncio
+import heapq
+import itertools
+import os
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import ArtifactSaver, QueryExistingArtifacts, Stage
+
+from pulp_docker.app.downloaders import DEFAULT_RANGED_DOWNLOAD_THRESHOLD
+from pulp_docker.app.models import ManifestBlob
+from pulp_docker.app.tasks.content_cache import ContentCache
+from pulp_docker.app.tasks.executor import run_blocking
+from pulp_docker.app.tasks.sync_stages import queued_batches
+
+
+# Default number of concurrent downloads of manifests, config blobs and small layers.
+DEFAULT_MAX_CONCURRENT_DOWNLOADS = 100
+
+# Default number of concurrent downloads of large layers, configurable with
+# DOCKER_LARGE_LAYER_DOWNLOADS.
+DEFAULT_LARGE_LAYER_DOWNLOADS = 2
+
+# Maximum number of units waiting to be downloaded before the stage stops reading its input.
+MAX_QUEUED = 1000
+
+# Digests of an Artifact that downloads are validated with, when they are known.
+DIGEST_FIELDS = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+
+# Priorities of the units waiting to be downloaded, lowest first.
+MANIFEST_PRIORITY = 0
+CONFIG_BLOB_PRIORITY = 1
+LAYER_PRIORITY = 2
+
+
+def needs_download(da):
+    """
+    Return whether an Artifact has to be downloaded.
+
+    Args:
+        da (pulpcore.plugin.stages.DeclarativeArtifact): The Artifact.
+
+    Returns:
+        bool: False if it is already in Pulp or is downloaded on demand, True otherwise.
+
+    """
+    return da.artifact.pk is None and not da.extra_data.get('deferred')
+
+
+def remove_unsaved_file(artifact, existing):
+    """
+    Remove the file of an Artifact whose row could not be inserted.
+
+    Saving an Artifact moves its file into storage before the row is inserted, so when another
+    process saved the same Artifact first, the copy in storage is left behind.
+
+    Args:
+        artifact (pulpcore.plugin.models.Artifact): The Artifact that could not be saved.
+        existing (pulpcore.plugin.models.Artifact): The saved Artifact of the same digest.
+    """
+    path = artifact.file.path
+    if path == existing.file.path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class DockerQueryExistingArtifacts(QueryExistingArtifacts):
+    """
+    Attach the Artifacts that are already in Pulp, looked up by sha256 digest.
+
+    Artifacts found or saved earlier are taken from a :class:`ContentCache` without any query.
+    Syncs that share the cache, such as the syncs of a batch, find the blobs that the others
+    saved.
+
+    Units are taken from the input queue as they arrive, without waiting for a full batch, since
+    the stage is part of the download and process loop.
+    """
+
+    def __init__(self, cache=None, executor=None):
+        """
+        Initialize the stage.
+
+        Args:
+            cache (ContentCache): The cache of Artifacts by digest. A private cache is used by
+                default.
+            executor (BlockingExecutor): The threads that Artifacts are looked up in. They are
+                looked up in the event loop by default.
+        """
+        self.cache = cache if cache is not None else ContentCache()
+        self.executor = executor
+
+    async def __call__(self, in_q, out_q):
+        """
+        Attach the existing Artifacts of each batch.
+
+        Args:
+            in_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects.
+            out_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects
+                whose Artifacts are saved ones where they exist.
+        """
+        async for batch in queued_batches(in_q):
+            das = [da for dc in batch for da in dc.d_artifacts
+                   if da.artifact.pk is None and da.artifact.sha256]
+            if das:
+                await run_blocking(self.executor, self.find_artifacts, das)
+            for dc in batch:
+                await out_q.put(dc)
+        await out_q.put(None)
+
+    def find_artifacts(self, das):
+        """
+        Replace unsaved Artifacts with the saved ones of the same sha256 digest.
+
+        Args:
+            das (list): List of pulpcore.plugin.stages.DeclarativeArtifact with unsaved
+                Artifacts of known sha256 digest.
+        """
+        digests = {da.artifact.sha256 for da in das}
+        found = {key[0]: artifact for key, artifact in
+                 self.cache.get_many(Artifact, [(digest,) for digest in digests]).items()}
+        missing = digests.difference(found)
+        if missing:
+            existing = {artifact.sha256: artifact for artifact in
+                        Artifact.objects.filter(sha256__in=missing)}
+            self.cache.add_many(Artifact, {(digest,): artifact
+                                           for digest, artifact in existing.items()})
+            found.update(existing)
+        for da in das:
+            artifact = found.get(da.artifact.sha256)
+            if artifact is not None:
+                da.artifact = artifact
+
+
+class DockerArtifactDownloader(Stage):
+    """
+    Download Artifacts, scheduled by content type and size.
+
+    Tags, manifest lists and manifests are downloaded first, so the content they reference is
+    discovered early, followed by config blobs and then layers, smallest first. Layers at least
+    as large as the DOCKER_RANGED_DOWNLOAD_THRESHOLD setting have their own lane of
+    DOCKER_LARGE_LAYER_DOWNLOADS concurrent downloads, so they can neither hold up the small
+    downloads nor be starved by them.
+
+    Units are read from the input queue as soon as they arrive, so that the ones waiting can be
+    reordered. Units with nothing to download are passed on right away.
+    """
+
+    def __init__(self, max_concurrent_downloads=DEFAULT_MAX_CONCURRENT_DOWNLOADS,
+                 max_large_downloads=None, large_layer_size=None):
+        """
+        Initialize the stage.
+
+        Args:
+            max_concurrent_downloads (int): The number of concurrent downloads of manifests,
+                config blobs and small layers.
+            max_large_downloads (int): The number of concurrent downloads of large layers.
+                Defaults to the DOCKER_LARGE_LAYER_DOWNLOADS setting.
+            large_layer_size (int): The size from which layers are downloaded in the large
+                lane. Defaults to the DOCKER_RANGED_DOWNLOAD_THRESHOLD setting.
+        """
+        if max_large_downloads is None:
+            max_large_downloads = getattr(settings, 'DOCKER_LARGE_LAYER_DOWNLOADS',
+                                          DEFAULT_LARGE_LAYER_DOWNLOADS)
+        if large_layer_size is None:
+            large_layer_size = getattr(settings, 'DOCKER_RANGED_DOWNLOAD_THRESHOLD',
+                                       DEFAULT_RANGED_DOWNLOAD_THRESHOLD)
+        self.lanes = [
+            DownloadLane(_('small'), max_concurrent_downloads),
+            DownloadLane(_('large'), max_large_downloads),
+        ]
+        self.large_layer_size = large_layer_size
+        self._order = itertools.count()
+
+    async def __call__(self, in_q, out_q):
+        """
+        Download the Artifacts of each unit in order of priority.
+
+        Args:
+            in_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects.
+            out_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects
+                whose Artifacts have been downloaded.
+        """
+        get = asyncio.ensure_future(in_q.get())
+        while get is not None or any(lane.busy for lane in self.lanes):
+            running = set()
+            for lane in self.lanes:
+                running.update(lane.start(self.download))
+            pending = running | ({get} if get is not None and not self.full else set())
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                if task is get:
+                    continue
+                for lane in self.lanes:
+                    lane.finished(task)
+                await out_q.put(task.result())
+
+            if get in done:
+                # Take everything that is queued, so that it is downloaded in order of priority.
+                dc = get.result()
+                get = None
+                while dc is not None:
+                    if any(needs_download(da) for da in dc.d_artifacts):
+                        self.schedule(dc)
+                    else:
+                        await out_q.put(dc)
+                    if self.full:
+                        get = asyncio.ensure_future(in_q.get())
+                        break
+                    try:
+                        dc = in_q.get_nowait()
+                    except asyncio.QueueEmpty:
+                        get = asyncio.ensure_future(in_q.get())
+                        break
+        await out_q.put(None)
+
+    @property
+    def full(self):
+        """Whether MAX_QUEUED units are waiting to be downloaded."""
+        return sum(len(lane.queue) for lane in self.lanes) >= MAX_QUEUED
+
+    def schedule(self, dc):
+        """
+        Queue a unit in the lane and at the priority its content type and size call for.
+
+        Args:
+            dc (pulpcore.plugin.stages.DeclarativeContent): The unit to download.
+        """
+        lane = self.lanes[0]
+        if type(dc.content) is not ManifestBlob:
+            priority = (MANIFEST_PRIORITY, 0)
+        elif 'config_relation' in dc.extra_data:
+            priority = (CONFIG_BLOB_PRIORITY, 0)
+        else:
+            size = dc.d_artifacts[0].artifact.size
+            # Layers of unknown size are downloaded after all the others of the small lane.
+            priority = (LAYER_PRIORITY, size if size is not None else float('inf'))
+            if size is not None and size >= self.large_layer_size:
+                lane = self.lanes[1]
+        heapq.heappush(lane.queue, (priority, next(self._order), dc))
+
+    async def download(self, dc):
+        """
+        Download the Artifacts of a unit that are not in Pulp yet.
+
+        Args:
+            dc (pulpcore.plugin.stages.DeclarativeContent): The unit to download.
+
+        Returns:
+            pulpcore.plugin.stages.DeclarativeContent: The unit, with unsaved downloaded
+                Artifacts.
+
+        """
+        await asyncio.gather(*(
+            self.download_artifact(da) for da in dc.d_artifacts if needs_download(da)
+        ))
+        return dc
+
+    @staticmethod
+    async def download_artifact(da):
+        """
+        Download an Artifact, validating its size and digests when they are known.
+
+        Args:
+            da (pulpcore.plugin.stages.DeclarativeArtifact): The Artifact to download.
+        """
+        expected_digests = {
+            name: getattr(da.artifact, name)
+            for name in DIGEST_FIELDS if getattr(da.artifact, name)
+        }
+        validation_kwargs = {}
+        if expected_digests:
+            validation_kwargs['expected_digests'] = expected_digests
+        if da.artifact.size is not None:
+            validation_kwargs['expected_size'] = da.artifact.size
+        downloader = da.remote.get_downloader(url=da.url, **validation_kwargs)
+        result = await downloader.run(extra_data=da.extra_data)
+        da.artifact = Artifact(file=result.path, **result.artifact_attributes)
+
+
+class DownloadLane:
+    """
+    A queue of units to download, and the downloads of it that are running.
+
+    Attributes:
+        name (str): The name of the lane.
+        limit (int): The number of concurrent downloads.
+        queue (list): A heap of (priority, order, dc) tuples waiting to be downloaded.
+        running (set): The running downloads.
+    """
+
+    def __init__(self, name, limit):
+        """
+        Create an empty lane.
+
+        Args:
+            name (str): The name of the lane.
+            limit (int): The number of concurrent downloads.
+        """
+        self.name = name
+        self.limit = limit
+        self.queue = []
+        self.running = set()
+
+    @property
+    def busy(self):
+        """Whether downloads are running or waiting."""
+        return bool(self.queue or self.running)
+
+    def start(self, download):
+        """
+        Start the downloads of the units with the highest priority, up to the limit.
+
+        Args:
+            download (callable): Returns the coroutine downloading a unit.
+
+        Returns:
+            set: The running downloads.
+
+        """
+        while self.queue and len(self.running) < self.limit:
+            dc = heapq.heappop(self.queue)[-1]
+            self.running.add(asyncio.ensure_future(download(dc)))
+        return self.running
+
+    def finished(self, task):
+        """
+        Forget a finished download.
+
+        Args:
+            task (asyncio.Task): The download.
+        """
+        self.running.discard(task)
+
+
+class DockerArtifactSaver(ArtifactSaver):
+    """
+    Save downloaded Artifacts, using the existing ones that were saved concurrently.
+
+    Concurrent syncs, such as the shards of a sharded sync, download the same blobs. When
+    another sync saves an Artifact after it was looked up, the existing Artifact is used and the
+    downloaded file is removed, like :class:`~pulp_docker.app.tasks.dedupe_save.BatchContentSave`
+    does for Content.
+
+    Saved Artifacts are added to the :class:`ContentCache` that
+    :class:`DockerQueryExistingArtifacts` looks them up in. Like that stage, it does not wait
+    for a full batch.
+    """
+
+    def __init__(self, cache=None, executor=None):
+        """
+        Initialize the stage.
+
+        Args:
+            cache (ContentCache): The cache of Artifacts by digest. A private cache is used by
+                default.
+            executor (BlockingExecutor): The threads that Artifacts are saved in. Artifacts are
+                saved in the event loop by default.
+        """
+        self.cache = cache if cache is not None else ContentCache()
+        self.executor = executor
+
+    async def __call__(self, in_q, out_q):
+        """
+        Save the downloaded Artifacts of each batch.
+
+        Args:
+            in_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects.
+            out_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects
+                whose downloaded Artifacts are saved.
+        """
+        async for batch in queued_batches(in_q):
+            das = [da for dc in batch for da in dc.d_artifacts if needs_download(da)]
+            if das:
+                await run_blocking(self.executor, self.save_artifacts, das)
+            for dc in batch:
+                await out_q.put(dc)
+        await out_q.put(None)
+
+    def save_artifacts(self, das):
+        """
+        Save downloaded Artifacts, each in its own transaction.
+
+        Args:
+            das (list): List of pulpcore.plugin.stages.DeclarativeArtifact with unsaved
+                downloaded Artifacts.
+        """
+        for da in das:
+            path = str(da.artifact.file)
+            da.artifact.file = path
+            try:
+                with transaction.atomic():
+                    da.artifact.save()
+            except IntegrityError:
+                # Another sync saved the same Artifact after it was looked up.
+                existing = Artifact.objects.get(sha256=da.artifact.sha256)
+                remove_unsaved_file(da.artifact, existing)
+                da.artifact = existing
+            # Only committed Artifacts are cached.
+            self.cache.add_many(Artifact, {(da.artifact.sha256,): da.artifact})
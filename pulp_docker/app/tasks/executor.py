@@ -0,0 +1,98 @@
+"""
+Run the blocking work of the sync stages in threads, so it does not stall the event loop.
+
+Database queries and file reads would otherwise pause every in-flight download whenever they
+are slow. Each stage awaits its own jobs one at a time, so the order of its output is kept,
+while different stages and the downloads go on in parallel.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+
+# Default number of threads of each sync, configurable with DOCKER_SYNC_THREADS.
+DEFAULT_SYNC_THREADS = 4
+
+
+class BlockingExecutor:
+    """
+    A bounded pool of threads for the ORM calls and file I/O of a sync.
+
+    Every thread uses its own database connection for all of its jobs. The connections are
+    closed when the pool is shut down, so that none outlives the sync.
+    """
+
+    def __init__(self, max_workers=None, queries=None):
+        """
+        Create the pool.
+
+        Args:
+            max_workers (int): The number of threads. Defaults to the DOCKER_SYNC_THREADS setting.
+            queries (pulp_docker.app.tasks.instrumentation.QueryCounter): Counts the queries of
+                the jobs, if given.
+        """
+        if max_workers is None:
+            max_workers = getattr(settings, 'DOCKER_SYNC_THREADS', DEFAULT_SYNC_THREADS)
+        self.queries = queries
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def run(self, func, *args):
+        """
+        Run a blocking function in the pool.
+
+        Args:
+            func (callable): The function.
+            args: The arguments of the function.
+
+        Returns:
+            The result of the function.
+
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._pool, self._call, func, args)
+
+    def _call(self, func, args):
+        # A connection broken by an earlier job is replaced, like Django does between requests.
+        connection.close_if_unusable_or_obsolete()
+        if self.queries is None:
+            return func(*args)
+        with self.queries.installed():
+            return func(*args)
+
+    def shutdown(self):
+        """
+        Wait for the running jobs, close the connection of every thread and stop the threads.
+        """
+        # Each job holds its thread until all of them run, so every thread of the pool runs one
+        # and closes its own connection.
+        barrier = threading.Barrier(self.max_workers)
+        for _ in range(self.max_workers):
+            self._pool.submit(self._close, barrier)
+        self._pool.shutdown(wait=True)
+
+    @staticmethod
+    def _close(barrier):
+        barrier.wait()
+        connection.close()
+
+
+async def run_blocking(executor, func, *args):
+    """
+    Run a blocking function in an executor, or right away when there is none.
+
+    Args:
+        executor (BlockingExecutor): The executor, or None.
+        func (callable): The function.
+        args: The arguments of the function.
+
+    Returns:
+        The result of the function.
+
+    """
+    if executor is None:
+        return func(*args)
+    return await executor.run(func, *args)
@@ -0,0 +1,364 @@
+"""
+Measure the throughput of the stages of a sync pipeline.
+
+Each stage is wrapped in an :class:`InstrumentedStage`, which counts the units it emits and the
+time it spends waiting for its input queue and for room in its output queue. The rest of its
+time is considered busy. The numbers are reported as a progress report per stage while the sync
+runs. Once it has finished, a JSON summary of all stages, the number of database queries and
+the peak memory usage of the process is logged and saved as a progress report of the task.
+"""
+from contextlib import contextmanager
+from gettext import gettext as _
+import asyncio
+import json
+import logging
+import resource
+import threading
+import time
+
+from django.db import connection
+from pulpcore.plugin.models import ProgressBar
+from pulpcore.plugin.stages import Stage
+
+from pulp_docker.app.tasks.executor import run_blocking
+
+
+log = logging.getLogger(__name__)
+
+
+# Number of seconds between two saves of the progress report of a running stage.
+REPORT_INTERVAL = 5
+
+
+class StageMetrics:
+    """
+    The counters of one stage.
+
+    Attributes:
+        name (str): The name of the stage.
+        units_in (int): The number of units received from the input queue.
+        units_out (int): The number of units put into the output queue.
+        waiting_in (float): Seconds spent waiting for the input queue.
+        waiting_out (float): Seconds spent waiting for room in the output queue.
+        queue_depth (int): The size of the input queue when a unit was last received.
+        max_queue_depth (int): The largest size of the input queue seen.
+    """
+
+    def __init__(self, name):
+        """
+        Create counters for a stage.
+
+        Args:
+            name (str): The name of the stage.
+        """
+        self.name = name
+        self.units_in = 0
+        self.units_out = 0
+        self.waiting_in = 0.0
+        self.waiting_out = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        """Seconds since the stage started, until it finished."""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def busy(self):
+        """Seconds spent neither waiting for input nor for room in the output queue."""
+        return max(self.elapsed - self.waiting_in - self.waiting_out, 0.0)
+
+    def sample_queue_depth(self, depth):
+        """
+        Record the size of the input queue.
+
+        Args:
+            depth (int): The number of units waiting in the input queue.
+        """
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def describe(self):
+        """
+        Return a one line description of the counters for progress reports.
+
+        Returns:
+            str: The description.
+
+        """
+        return _("{name}: {busy:.1f}s busy, {waiting_in:.1f}s waiting for input, "
+                 "{waiting_out:.1f}s waiting for output, queue depth {depth} "
+                 "(max {max_depth})").format(
+            name=self.name, busy=self.busy, waiting_in=self.waiting_in,
+            waiting_out=self.waiting_out, depth=self.queue_depth,
+            max_depth=self.max_queue_depth)
+
+    def as_dict(self):
+        """
+        Return the counters as a dict that can be serialized to JSON.
+
+        Returns:
+            dict: The counters, with times in seconds.
+
+        """
+        elapsed = self.elapsed
+        return {
+            'stage': self.name,
+            'units_in': self.units_in,
+            'units_out': self.units_out,
+            'elapsed': round(elapsed, 3),
+            'busy': round(self.busy, 3),
+            'waiting_in': round(self.waiting_in, 3),
+            'waiting_out': round(self.waiting_out, 3),
+            'max_queue_depth': self.max_queue_depth,
+            'units_per_second': round(self.units_out / elapsed, 3) if elapsed else None,
+        }
+
+
+class InputQueue:
+    """
+    A view of the input queue of a stage that records the time spent waiting for it.
+    """
+
+    def __init__(self, queue, metrics):
+        """
+        Wrap a queue.
+
+        Args:
+            queue (asyncio.Queue): The input queue of the stage.
+            metrics (StageMetrics): The counters of the stage.
+        """
+        self._queue = queue
+        self._metrics = metrics
+
+    async def get(self):
+        """
+        Wait for the next unit.
+
+        Returns:
+            The next item of the queue.
+
+        """
+        self._metrics.sample_queue_depth(self._queue.qsize())
+        start = time.monotonic()
+        try:
+            item = await self._queue.get()
+        finally:
+            self._metrics.waiting_in += time.monotonic() - start
+        return self._received(item)
+
+    def get_nowait(self):
+        """
+        Return the next unit if there is one.
+
+        Returns:
+            The next item of the queue.
+
+        Raises:
+            asyncio.QueueEmpty: When the queue is empty.
+
+        """
+        self._metrics.sample_queue_depth(self._queue.qsize())
+        return self._received(self._queue.get_nowait())
+
+    def _received(self, item):
+        if item is not None:
+            self._metrics.units_in += 1
+        return item
+
+    def __getattr__(self, name):
+        """Delegate everything else to the wrapped queue."""
+        return getattr(self._queue, name)
+
+
+class OutputQueue:
+    """
+    A view of the output queue of a stage that counts units and the time spent waiting for room.
+    """
+
+    def __init__(self, queue, metrics):
+        """
+        Wrap a queue.
+
+        Args:
+            queue (asyncio.Queue): The output queue of the stage.
+            metrics (StageMetrics): The counters of the stage.
+        """
+        self._queue = queue
+        self._metrics = metrics
+
+    async def put(self, item):
+        """
+        Wait for room in the queue and put a unit into it.
+
+        Args:
+            item: A unit, or None once the stage is finished.
+        """
+        start = time.monotonic()
+        try:
+            await self._queue.put(item)
+        finally:
+            self._metrics.waiting_out += time.monotonic() - start
+        self._sent(item)
+
+    def put_nowait(self, item):
+        """
+        Put a unit into the queue if there is room.
+
+        Args:
+            item: A unit, or None once the stage is finished.
+
+        Raises:
+            asyncio.QueueFull: When the queue is full.
+        """
+        self._queue.put_nowait(item)
+        self._sent(item)
+
+    def _sent(self, item):
+        if item is not None:
+            self._metrics.units_out += 1
+
+    def __getattr__(self, name):
+        """Delegate everything else to the wrapped queue."""
+        return getattr(self._queue, name)
+
+
+class InstrumentedStage(Stage):
+    """
+    Run a stage, measuring its throughput and reporting it as a progress report.
+
+    The progress report is saved every REPORT_INTERVAL seconds while the stage runs, and once
+    it has finished.
+    """
+
+    def __init__(self, stage, name=None, executor=None):
+        """
+        Wrap a stage.
+
+        Args:
+            stage (:class:`~pulpcore.plugin.stages.Stage`): The stage to measure.
+            name (str): The name to report the stage as. Defaults to the name of its class.
+            executor (BlockingExecutor): The threads that the progress report is saved in. It is
+                saved in the event loop by default.
+        """
+        self.stage = stage
+        self.metrics = StageMetrics(name or type(stage).__name__)
+        self.executor = executor
+        self._progress_bar = None
+
+    async def __call__(self, in_q, out_q):
+        """
+        Run the wrapped stage with instrumented queues.
+
+        Args:
+            in_q (asyncio.Queue): The input queue of the stage, None for the first stage.
+            out_q (asyncio.Queue): The output queue of the stage.
+        """
+        if in_q is not None:
+            in_q = InputQueue(in_q, self.metrics)
+        out_q = OutputQueue(out_q, self.metrics)
+        with ProgressBar(message=self.metrics.describe()) as progress_bar:
+            self._progress_bar = progress_bar
+            self.metrics.started = time.monotonic()
+            reporter = asyncio.ensure_future(self.report_periodically())
+            try:
+                await self.stage(in_q, out_q)
+            finally:
+                self.metrics.finished = time.monotonic()
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+                await self.report()
+
+    async def report_periodically(self):
+        """
+        Save the progress report of the stage every REPORT_INTERVAL seconds.
+        """
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            await self.report()
+
+    async def report(self):
+        """
+        Save the counters to the progress report of the stage.
+        """
+        self._progress_bar.done = self.metrics.units_out
+        self._progress_bar.message = self.metrics.describe()
+        await run_blocking(self.executor, self._progress_bar.save)
+
+
+class QueryCounter:
+    """
+    Count the database queries executed on the connections it is installed on.
+
+    Attributes:
+        count (int): The number of queries executed so far.
+    """
+
+    def __init__(self):
+        """Start counting from zero."""
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        """
+        Count a query and execute it, as a database execute wrapper.
+
+        Args:
+            execute (callable): Executes the query.
+            sql (str): The query.
+            params: The parameters of the query.
+            many (bool): Whether the query is executed for many sets of parameters.
+            context (dict): The connection and cursor executing the query.
+
+        Returns:
+            The result of `execute`.
+
+        """
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def installed(self, db_connection=None):
+        """
+        Count the queries of a connection within the context.
+
+        Args:
+            db_connection: The connection, the default connection of the current thread by
+                default.
+        """
+        with (db_connection or connection).execute_wrapper(self):
+            yield self
+
+
+def summarize(stages, queries):
+    """
+    Log the counters of instrumented stages and the resources used by the sync.
+
+    They are also saved as a progress report.
+
+    Args:
+        stages (list): List of :class:`InstrumentedStage`.
+        queries (QueryCounter): The queries executed by the sync.
+
+    Returns:
+        dict: The summary.
+
+    """
+    summary = {
+        'stages': [stage.metrics.as_dict() for stage in stages],
+        'queries': queries.count,
+        # Kilobytes on Linux. The peak of the worker process since it started, which includes the
+        # tasks it ran before this sync.
+        'process_max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    message = _("Sync pipeline summary: {summary}").format(summary=json.dumps(summary))
+    log.info(message)
+    with ProgressBar(message=message, done=len(stages)):
+        pass
+    return summary
@@ -0,0 +1,208 @@
+from collections import OrderedDict, defaultdict
+from gettext import gettext as _
+import asyncio
+import json
+import logging
+
+from pulpcore.plugin.models import Artifact, ProgressBar
+from pulpcore.plugin.stages import EndStage, Stage, create_pipeline
+from pulpcore.plugin.tasking import WorkingDirectory
+
+from pulp_docker.app.models import (DockerRemote, ImageManifest, ManifestBlob, ManifestList,
+                                    ManifestListTag, ManifestTag)
+from pulp_docker.app.tasks.download_stages import (DockerArtifactDownloader,
+                                                   DockerQueryExistingArtifacts)
+from pulp_docker.app.tasks.executor import BlockingExecutor, run_blocking
+from pulp_docker.app.tasks.sync_stages import (FeedbackStage, ProcessContentStage, TagListStage,
+                                               queued_batches)
+
+
+log = logging.getLogger(__name__)
+
+
+def plan_synchronize(remote_pk):
+    """
+    Report what a sync from a remote would download, without downloading any blob.
+
+    The tags and manifests of the remote are downloaded like in a sync, and the sizes of the
+    blobs are taken from the manifests. Blobs that are already in Pulp are not counted. Nothing
+    is saved and no repository version is created.
+
+    Args:
+        remote_pk (str): The remote PK.
+
+    Returns:
+        dict: The plan, as described by :meth:`SyncPlanStage.summary`.
+
+    Raises:
+        ValueError: If the remote does not specify a URL to sync
+
+    """
+    remote = DockerRemote.objects.get(pk=remote_pk)
+    if not remote.url:
+        raise ValueError(_('A remote must have a url specified to synchronize.'))
+    # Blobs are passed on with the sizes listed in their manifests instead of being downloaded.
+    remote.download_policy = DockerRemote.ON_DEMAND
+    executor = BlockingExecutor()
+    feedback = FeedbackStage()
+    plan = SyncPlanStage(executor)
+    stages = [
+        TagListStage(remote, feedback=feedback, executor=executor),
+        feedback,
+        DockerQueryExistingArtifacts(executor=executor),
+        DockerArtifactDownloader(),
+        ProcessContentStage(remote, feedback, executor),
+        plan,
+        EndStage(),
+    ]
+    try:
+        with WorkingDirectory():
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(create_pipeline(stages))
+    finally:
+        executor.shutdown()
+
+    summary = plan.summary()
+    message = _("Sync plan: {plan}").format(plan=json.dumps(summary))
+    log.info(message)
+    with ProgressBar(message=message, total=summary['new_blobs'], done=summary['new_blobs']):
+        pass
+    return summary
+
+
+class SyncPlanStage(Stage):
+    """
+    Collect the blobs each tag references, and find the ones that are not in Pulp yet.
+
+    Attributes:
+        tags (OrderedDict): Maps tag names to the digest of the manifest or manifest list they
+            point at.
+        manifests (set): Digests of the ImageManifests and ManifestLists.
+        list_manifests (dict): Maps ManifestList digests to the digests of their ImageManifests.
+        manifest_blobs (dict): Maps ImageManifest digests to the sha256 digests of their blobs.
+        blob_sizes (dict): Maps the sha256 digest of each blob to its size, or None if the
+            manifest does not list it.
+        existing (set): The sha256 digests of the blobs that are already in Pulp.
+    """
+
+    def __init__(self, executor=None):
+        """
+        Initialize the stage.
+
+        Args:
+            executor (BlockingExecutor): The threads that Artifacts are looked up in. They are
+                looked up in the event loop by default.
+        """
+        self.executor = executor
+        self.tags = OrderedDict()
+        self.manifests = set()
+        self.list_manifests = defaultdict(set)
+        self.manifest_blobs = defaultdict(set)
+        self.blob_sizes = {}
+        self.existing = set()
+
+    async def __call__(self, in_q, out_q):
+        """
+        Add the content at hand to the plan and pass it on, without waiting for a full batch.
+
+        Args:
+            in_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects.
+            out_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects.
+        """
+        async for batch in queued_batches(in_q):
+            await run_blocking(self.executor, self.add_batch, batch)
+            for dc in batch:
+                await out_q.put(dc)
+        await out_q.put(None)
+
+    def add_batch(self, batch):
+        """
+        Add the content of a batch to the plan, looking up its new blobs with a single query.
+
+        Args:
+            batch (list): List of pulpcore.plugin.stages.DeclarativeContent.
+        """
+        new_blobs = set()
+        for dc in batch:
+            content_type = type(dc.content)
+            relation = dc.extra_data.get('relation') or dc.extra_data.get('config_relation')
+            if content_type in (ManifestTag, ManifestListTag):
+                self.tags[dc.content.name] = dc.extra_data.get('tagged', (None, None))[1]
+            elif content_type in (ImageManifest, ManifestList):
+                self.manifests.add(dc.content.digest)
+                if relation:
+                    self.list_manifests[relation[1]].add(dc.content.digest)
+            elif content_type is ManifestBlob:
+                da = dc.d_artifacts[0]
+                sha256 = da.artifact.sha256
+                if sha256 not in self.blob_sizes:
+                    self.blob_sizes[sha256] = da.extra_data.get('size')
+                    new_blobs.add(sha256)
+                if relation:
+                    self.manifest_blobs[relation[1]].add(sha256)
+        if new_blobs:
+            self.existing.update(Artifact.objects.filter(
+                sha256__in=new_blobs).values_list('sha256', flat=True))
+
+    def blobs(self, digest):
+        """
+        Return the blobs referenced by a manifest or manifest list.
+
+        Args:
+            digest (str): The digest of the ImageManifest or ManifestList.
+
+        Returns:
+            set: The sha256 digests of the blobs.
+
+        """
+        blobs = set(self.manifest_blobs.get(digest, ()))
+        for manifest_digest in self.list_manifests.get(digest, ()):
+            blobs.update(self.manifest_blobs.get(manifest_digest, ()))
+        return blobs
+
+    def cost(self, digests):
+        """
+        Return the number and total size of the blobs of a set that are not in Pulp yet.
+
+        Args:
+            digests (set): sha256 digests of blobs.
+
+        Returns:
+            tuple: The number of new blobs, their total size, and how many of them have no known
+                size.
+
+        """
+        sizes = [self.blob_sizes[digest] for digest in digests if digest not in self.existing]
+        return len(sizes), sum(size or 0 for size in sizes), sizes.count(None)
+
+    def summary(self):
+        """
+        Return the plan.
+
+        Blobs shared by several tags are counted once in the totals, and once for each tag.
+
+        Returns:
+            dict: The number of tags, manifests and blobs, the number and total size of the blobs
+                that would be downloaded, and the same for each tag.
+
+        """
+        new_blobs, new_bytes, unknown_size = self.cost(self.blob_sizes)
+        per_tag = OrderedDict()
+        for name, digest in self.tags.items():
+            digests = self.blobs(digest)
+            tag_blobs, tag_bytes, tag_unknown_size = self.cost(digests)
+            per_tag[name] = {
+                'blobs': len(digests),
+                'new_blobs': tag_blobs,
+                'new_bytes': tag_bytes,
+                'unknown_size': tag_unknown_size,
+            }
+        return {
+            'tags': len(self.tags),
+            'manifests': len(self.manifests),
+            'blobs': len(self.blob_sizes),
+            'new_blobs': new_blobs,
+            'new_bytes': new_bytes,
+            'unknown_size': unknown_size,
+            'per_tag': per_tag,
+        }
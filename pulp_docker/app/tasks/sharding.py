@@ -0,0 +1,299 @@
+"""
+Sync a remote with many tags with several workers.
+
+The upstream tags list is split into shards. Each shard is synced by its own task into a scratch
+repository. The last shard task to finish enqueues a task that creates a single new version of
+the repository with the content of all of them, then deletes the scratch repositories.
+
+A shard whose task ended without recording its outcome, e.g. because it was canceled, is
+abandoned. It counts as failed once another shard of the sync finishes. When no shard is left to
+finish, the scratch repositories are deleted by the next sharded sync of the repository.
+"""
+from collections import defaultdict
+from functools import reduce
+from gettext import gettext as _
+from uuid import uuid4
+import asyncio
+import logging
+import operator
+
+from django.db import transaction
+from django.db.models import Q
+from pulpcore.constants import TASK_FINAL_STATES
+from pulpcore.plugin.models import Content, ProgressBar, Repository, RepositoryVersion, Task
+from pulpcore.plugin.tasking import WorkingDirectory, enqueue_with_reservation
+
+from pulp_docker.app.models import DockerRemote, ManifestListTag, ManifestTag, SyncShard
+from pulp_docker.app.tasks.sync_stages import TagListStage
+from pulp_docker.app.tasks.synchronize import DockerDeclarativeVersion
+
+
+log = logging.getLogger(__name__)
+
+
+def synchronize_sharded(remote_pk, repository_pk, shards):
+    """
+    Sync content from the remote repository with a task per shard of the upstream tags.
+
+    The tags are split into contiguous shards, so tags that are likely to share layers are synced
+    by the same task. A task is enqueued for every shard, and the last one to finish enqueues the
+    task that merges the shards into a new version of the repository.
+
+    Args:
+        remote_pk (str): The remote PK.
+        repository_pk (str): The repository PK.
+        shards (int): The number of shards.
+
+    Raises:
+        ValueError: If the remote does not specify a URL to sync
+
+    """
+    remote = DockerRemote.objects.get(pk=remote_pk)
+    repository = Repository.objects.get(pk=repository_pk)
+    if not remote.url:
+        raise ValueError(_('A remote must have a url specified to synchronize.'))
+    delete_abandoned_syncs(repository)
+
+    with WorkingDirectory():
+        loop = asyncio.get_event_loop()
+        tag_names = loop.run_until_complete(list_tags(remote))
+
+    sync_id = uuid4()
+    tag_shards = split_tags(tag_names, shards)
+    log.info(_("Syncing {tags} tags of {name} in {shards} shards").format(
+        tags=len(tag_names), name=repository.name, shards=len(tag_shards)))
+    if not tag_shards:
+        enqueue_merge(repository, sync_id)
+        return
+
+    # Every shard is recorded before any is enqueued, so none can finish while others are missing.
+    sync_shards = []
+    for number in range(1, len(tag_shards) + 1):
+        shard_repository = Repository.objects.create(
+            name='{name}-shard-{number}-{uuid}'.format(
+                name=repository.name, number=number, uuid=uuid4().hex),
+            description=_('Shard of a sync of {name}, deleted once the sync is '
+                          'merged.').format(name=repository.name),
+        )
+        sync_shards.append(SyncShard.objects.create(
+            sync_id=sync_id, repository=shard_repository, target=repository))
+
+    with ProgressBar(message=_('Enqueuing shards'), total=len(tag_shards)) as progress:
+        for sync_shard, shard in zip(sync_shards, tag_shards):
+            result = enqueue_with_reservation(
+                synchronize_shard,
+                [sync_shard.repository],
+                kwargs={
+                    'remote_pk': remote.pk,
+                    'repository_pk': sync_shard.repository.pk,
+                    'tag_names': shard,
+                }
+            )
+            SyncShard.objects.filter(pk=sync_shard.pk).update(task_id=result.id)
+            progress.increment()
+
+
+def enqueue_merge(repository, sync_id):
+    """
+    Enqueue the task that merges the shards of a sync into the repository.
+
+    Args:
+        repository (:class:`~pulpcore.plugin.models.Repository`): The repository.
+        sync_id (uuid.UUID): Identifies the sharded sync.
+    """
+    enqueue_with_reservation(
+        merge_shards,
+        [repository],
+        kwargs={
+            'repository_pk': repository.pk,
+            'sync_id': str(sync_id),
+        }
+    )
+
+
+async def list_tags(remote):
+    """
+    Download the names of all upstream tags that the remote includes.
+
+    Args:
+        remote (DockerRemote): The remote.
+
+    Returns:
+        list: The tag names, in the order of the upstream tags list.
+
+    """
+    return [name async for page in TagListStage(remote).tag_pages() for name in page]
+
+
+def split_tags(tag_names, shards):
+    """
+    Split tag names into at most `shards` contiguous shards of nearly equal sizes.
+
+    Args:
+        tag_names (list): The tag names.
+        shards (int): The number of shards.
+
+    Returns:
+        list: Lists of tag names. Empty shards are left out.
+
+    """
+    size, remainder = divmod(len(tag_names), shards)
+    result = []
+    start = 0
+    for number in range(shards):
+        end = start + size + (1 if number < remainder else 0)
+        if end > start:
+            result.append(tag_names[start:end])
+        start = end
+    return result
+
+
+def synchronize_shard(remote_pk, repository_pk, tag_names):
+    """
+    Sync some tags of the remote repository into a scratch repository.
+
+    Shards of the same sync download shared blobs concurrently, and use the Artifacts that
+    another shard saved first. Whether the sync succeeds or fails, the shard records its outcome,
+    and the last shard of the sync to finish enqueues the merge.
+
+    Args:
+        remote_pk (str): The remote PK.
+        repository_pk (str): The PK of the scratch repository.
+        tag_names (list): Names of the upstream tags to sync.
+
+    """
+    remove_duplicate_tags = [{'model': ManifestTag, 'field_names': ['name']},
+                             {'model': ManifestListTag, 'field_names': ['name']}]
+    sync_shard = None
+    state = SyncShard.FAILED
+    try:
+        sync_shard = SyncShard.objects.select_related('repository').get(
+            repository__pk=repository_pk)
+        remote = DockerRemote.objects.get(pk=remote_pk)
+        dv = DockerDeclarativeVersion(sync_shard.repository, remote,
+                                      remove_duplicates=remove_duplicate_tags, tag_names=tag_names)
+        dv.create()
+        state = SyncShard.COMPLETED
+    finally:
+        # Without its shard, the scratch repository was deleted and there is nothing to record.
+        if sync_shard is not None:
+            finish_shard(sync_shard, state)
+
+
+def finish_shard(sync_shard, state):
+    """
+    Record the outcome of a shard, and enqueue the merge if it is the last shard to finish.
+
+    The shards of the sync are locked while the outcome is recorded, so shards that finish at the
+    same time see each other's outcome, and exactly one of them sees that all shards finished.
+    Abandoned shards are recorded as failed.
+
+    Args:
+        sync_shard (:class:`~pulp_docker.app.models.SyncShard`): The shard.
+        state (str): :attr:`SyncShard.COMPLETED` or :attr:`SyncShard.FAILED`.
+    """
+    with transaction.atomic():
+        sync_shards = list(SyncShard.objects.select_for_update().filter(
+            sync_id=sync_shard.sync_id).order_by('pk'))
+        SyncShard.objects.filter(pk=sync_shard.pk).update(state=state)
+        waiting = [other for other in sync_shards
+                   if other.state == SyncShard.WAITING and other.pk != sync_shard.pk]
+        abandoned = abandoned_shards(waiting)
+        if abandoned:
+            log.warning(_("The tasks of {count} shards of {name} ended without recording their "
+                          "outcome").format(count=len(abandoned), name=sync_shard.target.name))
+            SyncShard.objects.filter(pk__in=[other.pk for other in abandoned]).update(
+                state=SyncShard.FAILED)
+        if len(abandoned) < len(waiting):
+            return
+        # The merge task must see the outcome, so it is enqueued once that is committed.
+        target, sync_id = sync_shard.target, sync_shard.sync_id
+        transaction.on_commit(lambda: enqueue_merge(target, sync_id))
+
+
+def abandoned_shards(sync_shards):
+    """
+    Return the waiting shards whose task ended without recording the outcome of the shard.
+
+    Shards record their outcome before their task ends, so a waiting shard whose task is in a
+    final state never will, e.g. because the task was canceled or its worker was lost.
+
+    Args:
+        sync_shards (list): :class:`~pulp_docker.app.models.SyncShard` instances.
+
+    Returns:
+        list: The abandoned shards.
+
+    """
+    task_pks = [sync_shard.task_id for sync_shard in sync_shards
+                if sync_shard.state == SyncShard.WAITING and sync_shard.task_id is not None]
+    ended = set(Task.objects.filter(pk__in=task_pks, state__in=TASK_FINAL_STATES).values_list(
+        'pk', flat=True))
+    return [sync_shard for sync_shard in sync_shards
+            if sync_shard.state == SyncShard.WAITING and sync_shard.task_id in ended]
+
+
+def delete_abandoned_syncs(repository):
+    """
+    Delete the scratch repositories of earlier syncs of a repository that can no longer finish.
+
+    A sync can no longer finish when every shard either finished or was abandoned, and at least
+    one was abandoned. The merge was not enqueued then, as no shard saw all others finish.
+
+    Args:
+        repository (:class:`~pulpcore.plugin.models.Repository`): The repository.
+    """
+    sync_shards = list(SyncShard.objects.filter(target=repository))
+    abandoned = {sync_shard.pk for sync_shard in abandoned_shards(sync_shards)}
+    syncs = defaultdict(list)
+    for sync_shard in sync_shards:
+        syncs[sync_shard.sync_id].append(sync_shard)
+    for sync_id, shards in syncs.items():
+        running = any(shard.state == SyncShard.WAITING and shard.pk not in abandoned
+                      for shard in shards)
+        if running or not any(shard.pk in abandoned for shard in shards):
+            continue
+        log.warning(_("Deleting the shards of an abandoned sync of {name}").format(
+            name=repository.name))
+        # The shards are deleted with their scratch repositories.
+        Repository.objects.filter(pk__in=[shard.repository_id for shard in shards]).delete()
+
+
+def merge_shards(repository_pk, sync_id):
+    """
+    Create a version of the repository with the content of the shards of a sync.
+
+    The new version has the content of the latest versions of all scratch repositories, and
+    nothing else. The scratch repositories are deleted, whether the sync succeeded or not.
+
+    Args:
+        repository_pk (str): The repository PK.
+        sync_id (str): Identifies the sharded sync.
+
+    Raises:
+        RuntimeError: If the sync of any shard did not complete. The repository is not changed.
+
+    """
+    repository = Repository.objects.get(pk=repository_pk)
+    sync_shards = SyncShard.objects.filter(sync_id=sync_id)
+    shard_repositories = Repository.objects.filter(
+        pk__in=list(sync_shards.values_list('repository__pk', flat=True)))
+    try:
+        failed = sync_shards.exclude(state=SyncShard.COMPLETED).count()
+        if failed:
+            raise RuntimeError(_("The sync of {count} shards of {name} did not complete").format(
+                count=failed, name=repository.name))
+
+        versions = [shard.latest_version() for shard in shard_repositories]
+        in_shards = [Q(pk__in=version.content) for version in versions if version is not None]
+        if in_shards:
+            content = Content.objects.filter(reduce(operator.or_, in_shards))
+        else:
+            content = Content.objects.none()
+        with transaction.atomic():
+            with RepositoryVersion.create(repository) as new_version:
+                new_version.remove_content(new_version.content.exclude(pk__in=content))
+                new_version.add_content(content.exclude(pk__in=new_version.content))
+    finally:
+        # The shards are deleted with their scratch repositories.
+        shard_repositories.delete()
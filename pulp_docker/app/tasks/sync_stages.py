@@ -1,14 +1,23 @@
+from collections import OrderedDict, defaultdict
+from functools import reduce
+from itertools import chain
 from urllib.parse import urljoin
+import asyncio
 import json
 import logging
+import operator
 
-from django.db import IntegrityError
-from pulpcore.plugin.models import Artifact
+from aiohttp import ClientError
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Q, Value, When
+from pulpcore.plugin.models import Artifact, ContentArtifact
 from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent, Stage
 
-from pulp_docker.app.models import (ImageManifest, MEDIA_TYPE, ManifestBlob, ManifestTag,
-                                    ManifestList, ManifestListTag, BlobManifestBlob,
-                                    ManifestListManifest)
+from pulp_docker.app.models import (DockerRemote, ImageManifest, MEDIA_TYPE, ManifestBlob,
+                                    ManifestTag, ManifestList, ManifestListTag,
+                                    BlobManifestBlob, ManifestListManifest)
+from pulp_docker.app.tasks.content_cache import ContentCache
+from pulp_docker.app.tasks.executor import run_blocking
 
 
 log = logging.getLogger(__name__)
@@ -18,6 +27,78 @@ V2_ACCEPT_HEADERS = {
     'accept': ','.join([MEDIA_TYPE.MANIFEST_V2, MEDIA_TYPE.MANIFEST_LIST])
 }
 
+# Number of tags requested per page of the tags list.
+TAG_LIST_PAGE_SIZE = 1000
+
+# Number of tag digests requested concurrently during an incremental sync.
+INCREMENTAL_BATCH_SIZE = 100
+
+# Maximum number of queued units handled together by a stage of the download and process loop.
+PROCESS_BATCH_SIZE = 100
+
+# Number of units in the download and process loop above which no more tags are emitted.
+MAX_IN_FLIGHT = 1000
+
+# The type of Tag used for each type of tagged content, and the field that references it.
+TAG_TYPES = {
+    ImageManifest: (ManifestTag, 'manifest'),
+    ManifestList: (ManifestListTag, 'manifest_list'),
+}
+
+
+def parse_next_link(link_header):
+    """
+    Find the url of the next page in a `Link` header.
+
+    Args:
+        link_header (str): Value of the `Link` header of a paginated response, or None.
+
+    Returns:
+        str: The (possibly relative) url of the next page, or None on the last page.
+
+    """
+    if not link_header:
+        return None
+    for link in link_header.split(','):
+        url, *params = link.split(';')
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'rel' and value.strip().strip('"') == 'next':
+                return url.strip().lstrip('<').rstrip('>')
+    return None
+
+
+async def queued_batches(in_q, maxsize=PROCESS_BATCH_SIZE):
+    """
+    Read a queue in batches of the units that are at hand, without waiting for more.
+
+    The stages between `FeedbackStage` and `ProcessContentStage` must not wait for a full batch
+    like `Stage.batches` does: `FeedbackStage` only ends the loop once every unit it emitted has
+    been processed, so the units held back by such a stage would never be followed by the end of
+    the queue.
+
+    Args:
+        in_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects.
+        maxsize (int): The largest number of units in a batch.
+
+    Yields:
+        list: The units that were queued, at least one.
+
+    """
+    finished = False
+    while not finished:
+        batch = [await in_q.get()]
+        while batch[-1] is not None and len(batch) < maxsize:
+            try:
+                batch.append(in_q.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        if batch[-1] is None:
+            finished = True
+            batch.pop()
+        if batch:
+            yield batch
+
 
 class TempTag:
     """
@@ -29,14 +110,67 @@ class TempTag:
         self.name = name
 
 
+class TempManifest:
+    """
+    A pseudo Tag for a manifest pulled by digest.
+
+    It will either become an ImageManifest or a ManifestList without a tag.
+    """
+
+    def __init__(self, digest):
+        """Make a temp manifest."""
+        self.digest = digest
+
+
 class TagListStage(Stage):
     """
     The first stage of a pulp_docker sync pipeline.
+
+    When the remote knows the token auth challenge of its registry from an earlier sync, a token
+    is requested before the first request, so no request is rejected for lacking one.
+
+    The tags list is requested one page at a time, and the tags of each page are emitted before
+    the next page is requested. Tags excluded by the filters of the remote are dropped before
+    any of their manifests are requested.
+
+    In incremental mode, the digest of each tag is requested with a HEAD request first. Tags
+    whose manifest is already known to Pulp are emitted as finished content, together with all
+    content they reference, so their manifests are neither downloaded nor processed again.
+
+    When the names of the tags to sync are given, the tags list is not requested at all. Manifests
+    can be synced by digest too, without any tag.
+
+    The tags are emitted in a bounded window: while the download and process loop holds too many
+    units, the next tag waits, and so does the next page of the tags list.
     """
 
-    def __init__(self, remote):
-        """Initialize the stage."""
+    def __init__(self, remote, repository=None, incremental=False, tag_names=None,
+                 feedback=None, digests=None, executor=None):
+        """
+        Initialize the stage.
+
+        Args:
+            remote (pulp_docker.app.models.DockerRemote): The remote to sync from.
+            repository (pulpcore.plugin.models.Repository): The repository being synced. Only
+                used in incremental mode.
+            incremental (bool): Skip tags whose manifests are already known to Pulp.
+            tag_names (list): Names of the tags to sync instead of the upstream tags list.
+            feedback (FeedbackStage): The entry of the download and process loop. When given,
+                tags are only emitted while fewer than MAX_IN_FLIGHT units are in the loop.
+            digests (list): Digests of manifests or manifest lists to sync without a tag. The
+                tags list is not requested when they are given.
+            executor (BlockingExecutor): The threads that known tags and content are looked up
+                in. They are looked up in the event loop by default.
+        """
         self.remote = remote
+        self.repository = repository
+        self.incremental = incremental
+        self.tag_names = tag_names
+        self.digests = digests
+        self.feedback = feedback
+        self.executor = executor
+        self.known_tags = {}
+        self.emitted_pks = set()
 
     async def __call__(self, in_q, out_q):
         """
@@ -50,21 +184,98 @@ class TagListStage(Stage):
         log.debug("Fetching tags list for upstream repository: {repo}".format(
             repo=self.remote.upstream_name
         ))
-        relative_url = '/v2/{name}/tags/list'.format(name=self.remote.namespaced_upstream_name)
-        tag_list_url = urljoin(self.remote.url, relative_url)
-        list_downloader = self.remote.get_downloader(tag_list_url)
-        await list_downloader.run()
+        if self.incremental:
+            self.known_tags = await run_blocking(self.executor, self.latest_version_tags)
 
-        with open(list_downloader.path) as tags_raw:
-            tags_dict = json.loads(tags_raw.read())
-            tag_list = tags_dict['tags']
+        if self.tag_names is not None or self.digests:
+            await self.emit_tags(self.remote.filter_tags(self.tag_names or []), out_q)
+            for digest in self.digests or []:
+                await self.put(self.create_pending_digest(digest), out_q)
+            await out_q.put(None)
+            return
 
-        for tag_name in tag_list:
-            tag_dc = self.create_pending_tag(tag_name)
-            await out_q.put(tag_dc)
+        async for tag_list in self.tag_pages():
+            await self.emit_tags(tag_list, out_q)
 
         await out_q.put(None)
 
+    async def tag_pages(self):
+        """
+        Download the upstream tags list one page at a time.
+
+        Yields:
+            list: The names of the tags of a page that the remote includes.
+
+        """
+        relative_url = '/v2/{name}/tags/list?n={page_size}'.format(
+            name=self.remote.namespaced_upstream_name,
+            page_size=TAG_LIST_PAGE_SIZE,
+        )
+        tag_list_url = urljoin(self.remote.url, relative_url)
+        while tag_list_url:
+            list_downloader = self.remote.get_downloader(tag_list_url)
+            await list_downloader.run()
+
+            with open(list_downloader.path) as tags_raw:
+                tags_dict = json.loads(tags_raw.read())
+                tag_list = tags_dict['tags'] or []
+
+            yield self.remote.filter_tags(tag_list)
+
+            next_page = parse_next_link(list_downloader.response_headers.get('Link'))
+            tag_list_url = next_page and urljoin(tag_list_url, next_page)
+
+    async def emit_tags(self, tag_list, out_q):
+        """
+        Emit `DeclarativeContent` for a list of tag names.
+
+        Args:
+            tag_list (list): Names of the tags to emit.
+            out_q (asyncio.Queue): Tag `DeclarativeContent` objects are sent here.
+        """
+        if not self.incremental:
+            for tag_name in tag_list:
+                tag_dc = self.create_pending_tag(tag_name)
+                await self.put(tag_dc, out_q)
+            return
+
+        for start in range(0, len(tag_list), INCREMENTAL_BATCH_SIZE):
+            tag_names = tag_list[start:start + INCREMENTAL_BATCH_SIZE]
+            digests = await asyncio.gather(*(self.get_tag_digest(name) for name in tag_names))
+            dcs = await run_blocking(self.executor, self.create_tags_from_digests,
+                                     OrderedDict(zip(tag_names, digests)))
+            for dc in dcs:
+                await self.put(dc, out_q)
+
+    async def put(self, dc, out_q):
+        """
+        Emit a `DeclarativeContent` once there is room for it in the download and process loop.
+
+        Args:
+            dc (pulpcore.plugin.stages.DeclarativeContent): The content to emit.
+            out_q (asyncio.Queue): The queue to emit it to.
+        """
+        if self.feedback is not None:
+            await self.feedback.wait_for_room(MAX_IN_FLIGHT)
+        await out_q.put(dc)
+
+    def tag_url(self, tag_name):
+        """
+        Return the url of the manifest for a tag.
+
+        Args:
+            tag_name (str): Name of the tag
+
+        Returns:
+            str: The manifest url.
+
+        """
+        relative_url = '/v2/{name}/manifests/{tag}'.format(
+            name=self.remote.namespaced_upstream_name,
+            tag=tag_name,
+        )
+        return urljoin(self.remote.url, relative_url)
+
     def create_pending_tag(self, tag_name):
         """
         Create `DeclarativeContent` for each tag.
@@ -78,23 +289,325 @@ class TagListStage(Stage):
             pulpcore.plugin.stages.DeclarativeContent: A Tag DeclarativeContent object
 
         """
-        relative_url = '/v2/{name}/manifests/{tag}'.format(
-            name=self.remote.namespaced_upstream_name,
-            tag=tag_name,
-        )
-        url = urljoin(self.remote.url, relative_url)
         tag = TempTag(name=tag_name)
         manifest_artifact = Artifact()
         da = DeclarativeArtifact(
             artifact=manifest_artifact,
-            url=url,
+            url=self.tag_url(tag_name),
             relative_path=tag_name,
             remote=self.remote,
-            extra_data={'headers': V2_ACCEPT_HEADERS}
+            extra_data={'headers': V2_ACCEPT_HEADERS, 'buffer_body': True}
         )
         tag_dc = DeclarativeContent(content=tag, d_artifacts=[da])
         return tag_dc
 
+    def create_pending_digest(self, digest):
+        """
+        Create `DeclarativeContent` for a manifest or manifest list known by its digest.
+
+        Args:
+            digest (str): The digest of the manifest or manifest list.
+
+        Returns:
+            pulpcore.plugin.stages.DeclarativeContent: A TempManifest DeclarativeContent object
+
+        """
+        da = DeclarativeArtifact(
+            artifact=Artifact(sha256=digest[len('sha256:'):]),
+            url=self.tag_url(digest),
+            relative_path=digest,
+            remote=self.remote,
+            extra_data={'headers': V2_ACCEPT_HEADERS, 'buffer_body': True}
+        )
+        return DeclarativeContent(content=TempManifest(digest), d_artifacts=[da])
+
+    async def get_tag_digest(self, tag_name):
+        """
+        Request the digest of the manifest a tag currently points to.
+
+        Args:
+            tag_name (str): Name of the tag
+
+        Returns:
+            str: The manifest digest, or None if the registry did not provide it.
+
+        """
+        downloader = self.remote.get_downloader(self.tag_url(tag_name))
+        try:
+            await downloader.run(extra_data={'headers': V2_ACCEPT_HEADERS, 'method': 'head'})
+        except ClientError as e:
+            log.debug("Unable to fetch the digest of tag {tag}: {error}".format(
+                tag=tag_name, error=e))
+            return None
+        return downloader.response_headers.get('Docker-Content-Digest')
+
+    def latest_version_tags(self):
+        """
+        Map the tag names in the latest version of the repository to the tags.
+
+        Returns:
+            dict: Tag names mapped to ManifestTags and ManifestListTags.
+
+        """
+        version = self.repository.latest_version()
+        if version is None:
+            return {}
+        manifest_tags = ManifestTag.objects.filter(
+            pk__in=version.content, manifest__isnull=False).select_related('manifest')
+        manifest_list_tags = ManifestListTag.objects.filter(
+            pk__in=version.content, manifest_list__isnull=False).select_related('manifest_list')
+        return {tag.name: tag for tag in chain(manifest_tags, manifest_list_tags)}
+
+    def create_tags_from_digests(self, tag_digests):
+        """
+        Create `DeclarativeContent` for tags whose digests are known.
+
+        Tags pointing at content that is already in Pulp are emitted as finished content,
+        followed by all of the content they reference. All other tags are left pending, and so
+        are tags of manifest lists whose listed platforms were not recorded when the remote
+        filters platforms. Those lists are downloaded and parsed again.
+
+        Args:
+            tag_digests (OrderedDict): Tag names mapped to manifest digests or None.
+
+        Returns:
+            list: pulpcore.plugin.stages.DeclarativeContent objects to emit.
+
+        """
+        digests = {digest for digest in tag_digests.values() if digest}
+        known_content = {
+            content.digest: content for content in chain(
+                ManifestList.objects.filter(digest__in=digests),
+                ImageManifest.objects.filter(digest__in=digests),
+            )
+        }
+        if self.remote.platforms:
+            unknown_platforms = ManifestListManifest.objects.filter(
+                Q(os='') | Q(architecture=''), manifest_list__digest__in=digests,
+            ).values_list('manifest_list__digest', flat=True)
+            for digest in set(unknown_platforms):
+                del known_content[digest]
+
+        dcs = []
+        tagged = OrderedDict()
+        for tag_name, digest in tag_digests.items():
+            if digest in known_content:
+                tagged[tag_name] = known_content[digest]
+            else:
+                dcs.append(self.create_pending_tag(tag_name))
+
+        dcs.extend(self.create_known_tags(tagged))
+        dcs.extend(self.create_known_content(tagged.values()))
+        return dcs
+
+    def create_known_tags(self, tagged):
+        """
+        Create `DeclarativeContent` for tags pointing at saved content.
+
+        Existing tags are reused. New tags share the artifact of the content they point at.
+
+        Args:
+            tagged (OrderedDict): Tag names mapped to saved ImageManifests or ManifestLists.
+
+        Returns:
+            list: Finished pulpcore.plugin.stages.DeclarativeContent objects for the tags.
+
+        """
+        existing_tags = {}
+        lookups = {ManifestTag: [], ManifestListTag: []}
+        for tag_name, content in tagged.items():
+            known_tag = self.known_tags.get(tag_name)
+            if known_tag is not None and self.tagged_content(known_tag) == content:
+                existing_tags[tag_name] = known_tag
+            else:
+                tag_type, field_name = TAG_TYPES[type(content)]
+                lookups[tag_type].append(Q(name=tag_name, **{field_name: content}))
+        for tag_type, queries in lookups.items():
+            if queries:
+                for tag in tag_type.objects.filter(reduce(operator.or_, queries)):
+                    existing_tags[tag.name] = tag
+
+        new_tags = [name for name in tagged if name not in existing_tags]
+        artifacts = {
+            ca.content_id: ca.artifact for ca in ContentArtifact.objects.filter(
+                content__in=[tagged[name] for name in new_tags]).select_related('artifact')
+        }
+
+        dcs = []
+        for tag_name, content in tagged.items():
+            if tag_name in existing_tags:
+                dcs.append(self.create_finished_content(existing_tags[tag_name]))
+                continue
+            if content.pk not in artifacts:
+                dcs.append(self.create_pending_tag(tag_name))
+                continue
+            tag_type, field_name = TAG_TYPES[type(content)]
+            da = DeclarativeArtifact(
+                artifact=artifacts[content.pk],
+                url=self.tag_url(tag_name),
+                relative_path=tag_name,
+                remote=self.remote,
+                extra_data={'headers': V2_ACCEPT_HEADERS}
+            )
+            tag = tag_type(name=tag_name, **{field_name: content})
+            dcs.append(DeclarativeContent(
+                content=tag, d_artifacts=[da], extra_data={'processed': True}))
+        return dcs
+
+    def create_known_content(self, tagged_content):
+        """
+        Create finished `DeclarativeContent` for saved content and everything it references.
+
+        Content that has already been emitted by this stage is skipped, and so are the listed
+        manifests for platforms the remote does not accept.
+
+        Args:
+            tagged_content (iterable): Saved ImageManifests and ManifestLists.
+
+        Returns:
+            list: Finished pulpcore.plugin.stages.DeclarativeContent objects.
+
+        """
+        manifest_lists = [c for c in tagged_content if type(c) is ManifestList]
+        manifest_pks = {c.pk for c in tagged_content if type(c) is ImageManifest}
+        listed = ManifestListManifest.objects.filter(manifest_list__in=manifest_lists).values(
+            'manifest_id', 'os', 'architecture', 'variant')
+        # Manifests for other platforms are not synced, like in ProcessContentStage.
+        manifest_pks.update(
+            row['manifest_id'] for row in listed if self.remote.accepts_platform(row))
+        manifests = list(ImageManifest.objects.filter(pk__in=manifest_pks))
+        blob_pks = set(BlobManifestBlob.objects.filter(
+            manifest__pk__in=manifest_pks).values_list('manifest_blob_id', flat=True))
+        blob_pks.update(m.config_blob_id for m in manifests if m.config_blob_id is not None)
+
+        dcs = []
+        units = chain(manifest_lists, manifests, ManifestBlob.objects.filter(pk__in=blob_pks))
+        for unit in units:
+            if unit.pk not in self.emitted_pks:
+                self.emitted_pks.add(unit.pk)
+                dcs.append(self.create_finished_content(unit))
+        return dcs
+
+    @staticmethod
+    def create_finished_content(content):
+        """
+        Wrap saved content in `DeclarativeContent` that needs no further processing.
+
+        Args:
+            content (pulpcore.plugin.models.Content): Saved content.
+
+        Returns:
+            pulpcore.plugin.stages.DeclarativeContent: A finished DeclarativeContent object
+
+        """
+        return DeclarativeContent(content=content, d_artifacts=[], extra_data={'processed': True})
+
+    @staticmethod
+    def tagged_content(tag):
+        """
+        Return the ImageManifest or ManifestList a tag points at.
+
+        Args:
+            tag: Either a ManifestTag or ManifestListTag
+
+        Returns:
+            The tagged ImageManifest or ManifestList
+
+        """
+        if type(tag) is ManifestTag:
+            return tag.manifest
+        return tag.manifest_list
+
+
+class FeedbackStage(Stage):
+    """
+    The entry of the download, process and save loop of a pulp_docker sync pipeline.
+
+    Content emitted by the previous stage and content fed back by `ProcessContentStage` are both
+    sent through the same stages, so nested content of any depth is handled in a single pass.
+    Fed back content is emitted first. The stage finishes once its input queue is exhausted and
+    every content unit that entered the loop has been processed.
+    """
+
+    def __init__(self):
+        """Initialize the stage."""
+        self.queue = asyncio.Queue()
+        self.in_flight = 0
+        self.upstream_finished = False
+        self.room = asyncio.Condition()
+
+    async def __call__(self, in_q, out_q):
+        """
+        Emit content from the input queue and fed back content.
+
+        Args:
+            in_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects.
+            out_q (asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects to
+                download, process and save.
+        """
+        upstream_get = asyncio.ensure_future(in_q.get())
+        feedback_get = asyncio.ensure_future(self.queue.get())
+        while True:
+            pending = [get for get in (feedback_get, upstream_get) if get is not None]
+            await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            if feedback_get.done():
+                dc = feedback_get.result()
+                if dc is None:
+                    break
+                await out_q.put(dc)
+                feedback_get = asyncio.ensure_future(self.queue.get())
+
+            if upstream_get is not None and upstream_get.done():
+                dc = upstream_get.result()
+                if dc is None:
+                    upstream_get = None
+                    self.upstream_finished = True
+                    await self.finish_if_complete()
+                else:
+                    self.in_flight += 1
+                    await out_q.put(dc)
+                    upstream_get = asyncio.ensure_future(in_q.get())
+
+        await out_q.put(None)
+
+    async def put(self, dc):
+        """
+        Feed a DeclarativeContent back into the loop.
+
+        Args:
+            dc (pulpcore.plugin.stages.DeclarativeContent): Pending content that was discovered
+                while processing other content.
+        """
+        self.in_flight += 1
+        await self.queue.put(dc)
+
+    async def done(self):
+        """
+        Mark a DeclarativeContent that entered the loop as processed.
+        """
+        self.in_flight -= 1
+        async with self.room:
+            self.room.notify_all()
+        await self.finish_if_complete()
+
+    async def wait_for_room(self, limit):
+        """
+        Wait until fewer than `limit` units are in the loop.
+
+        Args:
+            limit (int): The number of units in the loop to stay under.
+        """
+        async with self.room:
+            await self.room.wait_for(lambda: self.in_flight < limit)
+
+    async def finish_if_complete(self):
+        """
+        Stop the loop when no more content can be fed back.
+        """
+        if self.upstream_finished and self.in_flight == 0:
+            await self.queue.put(None)
+
 
 class ProcessContentStage(Stage):
     """
@@ -102,13 +615,34 @@ class ProcessContentStage(Stage):
 
     For each processed type, create content from nested fields. This stage does not process
     ManifestBlobs, which do not contain nested content.
+
+    Nested content that still needs to be downloaded is fed back into the `FeedbackStage`. When
+    the remote downloads on demand, blobs are not downloaded, they are passed on right after
+    their ImageManifest instead.
+
+    Units are taken from the input queue as they arrive, without waiting for a full batch, since
+    the content they feed back may be what the rest of the queue is waiting for. The manifests of
+    all the units at hand that were not buffered by the downloader are read together.
+
+    Relations to other content are recorded in `extra_data` as (type, digest) pairs rather than
+    references to other DeclarativeContent, so that each unit can be freed as soon as it has
+    left the pipeline: 'tagged' on Tags, 'relation' on listed ImageManifests and on blobs, and
+    'config_relation' on config blobs.
     """
 
-    def __init__(self, remote):
+    def __init__(self, remote, feedback, executor=None):
         """
         Inform the stage about the remote to use.
+
+        Args:
+            remote (pulp_docker.app.models.DockerRemote): The remote to sync from.
+            feedback (FeedbackStage): The stage that pending nested content is fed back into.
+            executor (BlockingExecutor): The threads that manifests are read in. Manifests are
+                read in the event loop by default.
         """
         self.remote = remote
+        self.feedback = feedback
+        self.executor = executor
 
     async def __call__(self, in_q, out_q):
         """
@@ -121,50 +655,90 @@ class ProcessContentStage(Stage):
                                   have either been processed or were created in this stage.
 
         """
-        while True:
-            dc = await in_q.get()
-            if dc is None:
-                break
-            elif dc.extra_data.get('processed'):
-                await out_q.put(dc)
-                continue
-            elif type(dc.content) is ManifestBlob:
-                await out_q.put(dc)
+        async for batch in queued_batches(in_q):
+            await run_blocking(self.executor, self.read_manifest_files, batch)
+            for dc in batch:
+                await self.process(dc, out_q)
+                await self.feedback.done()
+
+        await out_q.put(None)
+
+    def read_manifest_files(self, batch):
+        """
+        Read the manifests of a batch that were not buffered by the downloader.
+
+        Args:
+            batch (list): List of pulpcore.plugin.stages.DeclarativeContent to be processed.
+        """
+        for dc in batch:
+            if dc.extra_data.get('processed') or type(dc.content) is ManifestBlob:
                 continue
+            for da in dc.d_artifacts:
+                if 'body' not in da.extra_data:
+                    with da.artifact.file.open() as content_file:
+                        da.extra_data['body'] = content_file.read()
 
-            # All docker content contains a single artifact.
-            assert len(dc.d_artifacts) == 1
-            with dc.d_artifacts[0].artifact.file.open() as content_file:
-                raw = content_file.read()
-            content_data = json.loads(raw)
+    async def process(self, dc, out_q):
+        """
+        Process a single DeclarativeContent.
 
-            if type(dc.content) is TempTag:
-                if content_data.get('mediaType') == MEDIA_TYPE.MANIFEST_LIST:
-                    await self.create_and_process_tagged_manifest_list(dc, content_data, out_q)
+        Args:
+            dc (pulpcore.plugin.stages.DeclarativeContent): dc to process.
+            out_q(asyncio.Queue): Queue of pulpcore.plugin.stages.DeclarativeContent objects that
+                                  have either been processed or were created in this stage.
+
+        """
+        if dc.extra_data.get('processed') or type(dc.content) is ManifestBlob:
+            await out_q.put(dc)
+            return
+
+        # All docker content contains a single artifact.
+        assert len(dc.d_artifacts) == 1
+        content_data = json.loads(self.read_artifact(dc.d_artifacts[0]))
+
+        if type(dc.content) in (TempTag, TempManifest):
+            # A manifest pulled by digest only yields the manifest, without a tag.
+            tagged = type(dc.content) is TempTag
+            if content_data.get('mediaType') == MEDIA_TYPE.MANIFEST_LIST:
+                await self.create_and_process_tagged_manifest_list(dc, content_data, out_q)
+                if tagged:
                     await out_q.put(dc)
-                elif content_data.get('mediaType') == MEDIA_TYPE.MANIFEST_V2:
-                    await self.create_and_process_tagged_manifest(dc, content_data, out_q)
+            elif content_data.get('mediaType') == MEDIA_TYPE.MANIFEST_V2:
+                await self.create_and_process_tagged_manifest(dc, content_data, out_q)
+                if tagged:
                     await out_q.put(dc)
-                else:
-                    assert content_data.get('schemaVersion') == 1
-            elif type(dc.content) is ImageManifest:
-                for layer in content_data.get("layers"):
-                    blob_dc = await self.create_pending_blob(dc, layer, out_q)
-                    blob_dc.extra_data['relation'] = dc
-                    await out_q.put(blob_dc)
-
-                config_layer = content_data.get('config')
-                if config_layer:
-                    config_blob_dc = await self.create_pending_blob(dc, config_layer, out_q)
-                    config_blob_dc.extra_data['config_relation'] = dc
-                    await out_q.put(config_blob_dc)
-                dc.extra_data['processed'] = True
-                await out_q.put(dc)
             else:
-                msg = "Unexpected type cannot be processed{tp}".format(tp=type(dc.content))
-                raise Exception(msg)
+                assert content_data.get('schemaVersion') == 1
+        elif type(dc.content) is ImageManifest:
+            deferred_blobs = await self.create_pending_blobs(dc, content_data)
+            dc.extra_data['processed'] = True
+            await out_q.put(dc)
+            for blob_dc in deferred_blobs:
+                await out_q.put(blob_dc)
+        else:
+            msg = "Unexpected type cannot be processed{tp}".format(tp=type(dc.content))
+            raise Exception(msg)
 
-        await out_q.put(None)
+    @staticmethod
+    def read_artifact(da):
+        """
+        Read the body of a downloaded manifest.
+
+        The body buffered by the downloader or read by :meth:`read_manifest_files` is used when
+        available, otherwise it is read from the artifact file.
+
+        Args:
+            da (pulpcore.plugin.stages.DeclarativeArtifact): The downloaded manifest artifact.
+
+        Returns:
+            bytes: The manifest body.
+
+        """
+        body = da.extra_data.pop('body', None)
+        if body is not None:
+            return body
+        with da.artifact.file.open() as content_file:
+            return content_file.read()
 
     async def create_and_process_tagged_manifest_list(self, tag_dc, manifest_list_data, out_q):
         """
@@ -173,9 +747,10 @@ class ProcessContentStage(Stage):
         Args:
             tag_dc (pulpcore.plugin.stages.DeclarativeContent): dc for a Tag
             manifest_list_data (dict): Data about a ManifestList
-            out_q (asyncio.Queue): Queue to put created ManifestList and ImageManifest dcs.
+            out_q (asyncio.Queue): Queue to put the created ManifestList dc.
         """
-        tag_dc.content = ManifestListTag(name=tag_dc.content.name)
+        if type(tag_dc.content) is TempTag:
+            tag_dc.content = ManifestListTag(name=tag_dc.content.name)
         digest = "sha256:{digest}".format(digest=tag_dc.d_artifacts[0].artifact.sha256)
         relative_url = '/v2/{name}/manifests/{digest}'.format(
             name=self.remote.namespaced_upstream_name,
@@ -196,8 +771,10 @@ class ProcessContentStage(Stage):
         )
         list_dc = DeclarativeContent(content=manifest_list, d_artifacts=[da])
         for manifest in manifest_list_data.get('manifests'):
-            await self.create_pending_manifest(list_dc, manifest, out_q)
-        list_dc.extra_data['relation'] = tag_dc
+            # Manifests for other platforms are not synced, nor are their blobs.
+            if self.remote.accepts_platform(manifest.get('platform', {})):
+                await self.create_pending_manifest(list_dc, manifest)
+        tag_dc.extra_data['tagged'] = (ManifestList, digest)
         list_dc.extra_data['processed'] = True
         tag_dc.extra_data['processed'] = True
         await out_q.put(list_dc)
@@ -209,9 +786,10 @@ class ProcessContentStage(Stage):
         Args:
             tag_dc (pulpcore.plugin.stages.DeclarativeContent): dc for a Tag
             manifest_data (dict): Data about a single new ImageManifest.
-            out_q (asyncio.Queue): Queue to put created ImageManifest dcs and Blob dcs.
+            out_q (asyncio.Queue): Queue to put the created ImageManifest dc.
         """
-        tag_dc.content = ManifestTag(name=tag_dc.content.name)
+        if type(tag_dc.content) is TempTag:
+            tag_dc.content = ManifestTag(name=tag_dc.content.name)
         digest = "sha256:{digest}".format(digest=tag_dc.d_artifacts[0].artifact.sha256)
         manifest = ImageManifest(
             digest=digest,
@@ -231,29 +809,24 @@ class ProcessContentStage(Stage):
             extra_data={'headers': V2_ACCEPT_HEADERS}
         )
         man_dc = DeclarativeContent(content=manifest, d_artifacts=[da])
-        for layer in manifest_data.get('layers'):
-            blob_dc = await self.create_pending_blob(man_dc, layer, out_q)
-            blob_dc.extra_data['relation'] = man_dc
-            await out_q.put(blob_dc)
-        config_layer = manifest_data.get('config')
-        if config_layer:
-            config_blob_dc = await self.create_pending_blob(man_dc, config_layer, out_q)
-            config_blob_dc.extra_data['config_relation'] = man_dc
-            await out_q.put(config_blob_dc)
+        deferred_blobs = await self.create_pending_blobs(man_dc, manifest_data)
 
-        man_dc.extra_data['relation'] = tag_dc
+        tag_dc.extra_data['tagged'] = (ImageManifest, digest)
         tag_dc.extra_data['processed'] = True
         man_dc.extra_data['processed'] = True
         await out_q.put(man_dc)
+        for blob_dc in deferred_blobs:
+            await out_q.put(blob_dc)
 
-    async def create_pending_manifest(self, list_dc, manifest_data, out_q):
+    async def create_pending_manifest(self, list_dc, manifest_data):
         """
         Create a pending manifest from manifest data in a ManifestList.
 
+        The pending manifest is fed back to be downloaded and processed.
+
         Args:
             list_dc (pulpcore.plugin.stages.DeclarativeContent): dc for a ManifestList
             manifest_data (dict): Data about a single new ImageManifest.
-            out_q (asyncio.Queue): Queue to put created ImageManifest dcs.
         """
         digest = manifest_data['digest']
         relative_url = '/v2/{name}/manifests/{digest}'.format(
@@ -267,7 +840,7 @@ class ProcessContentStage(Stage):
             url=manifest_url,
             relative_path=digest,
             remote=self.remote,
-            extra_data={'headers': V2_ACCEPT_HEADERS}
+            extra_data={'headers': V2_ACCEPT_HEADERS, 'buffer_body': True}
         )
         manifest = ImageManifest(
             digest=manifest_data['digest'],
@@ -277,22 +850,59 @@ class ProcessContentStage(Stage):
         man_dc = DeclarativeContent(
             content=manifest,
             d_artifacts=[da],
-            extra_data={'relation': list_dc}
+            extra_data={
+                'relation': (ManifestList, list_dc.content.digest),
+                'platform': manifest_data.get('platform', {}),
+            }
         )
-        await out_q.put(man_dc)
+        await self.feedback.put(man_dc)
+
+    async def create_pending_blobs(self, man_dc, manifest_data):
+        """
+        Create pending blobs for the layers and the config of an ImageManifest.
+
+        The pending blobs are fed back to be downloaded, unless the remote downloads on demand.
+
+        Args:
+            man_dc (pulpcore.plugin.stages.DeclarativeContent): dc for an ImageManifest
+            manifest_data (dict): Data about the ImageManifest.
+
+        Returns:
+            list: The pending blobs that are not downloaded. They must be passed on after the
+                ImageManifest.
 
-    async def create_pending_blob(self, man_dc, blob_data, out_q):
+        """
+        blob_dcs = []
+        for layer in manifest_data.get('layers'):
+            blob_dc = self.create_pending_blob(man_dc, layer)
+            blob_dc.extra_data['relation'] = (ImageManifest, man_dc.content.digest)
+            blob_dcs.append(blob_dc)
+        config_layer = manifest_data.get('config')
+        if config_layer:
+            config_blob_dc = self.create_pending_blob(man_dc, config_layer)
+            config_blob_dc.extra_data['config_relation'] = (ImageManifest, man_dc.content.digest)
+            blob_dcs.append(config_blob_dc)
+
+        if self.remote.download_policy == DockerRemote.ON_DEMAND:
+            return blob_dcs
+        for blob_dc in blob_dcs:
+            await self.feedback.put(blob_dc)
+        return []
+
+    def create_pending_blob(self, man_dc, blob_data):
         """
         Create a pending blob from a layer in the ImageManifest.
 
         Args:
             man_dc (pulpcore.plugin.stages.DeclarativeContent): dc for an ImageManifest
             blob_data (dict): Data about a single new blob.
-            out_q (asyncio.Queue): Queue to put created blob dcs.
+
+        Returns:
+            pulpcore.plugin.stages.DeclarativeContent: A pending blob DeclarativeContent object
 
         """
         digest = blob_data['digest']
-        blob_artifact = Artifact(sha256=digest[len("sha256:"):])
+        blob_artifact = Artifact(sha256=digest[len("sha256:"):], size=blob_data.get('size'))
         blob = ManifestBlob(
             digest=digest,
             media_type=blob_data['mediaType'],
@@ -307,7 +917,12 @@ class ProcessContentStage(Stage):
             url=blob_url,
             relative_path=blob_data['digest'],
             remote=self.remote,
-            extra_data={'headers': V2_ACCEPT_HEADERS}
+            # The size lets the downloader split large blobs into parallel range requests.
+            extra_data={
+                'headers': V2_ACCEPT_HEADERS,
+                'size': blob_data.get('size'),
+                'deferred': self.remote.download_policy == DockerRemote.ON_DEMAND,
+            }
         )
         blob_dc = DeclarativeContent(
             content=blob,
@@ -319,8 +934,27 @@ class ProcessContentStage(Stage):
 class InterrelateContent(Stage):
     """
     Stage for relating Content to other Content.
+
+    Relations are collected for each batch and written with one query per relation type. The
+    related ImageManifests and ManifestLists are found by digest, they have been saved by the
+    time the content that references them arrives.
+    Relations created or found earlier in the same sync are remembered in a
+    :class:`~pulp_docker.app.tasks.content_cache.ContentCache` and skipped.
     """
 
+    def __init__(self, cache=None, executor=None):
+        """
+        Initialize the stage.
+
+        Args:
+            cache (ContentCache): The cache shared by the stages of the sync. A private cache is
+                used by default.
+            executor (BlockingExecutor): The threads that batches are related in. Batches are
+                related in the event loop by default.
+        """
+        self.cache = cache if cache is not None else ContentCache()
+        self.executor = executor
+
     async def __call__(self, in_q, out_q):
         """
         Relate each item in the in_q to objects specified on the DeclarativeContent.
@@ -329,80 +963,248 @@ class InterrelateContent(Stage):
             in_q (asyncio.Queue): A queue of unrelated pulpcore.plugin.DeclarativeContent objects
             out_q (asyncio.Queue): A queue of unrelated pulpcore.plugin.DeclarativeContent objects
         """
-        while True:
-            dc = await in_q.get()
-            if dc is None:
-                break
-            if dc.extra_data.get('relation'):
-                if type(dc.content) is ManifestList:
-                    self.relate_manifest_list(dc)
-                elif type(dc.content) is ManifestBlob:
-                    self.relate_blob(dc)
-                elif type(dc.content) is ImageManifest:
-                    self.relate_manifest(dc)
-
-            configured_dc = dc.extra_data.get('config_relation')
-            if configured_dc:
-                configured_dc.content.config_blob = dc.content
-                configured_dc.content.save()
-
-            await out_q.put(dc)
+        async for batch in self.batches(in_q):
+            await run_blocking(self.executor, self.relate_batch, batch)
+            for dc in batch:
+                await out_q.put(dc)
         await out_q.put(None)
 
-    def relate_blob(self, dc):
+    def relate_batch(self, batch):
         """
-        Relate a ManifestBlob to a Manifest.
+        Relate all Content in a batch.
 
         Args:
-            dc (pulpcore.plugin.stages.DeclarativeContent): dc for a ManifestList
+            batch (list): List of saved pulpcore.plugin.stages.DeclarativeContent
         """
-        related_dc = dc.extra_data.get('relation')
-        assert related_dc is not None
-        thru = BlobManifestBlob(manifest=related_dc.content, manifest_blob=dc.content)
-        try:
-            thru.save()
-        except IntegrityError:
-            pass
+        references = set()
+        for dc in batch:
+            for key in ('tagged', 'relation', 'config_relation'):
+                if key in dc.extra_data:
+                    references.add(dc.extra_data[key])
+        related = self.resolve(references)
+
+        blob_relations = set()
+        list_relations = {}
+        tagged = {ManifestTag: [], ManifestListTag: []}
+        config_blobs = {}
+        for dc in batch:
+            content_type = type(dc.content)
+            if 'tagged' in dc.extra_data:
+                tagged[content_type].append((dc, related[dc.extra_data['tagged']]))
+            elif 'relation' in dc.extra_data:
+                related_content = related[dc.extra_data['relation']]
+                if content_type is ManifestBlob:
+                    blob_relations.add((related_content.pk, dc.content.pk))
+                elif content_type is ImageManifest:
+                    platform = platform_fields(dc.extra_data.get('platform', {}))
+                    list_relations[(related_content.pk, dc.content.pk)] = platform
+            elif 'config_relation' in dc.extra_data:
+                manifest = related[dc.extra_data['config_relation']]
+                if manifest.config_blob_id != dc.content.pk:
+                    manifest.config_blob_id = dc.content.pk
+                    config_blobs[manifest.pk] = dc.content.pk
+
+        blob_relations = self.uncached(BlobManifestBlob, blob_relations)
+        list_relations = self.uncached(ManifestListManifest, list_relations)
+        with transaction.atomic():
+            self.relate_tags(ManifestTag, 'manifest', tagged[ManifestTag])
+            self.relate_tags(ManifestListTag, 'manifest_list', tagged[ManifestListTag])
+            bulk_relate(BlobManifestBlob, 'manifest', 'manifest_blob', blob_relations)
+            bulk_relate(ManifestListManifest, 'manifest_list', 'manifest', list_relations)
+            bulk_update_relation(ImageManifest, 'config_blob', config_blobs)
+        self.cache.add_many(BlobManifestBlob, dict.fromkeys(blob_relations, True))
+        self.cache.add_many(ManifestListManifest, dict.fromkeys(list_relations, True))
 
-    def relate_manifest(self, dc):
+    def resolve(self, references):
         """
-        Relate an ImageManifest to a Tag or ManifestList.
+        Find the saved content referenced by (type, digest) pairs.
 
         Args:
-            dc (pulpcore.plugin.stages.DeclarativeContent): dc for a ManifestList
+            references (set): Set of (type, digest) tuples of ImageManifests and ManifestLists.
+
+        Returns:
+            dict: Maps each reference to the saved content.
+
         """
-        related_dc = dc.extra_data.get('relation')
-        assert related_dc is not None
-        if type(related_dc.content) is ManifestTag:
-            assert related_dc.content.manifest is None
-            related_dc.content.manifest = dc.content
-            try:
-                related_dc.content.save()
-            except IntegrityError:
-                existing_tag = ManifestTag.objects.get(name=related_dc.content.name,
-                                                       manifest=dc.content)
-                related_dc.content = existing_tag
-        elif type(related_dc.content) is ManifestList:
-            thru = ManifestListManifest(manifest_list=related_dc.content, manifest=dc.content)
-            try:
-                thru.save()
-            except IntegrityError:
-                pass
+        digests = defaultdict(set)
+        for model_type, digest in references:
+            digests[model_type].add(digest)
+        related = {}
+        for model_type, type_digests in digests.items():
+            found = {
+                key[0]: content for key, content in
+                self.cache.get_many(model_type, [(digest,) for digest in type_digests]).items()
+            }
+            missing = type_digests.difference(found)
+            if missing:
+                queried = {
+                    content.digest: content
+                    for content in model_type.objects.filter(digest__in=missing)
+                }
+                self.cache.add_many(model_type, {
+                    (digest,): content for digest, content in queried.items()
+                })
+                found.update(queried)
+            related.update(((model_type, digest), content) for digest, content in found.items())
+        return related
+
+    def uncached(self, through_type, relations):
+        """
+        Drop the relations that are known to exist from earlier batches of the sync.
+
+        Args:
+            through_type (type): The model of the many-to-many table.
+            relations (set): Set of (from_pk, to_pk) tuples, or a dict mapping them to the values
+                of the other fields of each relation.
+
+        Returns:
+            set: The relations that are not cached, or a dict if `relations` is a dict.
+
+        """
+        cached = self.cache.get_many(through_type, relations)
+        if isinstance(relations, dict):
+            return {key: value for key, value in relations.items() if key not in cached}
+        return {key for key in relations if key not in cached}
 
-    def relate_manifest_list(self, dc):
+    @staticmethod
+    def relate_tags(tag_type, field_name, tagged):
         """
-        Relate a ManifestList to a Tag.
+        Point saved Tags at the content they tag.
+
+        If an identical Tag already exists, or a concurrent sync creates it first, the
+        DeclarativeContent is updated to use it instead.
 
         Args:
-            dc (pulpcore.plugin.stages.DeclarativeContent): dc for a ManifestList
+            tag_type (type): Either ManifestTag or ManifestListTag.
+            field_name (str): Name of the field on `tag_type` that references tagged content.
+            tagged (list): List of (tag_dc, content) tuples.
         """
-        related_dc = dc.extra_data.get('relation')
-        assert type(related_dc.content) is ManifestListTag
-        assert related_dc.content.manifest_list is None
-        related_dc.content.manifest_list = dc.content
+        if not tagged:
+            return
+        attname = tag_type._meta.get_field(field_name).attname
+        query = reduce(operator.or_, (
+            Q(name=tag_dc.content.name, **{attname: content.pk}) for tag_dc, content in tagged
+        ))
+        existing_tags = {
+            (tag.name, getattr(tag, attname)): tag for tag in tag_type.objects.filter(query)
+        }
+        new_tags = []
+        for tag_dc, content in tagged:
+            assert getattr(tag_dc.content, attname) is None
+            existing_tag = existing_tags.get((tag_dc.content.name, content.pk))
+            if existing_tag:
+                tag_dc.content = existing_tag
+            else:
+                setattr(tag_dc.content, field_name, content)
+                new_tags.append((tag_dc, content))
         try:
-            related_dc.content.save()
+            with transaction.atomic():
+                bulk_update_relation(tag_type, field_name, {
+                    tag_dc.content.pk: content.pk for tag_dc, content in new_tags
+                })
         except IntegrityError:
-            existing_tag = ManifestListTag.objects.get(name=related_dc.content.name,
-                                                       manifest_list=dc.content)
-            related_dc.content = existing_tag
+            # A concurrent sync created some of the same Tags, fall back to one at a time.
+            for tag_dc, content in new_tags:
+                try:
+                    with transaction.atomic():
+                        tag_type.objects.filter(pk=tag_dc.content.pk).update(
+                            **{attname: content.pk})
+                except IntegrityError:
+                    tag_dc.content = tag_type.objects.get(
+                        name=tag_dc.content.name, **{attname: content.pk})
+
+
+def platform_fields(platform):
+    """
+    Convert the `platform` of a manifest in a ManifestList to ManifestListManifest fields.
+
+    Args:
+        platform (dict): The platform, e.g. {'architecture': 'arm64', 'os': 'linux',
+            'variant': 'v8'}.
+
+    Returns:
+        dict: The values of the platform fields of ManifestListManifest.
+
+    """
+    return {
+        'architecture': platform.get('architecture', ''),
+        'os': platform.get('os', ''),
+        'os_version': platform.get('os.version', ''),
+        'os_features': ','.join(platform.get('os.features', [])),
+        'features': ','.join(platform.get('features', [])),
+        'variant': platform.get('variant', ''),
+    }
+
+
+def bulk_relate(through_type, from_field, to_field, relations):
+    """
+    Create many-to-many relations, updating the other fields of the ones that already exist.
+
+    Args:
+        through_type (type): The model of the many-to-many table.
+        from_field (str): Name of the first foreign key on `through_type`.
+        to_field (str): Name of the second foreign key on `through_type`.
+        relations (set): Set of (from_pk, to_pk) tuples, or a dict mapping them to the values of
+            the other fields of each relation.
+    """
+    if not relations:
+        return
+    from_attname = through_type._meta.get_field(from_field).attname
+    to_attname = through_type._meta.get_field(to_field).attname
+    query = reduce(operator.or_, (
+        Q(**{from_attname: from_pk, to_attname: to_pk}) for from_pk, to_pk in relations
+    ))
+    values = relations if isinstance(relations, dict) else {}
+    field_names = sorted({name for fields in values.values() for name in fields})
+    existing = {}
+    for row in through_type.objects.filter(query).values(from_attname, to_attname, *field_names):
+        existing[(row.pop(from_attname), row.pop(to_attname))] = row
+
+    def update(from_pk, to_pk):
+        fields = values.get((from_pk, to_pk))
+        if fields:
+            through_type.objects.filter(**{from_attname: from_pk, to_attname: to_pk}).update(
+                **fields)
+
+    for (from_pk, to_pk), row in existing.items():
+        fields = values.get((from_pk, to_pk), {})
+        if any(row[name] != value for name, value in fields.items()):
+            # Relations created before their fields were recorded, or whose upstream values changed.
+            update(from_pk, to_pk)
+    new_relations = [
+        through_type(**{from_attname: from_pk, to_attname: to_pk},
+                     **values.get((from_pk, to_pk), {}))
+        for from_pk, to_pk in set(relations).difference(existing)
+    ]
+    try:
+        with transaction.atomic():
+            through_type.objects.bulk_create(new_relations)
+    except IntegrityError:
+        # A concurrent sync created some of the same relations, fall back to one at a time.
+        for relation in new_relations:
+            try:
+                with transaction.atomic():
+                    relation.save()
+            except IntegrityError:
+                update(getattr(relation, from_attname), getattr(relation, to_attname))
+
+
+def bulk_update_relation(model_type, field_name, values):
+    """
+    Set a foreign key on many rows with a single query.
+
+    Args:
+        model_type (type): The model to update.
+        field_name (str): Name of the foreign key to set.
+        values (dict): Maps primary keys of `model_type` to primary keys of the related rows.
+    """
+    if not values:
+        return
+    output_field = model_type._meta.get_field(field_name)
+    while output_field.is_relation:
+        output_field = output_field.target_field
+    related_pk = Case(
+        *(When(pk=pk, then=Value(value)) for pk, value in values.items()),
+        output_field=output_field
+    )
+    model_type.objects.filter(pk__in=list(values)).update(**{field_name: related_pk})
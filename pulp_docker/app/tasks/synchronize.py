@@ -1,18 +1,28 @@
 from gettext import gettext as _
+import asyncio
 import logging
 
-from pulpcore.plugin.models import Repository
-from pulpcore.plugin.stages import ArtifactDownloader, DeclarativeVersion, ArtifactSaver
+from pulpcore.plugin.models import Repository, RepositoryVersion
+from pulpcore.plugin.stages import (ContentUnitAssociation, ContentUnitUnassociation,
+                                    DeclarativeVersion, EndStage, RemoveDuplicates)
 
-from .sync_stages import InterrelateContent, ProcessContentStage, TagListStage
+from .sync_stages import (FeedbackStage, InterrelateContent, ProcessContentStage,
+                          TagListStage)
 from pulp_docker.app.models import DockerRemote, ManifestTag, ManifestListTag
-from pulp_docker.app.tasks.dedupe_save import SerialContentSave
+from pulp_docker.app.tasks.content_cache import ContentCache
+from pulp_docker.app.tasks.dedupe_save import BatchContentSave
+from pulp_docker.app.tasks.download_stages import (DockerArtifactDownloader,
+                                                   DockerArtifactSaver,
+                                                   DockerQueryExistingArtifacts)
+from pulp_docker.app.tasks.executor import BlockingExecutor, run_blocking
+from pulp_docker.app.tasks.instrumentation import (InstrumentedStage, QueryCounter,
+                                                   summarize)
 
 
 log = logging.getLogger(__name__)
 
 
-def synchronize(remote_pk, repository_pk):
+def synchronize(remote_pk, repository_pk, incremental=False):
     """
     Sync content from the remote repository.
 
@@ -21,6 +31,7 @@ def synchronize(remote_pk, repository_pk):
     Args:
         remote_pk (str): The remote PK.
         repository_pk (str): The repository PK.
+        incremental (bool): Skip downloading manifests of tags that are already known to Pulp.
 
     Raises:
         ValueError: If the remote does not specify a URL to sync
@@ -32,21 +43,147 @@ def synchronize(remote_pk, repository_pk):
         raise ValueError(_('A remote must have a url specified to synchronize.'))
     remove_duplicate_tags = [{'model': ManifestTag, 'field_names': ['name']},
                              {'model': ManifestListTag, 'field_names': ['name']}]
-    dv = DockerDeclarativeVersion(repository, remote, remove_duplicates=remove_duplicate_tags)
+    dv = DockerDeclarativeVersion(repository, remote, remove_duplicates=remove_duplicate_tags,
+                                  incremental=incremental)
     dv.create()
 
 
+def synchronize_tags(remote_pk, repository_pk, tag_names, digests=None):
+    """
+    Add tags and manifests that were pulled through a distribution to a repository.
+
+    Create a new version of the repository that contains the tags, the manifests pulled by
+    digest, and the content they reference. No other content is removed. Blobs are not
+    downloaded, they are saved when they are pulled.
+
+    Args:
+        remote_pk (str): The remote PK.
+        repository_pk (str): The repository PK.
+        tag_names (list): Names of the upstream tags to add.
+        digests (list): Digests of upstream manifests or manifest lists to add without a tag.
+
+    """
+    remote = DockerRemote.objects.get(pk=remote_pk)
+    repository = Repository.objects.get(pk=repository_pk)
+    remote.download_policy = DockerRemote.ON_DEMAND
+    remove_duplicate_tags = [{'model': ManifestTag, 'field_names': ['name']},
+                             {'model': ManifestListTag, 'field_names': ['name']}]
+    dv = DockerDeclarativeVersion(repository, remote, mirror=False,
+                                  remove_duplicates=remove_duplicate_tags, incremental=True,
+                                  tag_names=tag_names, digests=digests)
+    dv.create()
+
+
+async def run_pipeline(stages, maxsize=100):
+    """
+    Run the stages of a pipeline like create_pipeline, stopping all of them when one fails.
+
+    create_pipeline gathers the stages, so the other stages of a failed pipeline keep waiting on
+    their queues forever. That does not matter when the pipeline is the only work of the event
+    loop, but stalls the other syncs sharing the loop.
+
+    Args:
+        stages (list): List of :class:`~pulpcore.plugin.stages.Stage` instances.
+        maxsize (int): The maximum size of the queues between the stages.
+
+    Raises:
+        Exception: The error of the first stage that failed.
+
+    """
+    tasks = []
+    in_q = None
+    for stage in stages:
+        out_q = asyncio.Queue(maxsize=maxsize)
+        tasks.append(asyncio.ensure_future(stage(in_q, out_q)))
+        in_q = out_q
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Let the cancelled stages unwind, so they release what they hold before the next sync.
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 class DockerDeclarativeVersion(DeclarativeVersion):
     """
     Subclassed Declarative version creates a custom pipeline for Docker sync.
     """
 
-    def __init__(self, repository, remote, mirror=True, remove_duplicates=None):
-        """Initialize the class."""
+    def __init__(self, repository, remote, mirror=True, remove_duplicates=None,
+                 incremental=False, tag_names=None, cache=None, instrument=True,
+                 digests=None):
+        """
+        Initialize the class.
+
+        Args:
+            cache (ContentCache): The units and relations known to be saved, shared with other
+                syncs. A new cache is used by default.
+            instrument (bool): Measure the stages and report them as progress reports.
+            digests (list): Digests of manifests or manifest lists to sync without a tag.
+        """
         self.repository = repository
         self.remote = remote
         self.mirror = mirror
         self.remove_duplicates = remove_duplicates or []
+        self.incremental = incremental
+        self.tag_names = tag_names
+        self.digests = digests
+        self.cache = cache
+        self.instrument = instrument
+        self.instrumented_stages = []
+        self.executor = None
+
+    def create(self):
+        """
+        Perform the work, then report how long each stage was busy and waiting.
+
+        The last token auth challenge of the registry is saved on the remote once the work is
+        done, so the next sync requests its token up front.
+        """
+        queries = QueryCounter()
+        self.executor = BlockingExecutor(queries=queries)
+        try:
+            with queries.installed():
+                result = super().create()
+                loop = asyncio.get_event_loop()
+                loop.run_until_complete(
+                    run_blocking(self.executor, self.remote.remember_token_challenge))
+                return result
+        finally:
+            self.executor.shutdown()
+            summarize(self.instrumented_stages, queries)
+
+    async def create_in_loop(self):
+        """
+        Perform the work in the running event loop, so several syncs can run concurrently.
+
+        The caller provides the working directory and the executor.
+        """
+        with RepositoryVersion.create(self.repository) as new_version:
+            await run_pipeline(self.stages(new_version))
+        await run_blocking(self.executor, self.remote.remember_token_challenge)
+
+    def stages(self, new_version):
+        """
+        Build the whole pipeline that creates the new version, like DeclarativeVersion.create.
+
+        Args:
+            new_version (:class:`~pulpcore.plugin.models.RepositoryVersion`): The
+                new repository version that is going to be built.
+
+        Returns:
+            list: List of :class:`~pulpcore.plugin.stages.Stage` instances
+
+        """
+        stages = self.pipeline_stages(new_version)
+        stages.append(ContentUnitAssociation(new_version))
+        if self.mirror:
+            stages.append(ContentUnitUnassociation(new_version))
+        for dupe_query_dict in self.remove_duplicates:
+            stages.append(RemoveDuplicates(new_version, **dupe_query_dict))
+        stages.append(EndStage())
+        return stages
 
     def pipeline_stages(self, new_version):
         """
@@ -62,43 +199,36 @@ class DockerDeclarativeVersion(DeclarativeVersion):
             list: List of :class:`~pulpcore.plugin.stages.Stage` instances
 
         """
-        # We only want to create a single instance of each stage. Each call to the stage is
-        # encapsulated, so it isn't necessary to create a new instance.
-        downloader = ArtifactDownloader()
-        serial_artifact_save = ArtifactSaver()
-        serial_content_save = SerialContentSave()
-        process_content = ProcessContentStage(self.remote)
-        return [
-            TagListStage(self.remote),
-
-            # In: Pending Tags (not downloaded yet)
-            downloader,
-            serial_artifact_save,
-            process_content,
-            serial_content_save,
-            # Out: Finished Tags, Finished ManifestLists, Finished ImageManifests,
-            #      Pending ImageManifests, Pending ManifestBlobs
-
-
-            # In: Pending ImageManifests, Pending Blobs
-            # In: Finished content (no-op)
-            downloader,
-            serial_artifact_save,
-            process_content,
-            serial_content_save,
-            # Out: No-op (Finished Tags, ManifestLists, ImageManifests)
-            # Out: Finished ImageManifests, Finished ManifestBlobs, Pending ManifestBlobs
-
-            # In: Pending Blobs
-            # In: Finished content (no-op)
-            downloader,
-            serial_artifact_save,
-            serial_content_save,
-            # Out: Finished content, Tags, ManifestLists, ImageManifests, ManifestBlobs
-
-            # In: Tags, ManifestLists, ImageManifests, ManifestBlobs (downloaded, processed, and
-            #     saved)
+        feedback = FeedbackStage()
+        # Artifacts, units and relations seen by the stages, so each is only queried once.
+        cache = self.cache if self.cache is not None else ContentCache()
+        stages = [
+            TagListStage(self.remote, self.repository, incremental=self.incremental,
+                         tag_names=self.tag_names, feedback=feedback, digests=self.digests,
+                         executor=self.executor),
+            # Out: Pending Tags, Finished content (incremental only)
+
+            # In: Pending Tags, Finished content, and fed back Pending ImageManifests and
+            #     Pending ManifestBlobs
+            feedback,
+            # Blobs and listed ImageManifests have known digests, so Artifacts that are already
+            # in Pulp are attached here and never downloaded.
+            DockerQueryExistingArtifacts(cache, self.executor),
+            # Manifests and config blobs are downloaded first, then layers by size.
+            DockerArtifactDownloader(),
+            # Artifacts saved by a concurrent sync after they were looked up are reused.
+            DockerArtifactSaver(cache, self.executor),
+            # Nested content that still has to be downloaded is fed back to `feedback`.
+            ProcessContentStage(self.remote, feedback, self.executor),
+            BatchContentSave(cache, self.executor),
+            # Out: Finished Tags, ManifestLists, ImageManifests and ManifestBlobs.
+
             # Requires that all content (and related content in dc.extra_data) is already saved.
-            InterrelateContent(),
+            InterrelateContent(cache, self.executor),
             # Out: Content that has been related to other Content.
         ]
+        if not self.instrument:
+            return stages
+        self.instrumented_stages = [InstrumentedStage(stage, executor=self.executor)
+                                    for stage in stages]
+        return self.instrumented_stages
@@ -11,7 +11,6 @@ from drf_yasg.utils import swagger_auto_schema
 from pulpcore.plugin.serializers import (
     AsyncOperationResponseSerializer,
     RepositoryPublishURLSerializer,
-    RepositorySyncURLSerializer,
 )
 from pulpcore.plugin.tasking import enqueue_with_reservation
 from pulpcore.plugin.viewsets import (
@@ -20,7 +19,7 @@ from pulpcore.plugin.viewsets import (
     RemoteViewSet,
     OperationPostponedResponse,
     PublisherViewSet)
-from rest_framework.decorators import detail_route
+from rest_framework.decorators import detail_route, list_route
 from rest_framework import mixins
 
 from . import models, serializers, tasks
@@ -126,23 +125,85 @@ class DockerRemoteViewSet(RemoteViewSet):
         operation_description="Trigger an asynchronous task to sync content",
         responses={202: AsyncOperationResponseSerializer}
     )
-    @detail_route(methods=('post',), serializer_class=RepositorySyncURLSerializer)
+    @detail_route(methods=('post',), serializer_class=serializers.DockerSyncSerializer)
     def sync(self, request, pk):
         """
-        Synchronizes a repository. The ``repository`` field has to be provided.
+        Synchronizes a repository.
+
+        The ``repository`` field has to be provided, except for a dry run.
+
+        With ``dry_run``, only reports what the sync would download. The repository is not
+        changed, so only the remote is reserved. With ``shards``, the tags are synced by that many
+        tasks, and merged into one new version by a final task.
         """
         remote = self.get_object()
-        serializer = RepositorySyncURLSerializer(data=request.data, context={'request': request})
+        serializer = serializers.DockerSyncSerializer(
+            data=request.data,
+            context={'request': request}
+        )
 
         # Validate synchronously to return 400 errors.
         serializer.is_valid(raise_exception=True)
         repository = serializer.validated_data.get('repository')
+        if serializer.validated_data['dry_run']:
+            result = enqueue_with_reservation(
+                tasks.plan_synchronize,
+                [remote],
+                kwargs={
+                    'remote_pk': remote.pk,
+                }
+            )
+            return OperationPostponedResponse(result, request)
+        if serializer.validated_data['shards'] > 1:
+            result = enqueue_with_reservation(
+                tasks.synchronize_sharded,
+                [repository, remote],
+                kwargs={
+                    'remote_pk': remote.pk,
+                    'repository_pk': repository.pk,
+                    'shards': serializer.validated_data['shards'],
+                }
+            )
+            return OperationPostponedResponse(result, request)
         result = enqueue_with_reservation(
             tasks.synchronize,
             [repository, remote],
             kwargs={
                 'remote_pk': remote.pk,
-                'repository_pk': repository.pk
+                'repository_pk': repository.pk,
+                'incremental': serializer.validated_data['incremental'],
+            }
+        )
+        return OperationPostponedResponse(result, request)
+
+    @swagger_auto_schema(
+        operation_description="Trigger an asynchronous task to sync many repositories",
+        responses={202: AsyncOperationResponseSerializer}
+    )
+    @list_route(methods=('post',), serializer_class=serializers.DockerBatchSyncSerializer)
+    def batch_sync(self, request):
+        """
+        Synchronizes many repositories, each from its remote, in a single task.
+
+        Syncs from the same registry share their connections and tokens. A new version is
+        created for each repository.
+        """
+        serializer = serializers.DockerBatchSyncSerializer(
+            data=request.data,
+            context={'request': request}
+        )
+
+        # Validate synchronously to return 400 errors.
+        serializer.is_valid(raise_exception=True)
+        syncs = serializer.validated_data['syncs']
+        resources = [sync['repository'] for sync in syncs]
+        resources.extend({sync['remote'].pk: sync['remote'] for sync in syncs}.values())
+        result = enqueue_with_reservation(
+            tasks.synchronize_batch,
+            resources,
+            kwargs={
+                'syncs': [(sync['remote'].pk, sync['repository'].pk) for sync in syncs],
+                'incremental': serializer.validated_data['incremental'],
             }
         )
         return OperationPostponedResponse(result, request)
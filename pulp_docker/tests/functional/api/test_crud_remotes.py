@@ -127,5 +127,9 @@ def _gen_verbose_remote():
         'password': utils.uuid4(),
         'username': utils.uuid4(),
         'validate': choice((False, True)),
+        'include_tags': choice(('latest', '1.*,latest')),
+        'exclude_tags': choice(('*-musl', '*-glibc,*-uclibc')),
+        'platforms': choice(('linux/amd64', 'linux/amd64,linux/arm64/v8')),
+        'download_policy': choice(('immediate', 'on_demand')),
     })
     return attrs
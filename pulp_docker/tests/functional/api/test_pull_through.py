@@ -0,0 +1,108 @@
+# coding=utf-8
+"""Tests that pull content through a docker distribution with a remote."""
+import hashlib
+import time
+import unittest
+from urllib.parse import urljoin
+
+from pulp_smash import api, config, utils
+from pulp_smash.pulp3.constants import REPO_PATH
+from pulp_smash.pulp3.utils import gen_repo
+
+from pulp_docker.tests.functional.constants import (
+    DOCKER_DISTRIBUTION_PATH,
+    DOCKER_PUBLISHER_PATH,
+    DOCKER_REMOTE_PATH,
+)
+from pulp_docker.tests.functional.fake_registry import MANIFEST_V2, FakeRegistry
+from pulp_docker.tests.functional.utils import gen_docker_publisher, gen_docker_remote
+from pulp_docker.tests.functional.utils import set_up_module as setUpModule  # noqa:F401
+
+
+class PullThroughTestCase(unittest.TestCase):
+    """Pull content through a distribution backed by a stand-in registry."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Create class-wide variables, and start the stand-in registry."""
+        cls.cfg = config.get_config()
+        cls.client = api.Client(cls.cfg, api.json_handler)
+        cls.registry = FakeRegistry(tags=1, layers=2)
+        cls.registry.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Stop the stand-in registry."""
+        cls.registry.stop()
+
+    def test_pull_through(self):
+        """Pull a tag that the distribution does not serve yet.
+
+        Do the following:
+
+        1. Create a repository, a remote pointing at the stand-in registry, and
+           a distribution with both.
+        2. Pull the manifest of a tag and its blobs from the distribution, and
+           assert they are identical to the upstream ones.
+        3. Wait for the tag to be added to the repository.
+        4. Pull the tag again, and assert that the stand-in registry did not
+           serve any of it again.
+        """
+        repo = self.client.post(REPO_PATH, gen_repo())
+        self.addCleanup(self.client.delete, repo['_href'])
+
+        remote = self.client.post(DOCKER_REMOTE_PATH, gen_docker_remote(
+            url=self.registry.url, upstream_name=self.registry.name))
+        self.addCleanup(self.client.delete, remote['_href'])
+
+        publisher = self.client.post(DOCKER_PUBLISHER_PATH, gen_docker_publisher())
+        self.addCleanup(self.client.delete, publisher['_href'])
+
+        base_path = utils.uuid4()
+        distribution = self.client.post(DOCKER_DISTRIBUTION_PATH, {
+            'name': utils.uuid4(),
+            'base_path': base_path,
+            'remote': remote['_href'],
+            'repository': repo['_href'],
+            'publisher': publisher['_href'],
+        })
+        self.addCleanup(self.client.delete, distribution['_href'])
+
+        scheme = self.cfg.get_hosts('api')[0].roles['api']['scheme']
+        host = distribution['registry_path'][:-len(base_path)]
+        registry_url = urljoin('{scheme}://{host}'.format(scheme=scheme, host=host),
+                               'v2/{base_path}/'.format(base_path=base_path))
+        tag = next(iter(self.registry.tags))
+
+        self.pull(registry_url, tag)
+        upstream_requests = dict(self.registry.requests)
+
+        self.wait_for_tag(repo, tag)
+        self.pull(registry_url, tag)
+        self.assertEqual(self.registry.requests['blobs'], upstream_requests['blobs'])
+
+    def pull(self, registry_url, tag):
+        """Pull a tag and its blobs, and compare them to the upstream ones."""
+        client = api.Client(self.cfg, api.safe_handler)
+        response = client.get(urljoin(registry_url, 'manifests/{tag}'.format(tag=tag)),
+                              headers={'Accept': MANIFEST_V2})
+        digest = self.registry.tags[tag]['digest']
+        self.assertEqual(response.headers['Docker-Content-Digest'], digest)
+        self.assertEqual(response.content, self.registry.manifests[digest][1])
+        for blob_digest in self.registry.image_blobs(tag):
+            response = client.get(urljoin(registry_url, 'blobs/{digest}'.format(
+                digest=blob_digest)))
+            self.assertEqual('sha256:' + hashlib.sha256(response.content).hexdigest(),
+                             blob_digest)
+
+    def wait_for_tag(self, repo, tag, timeout=60):
+        """Wait until the latest version of a repository has a tag."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            repo = self.client.get(repo['_href'])
+            if repo['_latest_version_href']:
+                content = self.client.get(urljoin(repo['_latest_version_href'], 'content/'))
+                if any(unit.get('name') == tag for unit in content['results']):
+                    return
+            time.sleep(1)
+        self.fail('Tag {tag} was not added to the repository.'.format(tag=tag))
@@ -3,6 +3,7 @@ from urllib.parse import urljoin
 
 from pulp_smash.constants import PULP_FIXTURES_BASE_URL
 from pulp_smash.pulp3.constants import (
+    BASE_PATH,
     BASE_PUBLISHER_PATH,
     BASE_REMOTE_PATH,
     CONTENT_PATH
@@ -18,6 +19,8 @@ DOCKER_REMOTE_PATH = urljoin(BASE_REMOTE_PATH, 'docker/')
 
 DOCKER_PUBLISHER_PATH = urljoin(BASE_PUBLISHER_PATH, 'docker/')
 
+DOCKER_DISTRIBUTION_PATH = urljoin(BASE_PATH, 'docker-distributions/')
+
 
 # FIXME: replace this with your own fixture repository URL and metadata
 DOCKER_FIXTURE_URL = urljoin(PULP_FIXTURES_BASE_URL, 'docker/')
@@ -0,0 +1,235 @@
+# coding=utf-8
+"""A stand-in Docker registry serving generated images, for tests that must not use the network."""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from aiohttp import web
+
+
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST_LIST = 'application/vnd.docker.distribution.manifest.list.v2+json'
+CONFIG_BLOB = 'application/vnd.docker.container.image.v1+json'
+LAYER_BLOB = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+
+PLATFORMS = (
+    {'architecture': 'amd64', 'os': 'linux'},
+    {'architecture': 'arm64', 'os': 'linux', 'variant': 'v8'},
+)
+
+
+def gen_platforms(count):
+    """Return ``count`` distinct platforms, starting with :data:`PLATFORMS`."""
+    return list(PLATFORMS[:count]) + [
+        {'architecture': 'arch{number}'.format(number=number), 'os': 'linux'}
+        for number in range(len(PLATFORMS), count)
+    ]
+
+
+class FakeRegistry:
+    """A Docker v2 registry serving generated images from memory.
+
+    Every tag has its own image. The first layers of every image are shared,
+    like a common base image. The registry supports paginated tags lists,
+    manifest lists and range requests, and counts the requests and bytes it
+    serves.
+
+    :param name: The name of the repository served.
+    :param tags: The number of tags.
+    :param layers: The number of layers of each image.
+    :param layer_size: The size of each layer in bytes.
+    :param manifest_lists: Whether tags reference manifest lists of one image
+        per platform instead of a single image.
+    :param platforms: The number of images in each manifest list. Defaults to
+        the number of :data:`PLATFORMS`.
+    :param share_ratio: The fraction of the layers of each image that all
+        images share. By default only the first layer is shared.
+    :param host: The host name the registry is reachable at, e.g. by Pulp.
+    """
+
+    def __init__(self, name='pulp/fake', tags=3, layers=2, layer_size=1024,
+                 manifest_lists=False, platforms=len(PLATFORMS), share_ratio=None,
+                 host=None):
+        """Generate the content of the registry."""
+        self.name = name
+        self.host = host or os.environ.get('PULP_DOCKER_FAKE_REGISTRY_HOST', 'localhost')
+        self.blobs = {}
+        self.manifests = {}
+        self.tags = OrderedDict()
+        self.requests = Counter()
+        self.bytes_served = 0
+        self.url = None
+        self._runner = None
+        self._loop = None
+        self._thread = None
+
+        self.platforms = gen_platforms(platforms)
+        shared = 1 if share_ratio is None else round(layers * share_ratio)
+        base_layers = [
+            self._add_blob(os.urandom(layer_size), LAYER_BLOB)
+            for i in range(min(shared, layers))
+        ]
+        for tag_number in range(tags):
+            tag = 'tag-{number}'.format(number=tag_number)
+            if manifest_lists:
+                self.tags[tag] = self._add_manifest_list(
+                    base_layers, layers, layer_size)
+            else:
+                self.tags[tag] = self._add_image(base_layers, layers, layer_size)
+
+    def _add_blob(self, data, media_type):
+        digest = 'sha256:' + hashlib.sha256(data).hexdigest()
+        self.blobs[digest] = data
+        return {'mediaType': media_type, 'size': len(data), 'digest': digest}
+
+    def _add_manifest(self, manifest):
+        body = json.dumps(manifest, indent=3).encode()
+        digest = 'sha256:' + hashlib.sha256(body).hexdigest()
+        self.manifests[digest] = (manifest['mediaType'], body)
+        return {'mediaType': manifest['mediaType'], 'size': len(body), 'digest': digest}
+
+    def _add_image(self, base_layers, layers, layer_size, platform=None):
+        layer_descriptors = base_layers + [
+            self._add_blob(os.urandom(layer_size), LAYER_BLOB)
+            for i in range(layers - len(base_layers))
+        ]
+        config = dict(platform or self.platforms[0])
+        config['rootfs'] = {
+            'type': 'layers',
+            'diff_ids': [layer['digest'] for layer in layer_descriptors],
+        }
+        return self._add_manifest({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_V2,
+            'config': self._add_blob(json.dumps(config).encode(), CONFIG_BLOB),
+            'layers': layer_descriptors,
+        })
+
+    def _add_manifest_list(self, base_layers, layers, layer_size):
+        manifests = []
+        for platform in self.platforms:
+            descriptor = self._add_image(base_layers, layers, layer_size, platform)
+            descriptor['platform'] = platform
+            manifests.append(descriptor)
+        return self._add_manifest({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_LIST,
+            'manifests': manifests,
+        })
+
+    def image_blobs(self, tag):
+        """Return the digests of all blobs referenced by a tag."""
+        digests = []
+        media_type, body = self.manifests[self.tags[tag]['digest']]
+        manifest = json.loads(body.decode())
+        if media_type == MANIFEST_LIST:
+            for listed in manifest['manifests']:
+                media_type, body = self.manifests[listed['digest']]
+                image = json.loads(body.decode())
+                digests.append(image['config']['digest'])
+                digests.extend(layer['digest'] for layer in image['layers'])
+        else:
+            digests.append(manifest['config']['digest'])
+            digests.extend(layer['digest'] for layer in manifest['layers'])
+        return digests
+
+    def make_app(self):
+        """Return the aiohttp application of the registry."""
+        app = web.Application()
+        app.add_routes([
+            web.get('/v2/', self.serve_v2),
+            web.get(r'/v2/{name:.+}/tags/list', self.tags_list),
+            web.route('*', r'/v2/{name:.+}/manifests/{reference}', self.get_manifest),
+            web.route('*', r'/v2/{name:.+}/blobs/{digest}', self.get_blob),
+        ])
+        return app
+
+    async def serve_v2(self, request):
+        """Announce the v2 API."""
+        self.requests['v2'] += 1
+        return web.json_response({})
+
+    def _check_name(self, request):
+        if request.match_info['name'] != self.name:
+            raise web.HTTPNotFound()
+
+    async def tags_list(self, request):
+        """Serve a page of the tags list."""
+        self._check_name(request)
+        self.requests['tags_list'] += 1
+        names = list(self.tags)
+        last = request.query.get('last')
+        start = names.index(last) + 1 if last in self.tags else 0
+        page_size = int(request.query.get('n', len(names) or 1))
+        page = names[start:start + page_size]
+        headers = {}
+        if start + page_size < len(names):
+            headers['Link'] = '</v2/{name}/tags/list?n={n}&last={last}>; rel="next"'.format(
+                name=self.name, n=page_size, last=page[-1])
+        return web.json_response({'name': self.name, 'tags': page}, headers=headers)
+
+    async def get_manifest(self, request):
+        """Serve a manifest by tag or digest."""
+        self._check_name(request)
+        self.requests['manifests'] += 1
+        reference = request.match_info['reference']
+        digest = self.tags[reference]['digest'] if reference in self.tags else reference
+        if digest not in self.manifests:
+            raise web.HTTPNotFound()
+        media_type, body = self.manifests[digest]
+        if media_type not in request.headers.get('Accept', media_type):
+            raise web.HTTPNotFound()
+        headers = {'Content-Type': media_type, 'Docker-Content-Digest': digest}
+        if request.method == 'HEAD':
+            headers['Content-Length'] = str(len(body))
+            return web.Response(headers=headers)
+        self.bytes_served += len(body)
+        return web.Response(body=body, headers=headers)
+
+    async def get_blob(self, request):
+        """Serve a blob, or a range of it."""
+        self._check_name(request)
+        self.requests['blobs'] += 1
+        data = self.blobs.get(request.match_info['digest'])
+        if data is None:
+            raise web.HTTPNotFound()
+        headers = {'Content-Type': 'application/octet-stream'}
+        status = 200
+        if request.http_range.start is not None or request.http_range.stop is not None:
+            start, stop, _ = request.http_range.indices(len(data))
+            headers['Content-Range'] = 'bytes {first}-{last}/{size}'.format(
+                first=start, last=stop - 1, size=len(data))
+            data = data[start:stop]
+            status = 206
+        if request.method == 'HEAD':
+            headers['Content-Length'] = str(len(data))
+            return web.Response(status=status, headers=headers)
+        self.bytes_served += len(data)
+        return web.Response(body=data, status=status, headers=headers)
+
+    def start(self, port=0):
+        """Serve the registry from a background thread.
+
+        :param port: The port to listen on. A free port is picked by default.
+        :returns: The url of the registry.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._runner = web.AppRunner(self.make_app())
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, '0.0.0.0', port)
+        self._loop.run_until_complete(site.start())
+        port = self._runner.addresses[0][1]
+        self.url = 'http://{host}:{port}'.format(host=self.host, port=port)
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        """Stop serving the registry."""
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
@@ -0,0 +1,2 @@
+# coding=utf-8
+"""Benchmarks of docker plugin syncs against a stand-in registry."""
@@ -0,0 +1,178 @@
+# coding=utf-8
+"""Benchmark syncs from a stand-in registry of configurable size.
+
+Every scenario syncs a new repository from a :class:`FakeRegistry` twice: once
+from scratch, and once more when nothing changed upstream. For every sync the
+wall time, the number of database queries, the peak memory usage of the worker
+and the bytes downloaded from the registry are recorded, along with the
+counters of every stage of the sync pipeline.
+
+The results are written as JSON to the file named by the
+``PULP_DOCKER_BENCHMARK_REPORT`` environment variable, or
+``pulp_docker_benchmark.json`` in the working directory. A subset of the
+scenarios can be selected with a comma separated list of names in
+``PULP_DOCKER_BENCHMARK_SCENARIOS``. The registry must be reachable by the Pulp
+workers, see :class:`FakeRegistry`. Run the benchmarks with::
+
+    pytest --pyargs pulp_docker.tests.performance
+"""
+import json
+import os
+import subprocess
+import unittest
+from datetime import datetime
+
+from pulp_smash import api, config
+from pulp_smash.pulp3.constants import REPO_PATH
+from pulp_smash.pulp3.utils import gen_repo, sync
+
+from pulp_docker.tests.functional.constants import DOCKER_REMOTE_PATH
+from pulp_docker.tests.functional.fake_registry import FakeRegistry
+from pulp_docker.tests.functional.utils import gen_docker_remote
+from pulp_docker.tests.functional.utils import set_up_module as setUpModule  # noqa:F401
+
+
+SCENARIOS = {
+    'small': {
+        'registry': {'tags': 5, 'layers': 3, 'layer_size': 64 * 1024},
+    },
+    'shared-layers': {
+        'registry': {'tags': 50, 'layers': 8, 'layer_size': 64 * 1024, 'share_ratio': 0.75},
+    },
+    'manifest-lists': {
+        'registry': {'tags': 20, 'layers': 4, 'layer_size': 64 * 1024,
+                     'manifest_lists': True, 'platforms': 4, 'share_ratio': 0.5},
+    },
+    'large-layers': {
+        'registry': {'tags': 1, 'layers': 2, 'layer_size': 72 * 1024 * 1024,
+                     'share_ratio': 0},
+    },
+    'on-demand': {
+        'registry': {'tags': 50, 'layers': 8, 'layer_size': 64 * 1024, 'share_ratio': 0.75},
+        'remote': {'download_policy': 'on_demand'},
+    },
+}
+"""The benchmarked scenarios.
+
+``registry`` holds the arguments of :class:`FakeRegistry`, and ``remote`` any
+additional fields of the remote synced from it.
+"""
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def selected_scenarios():
+    """Return the names of the scenarios to run."""
+    names = os.environ.get('PULP_DOCKER_BENCHMARK_SCENARIOS')
+    if not names:
+        return list(SCENARIOS)
+    return [name.strip() for name in names.split(',') if name.strip()]
+
+
+def current_commit():
+    """Return the commit of the benchmarked code, or None if it is unknown."""
+    commit = os.environ.get('PULP_DOCKER_BENCHMARK_COMMIT')
+    if commit:
+        return commit
+    process = subprocess.run(
+        ['git', 'rev-parse', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    return process.stdout.strip() if process.returncode == 0 else None
+
+
+def pipeline_summary(task):
+    """Return the summary that a sync task saves as its last progress report.
+
+    :param task: A dict of information about a finished sync task.
+    :returns: The summary, or an empty dict if the task has none.
+    """
+    for report in reversed(task['progress_reports']):
+        message = report['message']
+        if '{"stages"' in message:
+            return json.loads(message[message.index('{'):])
+    return {}
+
+
+def wall_time(task):
+    """Return the number of seconds a task ran for.
+
+    :param task: A dict of information about a finished task.
+    """
+    started = datetime.strptime(task['started_at'], TIMESTAMP_FORMAT)
+    finished = datetime.strptime(task['finished_at'], TIMESTAMP_FORMAT)
+    return (finished - started).total_seconds()
+
+
+class SyncBenchmarkTestCase(unittest.TestCase):
+    """Measure syncs from a stand-in registry."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Create class-wide variables."""
+        cls.cfg = config.get_config()
+        cls.client = api.Client(cls.cfg, api.json_handler)
+        cls.results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        """Write the report of all scenarios that ran."""
+        path = os.environ.get('PULP_DOCKER_BENCHMARK_REPORT', 'pulp_docker_benchmark.json')
+        report = {
+            'commit': current_commit(),
+            'created': datetime.utcnow().strftime(TIMESTAMP_FORMAT),
+            'results': cls.results,
+        }
+        with open(path, 'w') as report_file:
+            json.dump(report, report_file, indent=2, sort_keys=True)
+
+    def test_scenarios(self):
+        """Sync every selected scenario from scratch, then once more."""
+        for name in selected_scenarios():
+            with self.subTest(scenario=name):
+                self.run_scenario(name, **SCENARIOS[name])
+
+    def run_scenario(self, name, registry, remote=None):
+        """Sync a repository from a new stand-in registry twice.
+
+        :param name: The name of the scenario.
+        :param registry: The arguments of :class:`FakeRegistry`.
+        :param remote: Additional fields of the remote.
+        """
+        fake_registry = FakeRegistry(**registry)
+        fake_registry.start()
+        self.addCleanup(fake_registry.stop)
+
+        repo = self.client.post(REPO_PATH, gen_repo())
+        self.addCleanup(self.client.delete, repo['_href'])
+
+        remote = self.client.post(DOCKER_REMOTE_PATH, gen_docker_remote(
+            url=fake_registry.url, upstream_name=fake_registry.name, **(remote or {})))
+        self.addCleanup(self.client.delete, remote['_href'])
+
+        for run in ('initial', 'resync'):
+            requests = dict(fake_registry.requests)
+            bytes_served = fake_registry.bytes_served
+            call_report = sync(self.cfg, remote, repo)
+            task = self.client.get(call_report['task'])
+            self.assertEqual(task['state'], 'completed', task)
+            summary = pipeline_summary(task)
+            self.results.append({
+                'scenario': name,
+                'run': run,
+                'registry': registry,
+                'remote': {key: remote[key] for key in ('download_policy', 'platforms')},
+                'wall_time': wall_time(task),
+                'queries': summary.get('queries'),
+                'process_max_rss': summary.get('process_max_rss'),
+                'bytes_downloaded': fake_registry.bytes_served - bytes_served,
+                'requests': {
+                    kind: count - requests.get(kind, 0)
+                    for kind, count in fake_registry.requests.items()
+                },
+                'stages': summary.get('stages', []),
+                'task': task['_href'],
+            })
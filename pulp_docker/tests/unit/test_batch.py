@@ -0,0 +1,31 @@
+from django.test import TestCase
+
+from pulp_docker.app.models import DockerRemote
+from pulp_docker.app.tasks.batch import SharedDownloads, connection_key
+
+
+class TestSharedDownloads(TestCase):
+    """Test sharing the downloads of the remotes of a batch sync."""
+
+    def test_connection_key(self):
+        """Remotes of the same registry with the same settings have the same key."""
+        first = DockerRemote(url='https://registry.example.com', upstream_name='first')
+        second = DockerRemote(url='https://registry.example.com/', upstream_name='second')
+        other = DockerRemote(url='https://other.example.com', upstream_name='first')
+        self.assertEqual(connection_key(first), connection_key(second))
+        self.assertNotEqual(connection_key(first), connection_key(other))
+
+    def test_attach(self):
+        """Remotes of the same registry share a limiter, all limiters share the global limit."""
+        downloads = SharedDownloads(max_downloads=5)
+        first = DockerRemote(url='https://registry.example.com', upstream_name='first')
+        second = DockerRemote(url='https://registry.example.com', upstream_name='second')
+        other = DockerRemote(url='https://other.example.com', upstream_name='first')
+        for remote in (first, second, other):
+            downloads.attach(remote)
+        self.assertIs(second.download_limiter, first.download_limiter)
+        self.assertIsNot(other.download_limiter, first.download_limiter)
+        self.assertIs(first.download_limiter.parent, downloads.semaphore)
+        self.assertIs(other.download_limiter.parent, downloads.semaphore)
+        self.assertIs(second.token_cache._tokens, first.token_cache._tokens)
+        self.assertIsNot(second.token_cache, first.token_cache)
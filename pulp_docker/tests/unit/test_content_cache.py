@@ -0,0 +1,27 @@
+from django.test import TestCase
+
+from pulp_docker.app.models import ManifestBlob, ImageManifest
+from pulp_docker.app.tasks.content_cache import ContentCache
+
+
+class TestContentCache(TestCase):
+    """Test remembering the units saved during a sync."""
+
+    def test_get_many(self):
+        """Only cached keys of the same model are found."""
+        cache = ContentCache(max_size=10)
+        cache.add_many(ManifestBlob, {('sha256:1',): 'blob'})
+        self.assertEqual(cache.get_many(ManifestBlob, [('sha256:1',), ('sha256:2',)]),
+                         {('sha256:1',): 'blob'})
+        self.assertEqual(cache.get_many(ImageManifest, [('sha256:1',)]), {})
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_least_recently_used(self):
+        """The least recently used entries are forgotten beyond the size limit."""
+        cache = ContentCache(max_size=2)
+        cache.add_many(ManifestBlob, {('a',): 1, ('b',): 2})
+        cache.get_many(ManifestBlob, [('a',)])
+        cache.add_many(ManifestBlob, {('c',): 3})
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_many(ManifestBlob, [('a',), ('b',), ('c',)]),
+                         {('a',): 1, ('c',): 3})
@@ -0,0 +1,162 @@
+import hashlib
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import IntegrityError
+from django.test import TestCase
+from pulpcore.plugin.models import Artifact, ContentArtifact, RemoteArtifact
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent
+
+from pulp_docker.app.models import DockerRemote, MEDIA_TYPE, ManifestBlob
+from pulp_docker.app.tasks.content_cache import ContentCache
+from pulp_docker.app.tasks.dedupe_save import BatchContentSave, MAX_BATCH_ATTEMPTS
+
+
+BLOB = b'blob'
+DIGEST = 'sha256:' + hashlib.sha256(BLOB).hexdigest()
+
+
+def create_artifact(data=BLOB):
+    """Save an Artifact with the given content."""
+    digests = {name: getattr(hashlib, name)(data).hexdigest()
+               for name in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')}
+    return Artifact.objects.create(file=SimpleUploadedFile('blob', data), size=len(data),
+                                   **digests)
+
+
+def blob_dc(remote, artifact=None):
+    """Create a pending ManifestBlob, downloaded on demand unless a saved Artifact is given."""
+    da = DeclarativeArtifact(
+        artifact=artifact or Artifact(sha256=DIGEST[len('sha256:'):], size=len(BLOB)),
+        url='{url}/v2/{name}/blobs/{digest}'.format(url=remote.url, name=remote.upstream_name,
+                                                    digest=DIGEST),
+        relative_path=DIGEST,
+        remote=remote,
+        extra_data={'deferred': artifact is None},
+    )
+    blob = ManifestBlob(digest=DIGEST, media_type=MEDIA_TYPE.REGULAR_BLOB)
+    return DeclarativeContent(content=blob, d_artifacts=[da])
+
+
+class TestBatchContentSaveSharedCache(TestCase):
+    """Test saving Content with a cache shared by the syncs of several remotes."""
+
+    def setUp(self):
+        """Create two remotes of the same registry."""
+        self.first = DockerRemote.objects.create(
+            name='first', url='https://registry.example.com', upstream_name='first')
+        self.second = DockerRemote.objects.create(
+            name='second', url='https://registry.example.com', upstream_name='second')
+        self.cache = ContentCache()
+
+    def test_shared_blob(self):
+        """A blob cached by the sync of one remote gets a RemoteArtifact for the other."""
+        first_dc = blob_dc(self.first)
+        BatchContentSave(self.cache).save_and_dedupe_content([first_dc])
+        second_dc = blob_dc(self.second)
+        BatchContentSave(self.cache).save_and_dedupe_content([second_dc])
+
+        self.assertEqual(second_dc.content, first_dc.content)
+        self.assertEqual(ContentArtifact.objects.filter(content=first_dc.content).count(), 1)
+        remotes = RemoteArtifact.objects.filter(
+            content_artifact__content=first_dc.content).values_list('remote_id', flat=True)
+        self.assertEqual(sorted(remotes), sorted([self.first.pk, self.second.pk]))
+
+    def test_downloaded_after_on_demand(self):
+        """A blob cached by an on_demand sync gets the Artifact an immediate sync downloaded."""
+        on_demand_dc = blob_dc(self.first)
+        BatchContentSave(self.cache).save_and_dedupe_content([on_demand_dc])
+        self.assertIsNone(ContentArtifact.objects.get(content=on_demand_dc.content).artifact)
+
+        artifact = create_artifact()
+        BatchContentSave(self.cache).save_and_dedupe_content([blob_dc(self.second, artifact)])
+        self.assertEqual(ContentArtifact.objects.get(content=on_demand_dc.content).artifact,
+                         artifact)
+
+
+class RacingContentSave(BatchContentSave):
+    """Miss the existing units at first, as if a concurrent sync saved them after the lookup."""
+
+    def __init__(self, misses, **kwargs):
+        """Miss the existing units in the given number of lookups."""
+        super().__init__(**kwargs)
+        self.misses = misses
+
+    def query_existing(self, model_type, keys):
+        """Find nothing while there are misses left."""
+        if self.misses:
+            self.misses -= 1
+            return {}
+        return super().query_existing(model_type, keys)
+
+
+class TestBatchContentSave(TestCase):
+    """Test saving Content in batches."""
+
+    def setUp(self):
+        """Create a remote."""
+        self.remote = DockerRemote.objects.create(
+            name='test', url='https://registry.example.com', upstream_name='busybox')
+
+    def test_dedupe(self):
+        """Duplicates within a batch are saved once, with one ContentArtifact."""
+        dcs = [blob_dc(self.remote), blob_dc(self.remote)]
+        BatchContentSave().save_and_dedupe_content(dcs)
+        self.assertIsNotNone(dcs[0].content.pk)
+        self.assertIs(dcs[1].content, dcs[0].content)
+        self.assertEqual(ManifestBlob.objects.filter(digest=DIGEST).count(), 1)
+        content_artifact = ContentArtifact.objects.get(content=dcs[0].content)
+        self.assertEqual(content_artifact.relative_path, DIGEST)
+        self.assertIsNone(content_artifact.artifact)
+        self.assertEqual(RemoteArtifact.objects.get(content_artifact=content_artifact).remote_id,
+                         self.remote.pk)
+
+    def test_existing(self):
+        """Units that are already saved are used instead of new ones."""
+        existing = ManifestBlob.objects.create(digest=DIGEST, media_type=MEDIA_TYPE.REGULAR_BLOB)
+        dc = blob_dc(self.remote)
+        BatchContentSave().save_and_dedupe_content([dc])
+        self.assertEqual(dc.content.pk, existing.pk)
+        self.assertEqual(ManifestBlob.objects.filter(digest=DIGEST).count(), 1)
+        self.assertEqual(ContentArtifact.objects.filter(content=existing).count(), 1)
+
+    def test_cache(self):
+        """Saved units are cached, and found in the cache by later batches."""
+        cache = ContentCache()
+        first_dc = blob_dc(self.remote)
+        BatchContentSave(cache).save_and_dedupe_content([first_dc])
+        key = (DIGEST,)
+        self.assertEqual(cache.get_many(ManifestBlob, [key]), {key: first_dc.content})
+
+        second_dc = blob_dc(self.remote)
+        BatchContentSave(cache).save_and_dedupe_content([second_dc])
+        self.assertIs(second_dc.content, first_dc.content)
+        self.assertEqual(cache.hits, 2)
+
+    def test_retry(self):
+        """A batch conflicting with a concurrent save is retried with the existing units."""
+        existing = ManifestBlob.objects.create(digest=DIGEST, media_type=MEDIA_TYPE.REGULAR_BLOB)
+        cache = ContentCache()
+        dc = blob_dc(self.remote)
+        RacingContentSave(misses=1, cache=cache).save_and_dedupe_content([dc])
+        self.assertEqual(dc.content.pk, existing.pk)
+        self.assertEqual(ManifestBlob.objects.filter(digest=DIGEST).count(), 1)
+        self.assertEqual(ContentArtifact.objects.filter(content=existing).count(), 1)
+        self.assertEqual(cache.get_many(ManifestBlob, [(DIGEST,)]), {(DIGEST,): dc.content})
+
+    def test_retries_exhausted(self):
+        """The conflict is raised when every attempt misses the existing units."""
+        ManifestBlob.objects.create(digest=DIGEST, media_type=MEDIA_TYPE.REGULAR_BLOB)
+        cache = ContentCache()
+        dc = blob_dc(self.remote)
+        with self.assertRaises(IntegrityError):
+            RacingContentSave(misses=MAX_BATCH_ATTEMPTS, cache=cache).save_and_dedupe_content(
+                [dc])
+        self.assertEqual(len(cache), 0)
+
+    def test_downloaded_artifact(self):
+        """An existing ContentArtifact without an Artifact gets the downloaded one."""
+        existing = ManifestBlob.objects.create(digest=DIGEST, media_type=MEDIA_TYPE.REGULAR_BLOB)
+        ContentArtifact.objects.create(content=existing, relative_path=DIGEST)
+        artifact = create_artifact()
+        BatchContentSave().save_and_dedupe_content([blob_dc(self.remote, artifact)])
+        self.assertEqual(ContentArtifact.objects.get(content=existing).artifact, artifact)
@@ -0,0 +1,103 @@
+import hashlib
+import heapq
+import os
+import tempfile
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from pulpcore.plugin.models import Artifact
+from pulpcore.plugin.stages import DeclarativeArtifact, DeclarativeContent
+
+from pulp_docker.app.models import ImageManifest, ManifestBlob, ManifestTag
+from pulp_docker.app.tasks.content_cache import ContentCache
+from pulp_docker.app.tasks.download_stages import (DockerArtifactDownloader,
+                                                   DockerArtifactSaver,
+                                                   DockerQueryExistingArtifacts)
+
+
+def pending(content, size=None, **extra_data):
+    """Return a unit with a single Artifact that still has to be downloaded."""
+    da = DeclarativeArtifact(
+        artifact=Artifact(size=size),
+        url='https://registry.example.com/v2/',
+        relative_path='artifact',
+        remote=None,
+        extra_data={},
+    )
+    return DeclarativeContent(content=content, d_artifacts=[da], extra_data=extra_data)
+
+
+def artifact_attributes(data):
+    """Return the size and digests of an Artifact with the given content."""
+    attributes = {name: getattr(hashlib, name)(data).hexdigest()
+                  for name in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')}
+    attributes['size'] = len(data)
+    return attributes
+
+
+def downloaded_file(data):
+    """Write data to a temporary file, like a downloader does."""
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as downloaded:
+        downloaded.write(data)
+    return path
+
+
+class TestDockerArtifactDownloader(TestCase):
+    """Test the order in which Artifacts are downloaded."""
+
+    def test_schedule(self):
+        """Manifests come first, then config blobs, then layers by size in their lanes."""
+        stage = DockerArtifactDownloader(max_large_downloads=1, large_layer_size=1000)
+        large = pending(ManifestBlob(digest='sha256:large'), size=5000)
+        unknown = pending(ManifestBlob(digest='sha256:unknown'))
+        layer = pending(ManifestBlob(digest='sha256:layer'), size=500)
+        small = pending(ManifestBlob(digest='sha256:small'), size=10)
+        config = pending(ManifestBlob(digest='sha256:config'), size=900,
+                         config_relation=(ImageManifest, 'sha256:manifest'))
+        manifest = pending(ImageManifest(digest='sha256:manifest'))
+        tag = pending(ManifestTag(name='latest'))
+        for dc in (large, unknown, layer, small, config, manifest, tag):
+            stage.schedule(dc)
+
+        small_lane, large_lane = stage.lanes
+        order = [heapq.heappop(small_lane.queue)[-1] for _ in range(len(small_lane.queue))]
+        self.assertEqual(order, [manifest, tag, config, small, layer, unknown])
+        self.assertEqual([item[-1] for item in large_lane.queue], [large])
+
+
+class TestDockerQueryExistingArtifacts(TestCase):
+    """Test looking up the Artifacts that are already in Pulp."""
+
+    def test_cached(self):
+        """Artifacts in the shared cache are attached without a query."""
+        cache = ContentCache()
+        saved = Artifact(sha256='abc')
+        cache.add_many(Artifact, {('abc',): saved})
+        dc = pending(ManifestBlob(digest='sha256:abc'))
+        dc.d_artifacts[0].artifact.sha256 = 'abc'
+        with self.assertNumQueries(0):
+            DockerQueryExistingArtifacts(cache).find_artifacts(dc.d_artifacts)
+        self.assertIs(dc.d_artifacts[0].artifact, saved)
+
+
+class TestDockerArtifactSaver(TestCase):
+    """Test saving downloaded Artifacts."""
+
+    def test_saved_concurrently(self):
+        """An Artifact saved by another sync first is used, and no copy of the file is left."""
+        data = b'layer'
+        existing = Artifact.objects.create(file=SimpleUploadedFile('layer', data),
+                                           **artifact_attributes(data))
+        storage_dir = os.path.dirname(existing.file.path)
+        stored = set(os.listdir(storage_dir))
+        path = downloaded_file(data)
+        dc = pending(ManifestBlob(digest='sha256:layer'))
+        da = dc.d_artifacts[0]
+        da.artifact = Artifact(file=path, **artifact_attributes(data))
+
+        DockerArtifactSaver().save_artifacts([da])
+        self.assertEqual(da.artifact, existing)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(set(os.listdir(storage_dir)), stored)
+        self.assertTrue(os.path.exists(existing.file.path))
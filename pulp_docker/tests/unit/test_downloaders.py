@@ -0,0 +1,397 @@
+from unittest import mock
+import asyncio
+import hashlib
+import os
+import tempfile
+
+from aiohttp.client_exceptions import ClientPayloadError
+from django.test import TestCase, override_settings
+
+from pulp_docker.app.downloaders import (
+    AdaptiveConcurrencyLimiter,
+    MAX_RESUME_ATTEMPTS,
+    TokenAuthHttpDownloader,
+    TokenCache,
+    parse_challenge,
+    parse_content_range,
+    parse_retry_after,
+    split_ranges,
+)
+
+
+CHALLENGE = ('https://auth.docker.io/token', 'registry.docker.io',
+             'repository:library/busybox:pull')
+
+BODY = b'0123456789'
+
+
+class FakeContent:
+    """The body of a fake response, interrupted or blocked at a position if given."""
+
+    def __init__(self, body, fail_at=None, block=False):
+        """Serve the body."""
+        self.body = body
+        self.position = 0
+        self.fail_at = fail_at
+        self.block = block
+        self.cancelled = False
+
+    async def read(self, size=-1):
+        """Return the next chunk, or fail or block when reaching the given position."""
+        if self.block:
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+        end = len(self.body) if size < 0 else self.position + size
+        if self.fail_at is not None:
+            if self.position >= self.fail_at:
+                raise ClientPayloadError('interrupted')
+            end = min(end, self.fail_at)
+        chunk = self.body[self.position:end]
+        self.position += len(chunk)
+        return chunk
+
+
+class FakeResponse:
+    """A successful response of a fake session."""
+
+    def __init__(self, body, status=200, content_range=None, **content_kwargs):
+        """Respond with a body, or a range of it."""
+        self.status = status
+        self.headers = {}
+        if content_range:
+            self.headers['Content-Range'] = content_range
+        self.content = FakeContent(body, **content_kwargs)
+
+    async def __aenter__(self):
+        """Return the response."""
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        """Do nothing."""
+
+    def raise_for_status(self):
+        """Do nothing, the response is successful."""
+
+    async def release(self):
+        """Do nothing."""
+
+
+class FakeSession:
+    """Answer requests with the given responses in order, recording their headers."""
+
+    def __init__(self, *responses):
+        """Answer with the responses."""
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, headers=None):
+        """Return the next response."""
+        self.requests.append(headers or {})
+        return self.responses.pop(0)
+
+    def get(self, url, headers=None):
+        """Return the next response."""
+        return self.request('get', url, headers=headers)
+
+
+class FakeRemote:
+    """A remote without token auth."""
+
+    def __init__(self):
+        """Create the token cache and the limiter."""
+        self.token_cache = TokenCache()
+        self.download_limiter = AdaptiveConcurrencyLimiter(1)
+
+
+class TestParseChallenge(TestCase):
+    """Test parsing token auth challenges."""
+
+    def test_parse_challenge(self):
+        """The realm, service and scope are parsed from the header."""
+        header = ('Bearer realm="https://auth.docker.io/token",service="registry.docker.io",'
+                  'scope="repository:library/busybox:pull"')
+        self.assertEqual(parse_challenge(header), CHALLENGE)
+
+    def test_no_realm(self):
+        """A challenge without a realm cannot be answered."""
+        with self.assertRaises(IOError):
+            parse_challenge('Bearer service="registry.docker.io"')
+
+
+class TestRanges(TestCase):
+    """Test splitting large bodies into range requests."""
+
+    def test_split_ranges(self):
+        """The ranges cover the whole body without overlapping."""
+        self.assertEqual(split_ranges(10, 3), [(0, 3), (4, 7), (8, 9)])
+        self.assertEqual(split_ranges(8, 4), [(0, 1), (2, 3), (4, 5), (6, 7)])
+        self.assertEqual(split_ranges(2, 4), [(0, 0), (1, 1)])
+
+    def test_parse_content_range(self):
+        """The range and the size of the whole body are parsed from the header."""
+        self.assertEqual(parse_content_range('bytes 0-1023/4096'), (0, 1023, 4096))
+        self.assertEqual(parse_content_range('bytes 1024-2047/*'), (1024, 2047, None))
+        self.assertEqual(parse_content_range(None), (None, None, None))
+        self.assertEqual(parse_content_range('bytes */4096'), (None, None, None))
+
+
+class TestParseRetryAfter(TestCase):
+    """Test parsing the delay of rate limited requests."""
+
+    def test_seconds(self):
+        """The delay can be a number of seconds."""
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after('-1'), 0)
+
+    def test_date(self):
+        """The delay can be a date in the past or the future."""
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        self.assertGreater(parse_retry_after('Fri, 01 Jan 2100 00:00:00 GMT'), 0)
+
+    def test_invalid(self):
+        """Missing or invalid headers have no delay."""
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after('soon'))
+
+
+class TestAdaptiveConcurrencyLimiter(TestCase):
+    """Test adapting the download concurrency to rate limiting."""
+
+    def test_throttled(self):
+        """The limit is halved once per burst of rate limited requests."""
+        limiter = AdaptiveConcurrencyLimiter(8)
+        limiter.throttled()
+        limiter.throttled()
+        self.assertEqual(limiter.limit, 4)
+        limiter._throttled_at -= AdaptiveConcurrencyLimiter.COOLDOWN
+        limiter.throttled()
+        self.assertEqual(limiter.limit, 2)
+
+    def test_succeeded(self):
+        """The limit grows by one per window of successes, up to the maximum."""
+        limiter = AdaptiveConcurrencyLimiter(3)
+        limiter.throttled()
+        for i in range(10):
+            limiter.succeeded()
+        self.assertEqual(limiter.limit, 3)
+
+    def test_limit(self):
+        """No more downloads than the limit run concurrently."""
+        limiter = AdaptiveConcurrencyLimiter(2)
+        running = []
+
+        async def download():
+            async with limiter:
+                running.append(limiter.in_use)
+                await asyncio.sleep(0)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.gather(*(download() for i in range(6))))
+        self.assertEqual(max(running), 2)
+        self.assertEqual(limiter.in_use, 0)
+
+    def test_parent(self):
+        """Downloads of several limiters also respect the limit of their parent."""
+        parent = asyncio.Semaphore(3)
+        limiters = [AdaptiveConcurrencyLimiter(2), AdaptiveConcurrencyLimiter(2)]
+        running = []
+        active = []
+
+        async def download(limiter):
+            limiter.parent = parent
+            async with limiter:
+                active.append(limiter)
+                running.append(len(active))
+                await asyncio.sleep(0)
+                active.remove(limiter)
+
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(asyncio.gather(*(
+            download(limiters[i % 2]) for i in range(8))))
+        self.assertLessEqual(max(running), 3)
+        self.assertEqual([limiter.in_use for limiter in limiters], [0, 0])
+
+
+class TestTokenCache(TestCase):
+    """Test caching Bearer tokens."""
+
+    def setUp(self):
+        """Create an empty cache and a fake token server."""
+        self.cache = TokenCache()
+        self.requested = []
+        self.expires_in = 300
+
+    async def fetch(self, challenge):
+        """Issue a new token for a challenge."""
+        self.requested.append(challenge)
+        await asyncio.sleep(0)
+        return 'token-{n}'.format(n=len(self.requested)), self.expires_in
+
+    def get_token(self):
+        """Get a token from the cache."""
+        return self.cache.get_token(CHALLENGE, self.fetch)
+
+    def run_coroutines(self, *coroutines):
+        """Run coroutines concurrently until they are done."""
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(asyncio.gather(*coroutines))
+
+    def test_single_request(self):
+        """Concurrent requests for the same challenge share a single token request."""
+        tokens = self.run_coroutines(*(self.get_token() for i in range(5)))
+        self.assertEqual(tokens, ['token-1'] * 5)
+        self.assertEqual(self.run_coroutines(self.get_token()), ['token-1'])
+        self.assertEqual(len(self.requested), 1)
+
+    def test_expiring_token(self):
+        """Tokens about to expire are requested again."""
+        self.expires_in = 0
+        tokens = self.run_coroutines(self.get_token(), self.get_token())
+        self.assertEqual(tokens, ['token-1', 'token-1'])
+        self.assertIsNone(self.cache.get(CHALLENGE))
+        self.assertEqual(self.run_coroutines(self.get_token()), ['token-2'])
+
+    def test_short_lived_token(self):
+        """Tokens valid for less than the refresh margin are used until halfway to expiring."""
+        self.expires_in = TokenCache.REFRESH_MARGIN / 2
+        self.assertEqual(self.run_coroutines(self.get_token()), ['token-1'])
+        self.assertEqual(self.cache.get(CHALLENGE), 'token-1')
+        self.assertEqual(self.run_coroutines(self.get_token()), ['token-1'])
+        self.assertEqual(len(self.requested), 1)
+
+    def test_invalidate(self):
+        """Only the token that was rejected is forgotten."""
+        self.run_coroutines(self.get_token())
+        self.cache.invalidate(CHALLENGE, 'another-token')
+        self.assertEqual(self.cache.get(CHALLENGE), 'token-1')
+        self.cache.invalidate(CHALLENGE, 'token-1')
+        self.assertIsNone(self.cache.get(CHALLENGE))
+
+    def test_share(self):
+        """Caches sharing their tokens request each token once, but keep their challenge."""
+        self.cache.challenge = CHALLENGE
+        other = TokenCache()
+        other.share(self.cache)
+        self.run_coroutines(self.get_token(), other.get_token(CHALLENGE, self.fetch))
+        self.assertEqual(len(self.requested), 1)
+        self.assertIsNone(other.challenge)
+
+
+class TestTokenAuthHttpDownloader(TestCase):
+    """Test resumed and ranged downloads."""
+
+    def setUp(self):
+        """Download into a temporary directory, and record the backoff delays."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        self.delays = []
+
+        async def sleep(delay):
+            self.delays.append(delay)
+
+        patcher = mock.patch('asyncio.sleep', sleep)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def downloader(self, session):
+        """Create a downloader of BODY."""
+        return TokenAuthHttpDownloader(
+            'https://registry.example.com/v2/library/busybox/blobs/sha256:abc',
+            session=session, remote=FakeRemote(), expected_size=len(BODY),
+            expected_digests={'sha256': hashlib.sha256(BODY).hexdigest()})
+
+    def download(self, downloader, extra_data=None):
+        """Run a download, and return the downloaded data."""
+        coroutine = downloader.run(extra_data=extra_data or {})
+        result = asyncio.get_event_loop().run_until_complete(coroutine)
+        with open(result.path, 'rb') as downloaded:
+            return downloaded.read()
+
+    def test_resume(self):
+        """An interrupted download is resumed from the last byte received."""
+        session = FakeSession(
+            FakeResponse(BODY, fail_at=4),
+            FakeResponse(BODY[4:], status=206, content_range='bytes 4-9/10'),
+        )
+        self.assertEqual(self.download(self.downloader(session)), BODY)
+        self.assertNotIn('Range', session.requests[0])
+        self.assertEqual(session.requests[1]['Range'], 'bytes=4-')
+
+    def test_restart(self):
+        """The download starts over when the registry sends the whole body again."""
+        session = FakeSession(FakeResponse(BODY, fail_at=4), FakeResponse(BODY))
+        downloader = self.downloader(session)
+        self.assertEqual(self.download(downloader), BODY)
+        self.assertEqual(session.requests[1]['Range'], 'bytes=4-')
+        self.assertEqual(downloader.artifact_attributes['size'], len(BODY))
+        self.assertEqual(downloader.artifact_attributes['sha256'], hashlib.sha256(BODY).hexdigest())
+
+    @override_settings(DOCKER_RANGED_DOWNLOAD_THRESHOLD=4, DOCKER_RANGED_DOWNLOAD_PARTS=2)
+    def test_ranged(self):
+        """Large bodies are downloaded in parts."""
+        session = FakeSession(
+            FakeResponse(BODY[:5], status=206, content_range='bytes 0-4/10'),
+            FakeResponse(BODY[5:], status=206, content_range='bytes 5-9/10'),
+        )
+        self.assertEqual(self.download(self.downloader(session), {'size': len(BODY)}), BODY)
+        self.assertEqual([request['Range'] for request in session.requests],
+                         ['bytes=0-4', 'bytes=5-9'])
+
+    @override_settings(DOCKER_RANGED_DOWNLOAD_THRESHOLD=4, DOCKER_RANGED_DOWNLOAD_PARTS=2)
+    def test_part_token(self):
+        """A part rejected with HTTP 401 is requested once more with a new token."""
+        unauthorized = FakeResponse(b'', status=401)
+        unauthorized.headers['www-authenticate'] = (
+            'Bearer realm="https://auth.docker.io/token",service="registry.docker.io",'
+            'scope="repository:library/busybox:pull"')
+        session = FakeSession(
+            FakeResponse(BODY[:5], status=206, content_range='bytes 0-4/10'),
+            unauthorized,
+            FakeResponse(BODY[5:], status=206, content_range='bytes 5-9/10'),
+        )
+        downloader = self.downloader(session)
+        downloader.token_cache.challenge = CHALLENGE
+        tokens = iter(['expired', 'renewed'])
+
+        async def fetch_token(challenge):
+            return next(tokens), 300
+
+        downloader.fetch_token = fetch_token
+        self.assertEqual(self.download(downloader, {'size': len(BODY)}), BODY)
+        self.assertEqual([request['Authorization'] for request in session.requests],
+                         ['Bearer expired', 'Bearer expired', 'Bearer renewed'])
+        self.assertEqual(session.requests[2]['Range'], 'bytes=5-9')
+
+    @override_settings(DOCKER_RANGED_DOWNLOAD_THRESHOLD=4, DOCKER_RANGED_DOWNLOAD_PARTS=2)
+    def test_ranges_not_supported(self):
+        """The whole body is used when the registry does not support range requests."""
+        session = FakeSession(FakeResponse(BODY))
+        self.assertEqual(self.download(self.downloader(session), {'size': len(BODY)}), BODY)
+        self.assertEqual(len(session.requests), 1)
+
+    def test_part_attempts(self):
+        """A part is attempted MAX_RESUME_ATTEMPTS times, without a backoff after the last."""
+        session = FakeSession(*(
+            FakeResponse(BODY[5:], status=206, content_range='bytes 5-9/10', fail_at=0)
+            for _ in range(MAX_RESUME_ATTEMPTS)
+        ))
+        downloader = self.downloader(session)
+        with self.assertRaises(IOError):
+            asyncio.get_event_loop().run_until_complete(downloader._download_part((5, 9), {}))
+        self.assertEqual(len(session.requests), MAX_RESUME_ATTEMPTS)
+        self.assertEqual(len(self.delays), MAX_RESUME_ATTEMPTS - 1)
+
+    @override_settings(DOCKER_RANGED_DOWNLOAD_THRESHOLD=4, DOCKER_RANGED_DOWNLOAD_PARTS=2)
+    def test_cancel_parts(self):
+        """When a part fails, the other parts are cancelled."""
+        first_part = FakeResponse(BODY[:5], status=206, content_range='bytes 0-4/10', block=True)
+        # A registry that ignores the range of the second part.
+        session = FakeSession(first_part, FakeResponse(BODY))
+        with self.assertRaises(IOError):
+            self.download(self.downloader(session), {'size': len(BODY)})
+        self.assertTrue(first_part.content.cancelled)
@@ -0,0 +1,39 @@
+from unittest import mock
+import asyncio
+import threading
+
+from django.test import TestCase
+
+from pulp_docker.app.tasks.executor import BlockingExecutor, run_blocking
+
+
+class TestRunBlocking(TestCase):
+    """Test running blocking work of the sync stages."""
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine until it is done."""
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_executor(self):
+        """Jobs run in the threads of the executor."""
+        executor = BlockingExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        thread = self.run_coroutine(run_blocking(executor, threading.current_thread))
+        self.assertIsNot(thread, threading.current_thread())
+
+    def test_no_executor(self):
+        """Without an executor, jobs run in the event loop thread."""
+        thread = self.run_coroutine(run_blocking(None, threading.current_thread))
+        self.assertIs(thread, threading.current_thread())
+
+    def test_shutdown(self):
+        """Shutting down closes the connection of every thread, including idle ones."""
+        closed = set()
+        executor = BlockingExecutor(max_workers=3)
+        with mock.patch('pulp_docker.app.tasks.executor.connection') as db_connection:
+            db_connection.close.side_effect = lambda: closed.add(threading.get_ident())
+            jobs = asyncio.gather(*(run_blocking(executor, threading.get_ident) for _ in range(2)))
+            threads = set(self.run_coroutine(jobs))
+            executor.shutdown()
+        self.assertLessEqual(threads, closed)
+        self.assertEqual(len(closed), 3)
@@ -0,0 +1,41 @@
+import asyncio
+
+from django.test import TestCase
+
+from pulp_docker.app.tasks.instrumentation import InputQueue, OutputQueue, StageMetrics
+
+
+class TestInstrumentedQueues(TestCase):
+    """Test counting the units passing through a stage."""
+
+    def setUp(self):
+        """Create the counters of a stage and its queues."""
+        self.metrics = StageMetrics('TestStage')
+        self.in_q = InputQueue(asyncio.Queue(), self.metrics)
+        self.out_q = OutputQueue(asyncio.Queue(), self.metrics)
+
+    def test_counts(self):
+        """Units are counted, the end of the stream is not."""
+        for item in ('a', 'b', None):
+            self.in_q.put_nowait(item)
+
+        async def stage():
+            self.assertEqual(self.in_q.get_nowait(), 'a')
+            while True:
+                item = await self.in_q.get()
+                await self.out_q.put(item)
+                if item is None:
+                    break
+
+        asyncio.get_event_loop().run_until_complete(stage())
+        self.assertEqual((self.metrics.units_in, self.metrics.units_out), (2, 1))
+        self.assertEqual(self.metrics.max_queue_depth, 3)
+
+    def test_busy(self):
+        """Time spent waiting is not busy."""
+        self.metrics.started = 10.0
+        self.metrics.finished = 20.0
+        self.metrics.waiting_in = 6.0
+        self.metrics.waiting_out = 1.5
+        self.assertEqual(self.metrics.busy, 2.5)
+        self.assertEqual(self.metrics.as_dict()['units_per_second'], 0)
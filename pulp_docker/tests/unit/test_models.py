@@ -1,5 +1,11 @@
+import asyncio
+import os
+import tempfile
+
 from django.test import TestCase
 
+from pulp_docker.app.models import DockerRemote
+
 
 class TestNothing(TestCase):
     """Test Nothing (placeholder)."""
@@ -7,3 +13,93 @@ class TestNothing(TestCase):
     def test_nothing_at_all(self):
         """Test that the tests are running and that's it."""
         self.assertTrue(True)
+
+
+class TestDockerRemoteFilterTags(TestCase):
+    """Test filtering upstream tags with the patterns of a DockerRemote."""
+
+    tags = ['latest', '3.8', '3.8-alpine', '3.9-alpine', '2.7']
+
+    def test_no_filters(self):
+        """All tags are kept when no patterns are set."""
+        remote = DockerRemote(upstream_name='python')
+        self.assertEqual(remote.filter_tags(self.tags), self.tags)
+
+    def test_include(self):
+        """Only tags matching an include pattern are kept."""
+        remote = DockerRemote(upstream_name='python', include_tags='3.*, latest')
+        self.assertEqual(remote.filter_tags(self.tags),
+                         ['latest', '3.8', '3.8-alpine', '3.9-alpine'])
+
+    def test_exclude(self):
+        """Tags matching an exclude pattern are dropped, even if they are included."""
+        remote = DockerRemote(upstream_name='python', include_tags='3.*',
+                              exclude_tags='*-alpine')
+        self.assertEqual(remote.filter_tags(self.tags), ['3.8'])
+
+
+class TestDockerRemoteTokenCache(TestCase):
+    """Test priming the token cache of a DockerRemote."""
+
+    def test_unknown_challenge(self):
+        """Without a remembered challenge the registry has to issue one first."""
+        remote = DockerRemote(upstream_name='busybox')
+        self.assertIsNone(remote.token_cache.challenge)
+
+    def test_remembered_challenge(self):
+        """A remembered challenge is used with the pull scope of the upstream repository."""
+        remote = DockerRemote(upstream_name='busybox', token_realm='https://auth.docker.io/token',
+                              token_service='registry.docker.io')
+        self.assertEqual(remote.token_cache.challenge, ('https://auth.docker.io/token',
+                                                        'registry.docker.io',
+                                                        'repository:library/busybox:pull'))
+
+
+class TestDockerRemoteCloseDownloads(TestCase):
+    """Test closing the download session of a DockerRemote."""
+
+    def setUp(self):
+        """Create downloaders in a temporary directory."""
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+
+    def test_close_downloads(self):
+        """The session shared by the downloaders of the remote is closed."""
+        remote = DockerRemote(name='test', url='https://registry.example.com',
+                              upstream_name='busybox')
+        downloader = remote.get_downloader('https://registry.example.com/v2/')
+        asyncio.get_event_loop().run_until_complete(remote.close_downloads())
+        self.assertTrue(downloader.session.closed)
+
+    def test_no_downloads(self):
+        """Nothing is closed before a downloader was built."""
+        remote = DockerRemote(name='test', url='https://registry.example.com',
+                              upstream_name='busybox')
+        asyncio.get_event_loop().run_until_complete(remote.close_downloads())
+
+
+class TestDockerRemoteAcceptsPlatform(TestCase):
+    """Test filtering the manifests of manifest lists by platform."""
+
+    amd64 = {'architecture': 'amd64', 'os': 'linux'}
+    arm64 = {'architecture': 'arm64', 'os': 'linux', 'variant': 'v8'}
+    arm = {'architecture': 'arm', 'os': 'linux', 'variant': 'v7'}
+
+    def test_no_platforms(self):
+        """All platforms are accepted when none are set."""
+        remote = DockerRemote(upstream_name='python')
+        self.assertTrue(remote.accepts_platform(self.arm))
+
+    def test_platforms(self):
+        """Only the platforms that are set are accepted."""
+        remote = DockerRemote(upstream_name='python', platforms='linux/amd64, linux/arm64')
+        self.assertTrue(remote.accepts_platform(self.amd64))
+        self.assertTrue(remote.accepts_platform(self.arm64))
+        self.assertFalse(remote.accepts_platform(self.arm))
+
+    def test_variant(self):
+        """A platform with a variant only accepts that variant."""
+        remote = DockerRemote(upstream_name='python', platforms='linux/arm/v6')
+        self.assertFalse(remote.accepts_platform(self.arm))
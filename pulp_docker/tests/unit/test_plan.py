@@ -0,0 +1,28 @@
+from django.test import TestCase
+
+from pulp_docker.app.tasks.plan import SyncPlanStage
+
+
+class TestSyncPlanStage(TestCase):
+    """Test summarizing what a sync would download."""
+
+    def test_summary(self):
+        """Blobs in Pulp are free, shared blobs are counted once in the totals."""
+        plan = SyncPlanStage()
+        plan.tags['1.0'] = 'sha256:1'
+        plan.tags['2.0'] = 'sha256:list'
+        plan.manifests = {'sha256:1', 'sha256:2', 'sha256:list'}
+        plan.list_manifests['sha256:list'] = {'sha256:2'}
+        plan.manifest_blobs['sha256:1'] = {'base', 'app-1'}
+        plan.manifest_blobs['sha256:2'] = {'base', 'app-2', 'config'}
+        plan.blob_sizes = {'base': 100, 'app-1': 10, 'app-2': 20, 'config': None}
+        plan.existing = {'app-1'}
+        summary = plan.summary()
+        self.assertEqual(
+            (summary['tags'], summary['manifests'], summary['blobs']), (2, 3, 4))
+        self.assertEqual(
+            (summary['new_blobs'], summary['new_bytes'], summary['unknown_size']), (3, 120, 1))
+        self.assertEqual(summary['per_tag']['1.0'],
+                         {'blobs': 2, 'new_blobs': 1, 'new_bytes': 100, 'unknown_size': 0})
+        self.assertEqual(summary['per_tag']['2.0'],
+                         {'blobs': 3, 'new_blobs': 3, 'new_bytes': 120, 'unknown_size': 1})
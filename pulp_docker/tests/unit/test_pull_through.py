@@ -0,0 +1,194 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+
+from aiohttp import web
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+from pulpcore.plugin.models import Artifact
+
+from pulp_docker.app import pull_through
+from pulp_docker.app.models import DockerRemote
+from pulp_docker.app.pull_through import BlobFetch, save_artifact, shared_remote
+
+
+class FakeDownloader:
+    """Write chunks to the file of a BlobFetch, then fail once the remote releases it."""
+
+    def __init__(self, file, chunks, release):
+        """Write the chunks to a file."""
+        self.file = file
+        self.chunks = chunks
+        self.release = release
+
+    async def run(self, extra_data=None):
+        """Write the chunks, then fail once released."""
+        for chunk in self.chunks:
+            self.file.write(chunk)
+            await asyncio.sleep(0)
+        await self.release.wait()
+        raise IOError('upstream failed')
+
+
+class FakeRemote:
+    """A remote whose downloads write the given chunks and fail when released."""
+
+    url = 'https://registry.example.com'
+    namespaced_upstream_name = 'library/busybox'
+
+    def __init__(self, chunks=()):
+        """Make the downloads write the given chunks."""
+        self.chunks = list(chunks)
+        self.release = asyncio.Event()
+        self.downloads = 0
+
+    def get_downloader(self, url, custom_file_object, expected_digests):
+        """Return a fake downloader writing to the file."""
+        self.downloads += 1
+        return FakeDownloader(custom_file_object, self.chunks, self.release)
+
+
+class TestBlobFetch(TestCase):
+    """Test streaming blobs to clients while they are downloaded."""
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine until it is done."""
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def finish(self, remote, fetch):
+        """Make the download fail, and wait for it."""
+        remote.release.set()
+        self.run_coroutine(asyncio.wait([fetch.task]))
+        fetch.task.exception()
+
+    async def read(self, fetch, size):
+        """Read the download until `size` bytes or the end, as a response does."""
+        data = b''
+        with open(fetch.path, 'rb') as blob_file:
+            generation = fetch.generation
+            while len(data) < size:
+                chunk = await fetch._read(blob_file, generation)
+                if not chunk:
+                    return data, chunk
+                data += chunk
+        return data, None
+
+    def test_several_readers(self):
+        """Every reader receives all data written so far."""
+        remote = FakeRemote([b'one', b'two'])
+        fetch = BlobFetch(remote, 'https://registry.example.com/v2/', 'abc')
+        self.addCleanup(self.finish, remote, fetch)
+        readers = asyncio.gather(self.read(fetch, 6), self.read(fetch, 6))
+        self.assertEqual(self.run_coroutine(readers), [(b'onetwo', None), (b'onetwo', None)])
+
+    def test_reuse_in_flight(self):
+        """A blob that is being downloaded is not downloaded again."""
+        remote = FakeRemote()
+        fetch = BlobFetch.get_or_start_upstream(remote, 'sha256:abc')
+        self.addCleanup(self.finish, remote, fetch)
+        self.run_coroutine(asyncio.sleep(0))
+        self.assertIs(BlobFetch.get_or_start_upstream(remote, 'sha256:abc'), fetch)
+        self.assertEqual(fetch.url, 'https://registry.example.com/v2/library/busybox/blobs/'
+                                    'sha256:abc')
+        self.assertEqual(remote.downloads, 1)
+
+    def test_upstream_failure(self):
+        """Readers waiting for more data learn that the download failed."""
+        remote = FakeRemote([b'one'])
+        fetch = BlobFetch(remote, 'https://registry.example.com/v2/', 'abc')
+        reader = asyncio.ensure_future(self.read(fetch, 6))
+        self.run_coroutine(asyncio.sleep(0.01))
+        self.assertFalse(reader.done())
+        self.finish(remote, fetch)
+        self.assertEqual(self.run_coroutine(reader), (b'one', None))
+        self.assertNotIn('abc', BlobFetch.in_flight)
+
+    def test_failure_before_data(self):
+        """A response fails with a bad gateway error when the download fails without data."""
+        remote = FakeRemote()
+        fetch = BlobFetch(remote, 'https://registry.example.com/v2/', 'abc')
+        response = asyncio.ensure_future(fetch.stream(None, {}))
+        self.run_coroutine(asyncio.sleep(0.01))
+        self.finish(remote, fetch)
+        with self.assertRaises(web.HTTPBadGateway):
+            self.run_coroutine(response)
+
+
+class TestSharedRemote(TestCase):
+    """Test sharing the remotes of pull-through requests."""
+
+    def setUp(self):
+        """Create a remote, and forget the shared remotes afterwards."""
+        self.remote = DockerRemote.objects.create(
+            name='shared', url='https://registry.example.com', upstream_name='busybox')
+        self.addCleanup(pull_through._remotes.clear)
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine until it is done."""
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def pull(self):
+        """Load the remote like a request does, and return the instance to fetch with."""
+        return shared_remote(DockerRemote.objects.get(pk=self.remote.pk))
+
+    def test_reuse_token(self):
+        """Two pulls through the same remote use one token."""
+        fetched = []
+
+        async def fetch_token(challenge):
+            fetched.append(challenge)
+            return 'token', 300
+
+        challenge = ('https://auth.example.com/token', 'registry.example.com',
+                     self.remote.pull_scope)
+        first = self.pull()
+        second = self.pull()
+        self.assertIs(second, first)
+        for remote in (first, second):
+            token = self.run_coroutine(remote.token_cache.get_token(challenge, fetch_token))
+            self.assertEqual(token, 'token')
+        self.assertEqual(fetched, [challenge])
+
+    def test_updated_remote(self):
+        """An updated remote replaces the shared instance."""
+        first = self.pull()
+        self.remote.upstream_name = 'alpine'
+        self.remote.save()
+        second = self.pull()
+        self.assertIsNot(second, first)
+        self.assertEqual(second.upstream_name, 'alpine')
+        self.assertIs(self.pull(), second)
+        # Let the session of the replaced instance be closed.
+        self.run_coroutine(asyncio.sleep(0))
+
+    def test_no_remote(self):
+        """Distributions without a remote have no shared remote."""
+        self.assertIsNone(shared_remote(None))
+
+
+class TestSaveArtifact(TestCase):
+    """Test saving downloaded files as Artifacts."""
+
+    def downloaded_file(self, data):
+        """Write data to a temporary file, like a downloader does."""
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as downloaded:
+            downloaded.write(data)
+        return path
+
+    def test_saved_concurrently(self):
+        """An Artifact saved by another process first is used, and no copy of the file is left."""
+        data = b'layer'
+        attributes = {name: getattr(hashlib, name)(data).hexdigest()
+                      for name in ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')}
+        attributes['size'] = len(data)
+        existing = Artifact.objects.create(file=SimpleUploadedFile('layer', data), **attributes)
+        storage_dir = os.path.dirname(existing.file.path)
+        stored = set(os.listdir(storage_dir))
+        path = self.downloaded_file(data)
+
+        self.assertEqual(save_artifact(path, attributes), existing)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(set(os.listdir(storage_dir)), stored)
+        self.assertTrue(os.path.exists(existing.file.path))
@@ -0,0 +1,78 @@
+from uuid import uuid4
+
+from django.test import TestCase
+from pulpcore.constants import TASK_STATES
+from pulpcore.plugin.models import Repository, Task
+
+from pulp_docker.app.models import DockerRemote, SyncShard
+from pulp_docker.app.tasks.sharding import (delete_abandoned_syncs, finish_shard, split_tags,
+                                            synchronize_shard)
+
+
+class TestSplitTags(TestCase):
+    """Test splitting the upstream tags into shards."""
+
+    def test_split_tags(self):
+        """Shards are contiguous and their sizes differ by at most one."""
+        tags = [str(i) for i in range(10)]
+        self.assertEqual(split_tags(tags, 3), [tags[0:4], tags[4:7], tags[7:10]])
+        self.assertEqual(split_tags(tags, 1), [tags])
+
+    def test_more_shards_than_tags(self):
+        """Empty shards are left out."""
+        self.assertEqual(split_tags(['a', 'b'], 4), [['a'], ['b']])
+        self.assertEqual(split_tags([], 4), [])
+
+
+class TestAbandonedShards(TestCase):
+    """Test finishing syncs whose shard tasks ended without recording their outcome."""
+
+    def setUp(self):
+        """Create the repository the shards are merged into."""
+        self.repository = Repository.objects.create(name='target')
+        self.sync_id = uuid4()
+
+    def shard(self, task_state=None, state=SyncShard.WAITING):
+        """Create a shard, with a task in the given state."""
+        task = None
+        if task_state is not None:
+            task = Task.objects.create(name='synchronize_shard', state=task_state)
+        return SyncShard.objects.create(
+            sync_id=self.sync_id, state=state, target=self.repository, task=task,
+            repository=Repository.objects.create(name='shard-{uuid}'.format(uuid=uuid4().hex)))
+
+    def test_finish_shard(self):
+        """Shards whose task was canceled are recorded as failed when another shard finishes."""
+        finishing = self.shard(TASK_STATES.RUNNING)
+        canceled = self.shard(TASK_STATES.CANCELED)
+        running = self.shard(TASK_STATES.RUNNING)
+        finish_shard(finishing, SyncShard.COMPLETED)
+        states = dict(SyncShard.objects.values_list('pk', 'state'))
+        self.assertEqual(states, {finishing.pk: SyncShard.COMPLETED,
+                                  canceled.pk: SyncShard.FAILED,
+                                  running.pk: SyncShard.WAITING})
+
+    def test_delete_abandoned_syncs(self):
+        """The scratch repositories of a sync whose last shard was abandoned are deleted."""
+        shards = [self.shard(TASK_STATES.COMPLETED, state=SyncShard.COMPLETED),
+                  self.shard(TASK_STATES.CANCELED)]
+        delete_abandoned_syncs(self.repository)
+        self.assertFalse(Repository.objects.filter(
+            pk__in=[shard.repository_id for shard in shards]).exists())
+        self.assertFalse(SyncShard.objects.exists())
+
+    def test_running_sync(self):
+        """The shards of a sync that can still finish are kept."""
+        self.shard(TASK_STATES.CANCELED)
+        self.shard(TASK_STATES.RUNNING)
+        self.shard()
+        delete_abandoned_syncs(self.repository)
+        self.assertEqual(SyncShard.objects.count(), 3)
+
+    def test_missing_remote(self):
+        """A shard is recorded as failed when its remote cannot be found."""
+        sync_shard = self.shard(TASK_STATES.RUNNING)
+        with self.assertRaises(DockerRemote.DoesNotExist):
+            synchronize_shard(uuid4(), sync_shard.repository.pk, ['latest'])
+        sync_shard.refresh_from_db()
+        self.assertEqual(sync_shard.state, SyncShard.FAILED)
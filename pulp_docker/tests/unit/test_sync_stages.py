@@ -0,0 +1,201 @@
+from collections import OrderedDict
+from unittest import mock
+import asyncio
+
+from django.test import TestCase
+from pulpcore.plugin.stages import DeclarativeContent
+
+from pulp_docker.app.models import (BlobManifestBlob, DockerRemote, ImageManifest, MEDIA_TYPE,
+                                    ManifestBlob, ManifestList, ManifestListManifest, ManifestTag)
+from pulp_docker.app.tasks.sync_stages import (InterrelateContent, TagListStage, TempTag,
+                                               parse_next_link, platform_fields)
+
+
+class FakeHeadDownloader:
+    """Respond to a HEAD request for a tag with the digest of its manifest."""
+
+    def __init__(self, digest):
+        """Respond with the given digest."""
+        self.digest = digest
+        self.methods = []
+        self.response_headers = {}
+
+    async def run(self, extra_data=None):
+        """Record the method of the request, and set the digest header."""
+        self.methods.append(extra_data.get('method', 'get'))
+        self.response_headers = {'Docker-Content-Digest': self.digest}
+
+
+class TestParseNextLink(TestCase):
+    """Test finding the next page of a paginated tags list."""
+
+    def test_next_link(self):
+        """The url of the next page is returned without the angle brackets."""
+        link = '</v2/library/busybox/tags/list?last=1.29&n=100>; rel="next"'
+        self.assertEqual(parse_next_link(link), '/v2/library/busybox/tags/list?last=1.29&n=100')
+
+    def test_other_relations(self):
+        """Links to other relations are ignored."""
+        link = '</v2/foo/tags/list?n=10>; rel="first", </v2/foo/tags/list?last=b&n=10>; rel=next'
+        self.assertEqual(parse_next_link(link), '/v2/foo/tags/list?last=b&n=10')
+        self.assertIsNone(parse_next_link('</v2/foo/tags/list?n=10>; rel="first"'))
+
+    def test_last_page(self):
+        """There is no next page without a Link header."""
+        self.assertIsNone(parse_next_link(None))
+        self.assertIsNone(parse_next_link(''))
+
+
+class TestPlatformFields(TestCase):
+    """Test converting the platform of a listed manifest to ManifestListManifest fields."""
+
+    def test_platform_fields(self):
+        """All fields are set, with empty values for missing keys."""
+        platform = {'architecture': 'amd64', 'os': 'windows', 'os.version': '10.0.14393.1066',
+                    'os.features': ['win32k']}
+        self.assertEqual(platform_fields(platform), {
+            'architecture': 'amd64',
+            'os': 'windows',
+            'os_version': '10.0.14393.1066',
+            'os_features': 'win32k',
+            'features': '',
+            'variant': '',
+        })
+
+
+class TestCreateKnownContent(TestCase):
+    """Test emitting the saved content of unchanged tags in an incremental sync."""
+
+    def test_platforms(self):
+        """Listed manifests for platforms the remote does not accept are not emitted."""
+        manifest_list = ManifestList.objects.create(
+            digest='sha256:list', schema_version=2, media_type=MEDIA_TYPE.MANIFEST_LIST)
+        manifests = {}
+        for architecture in ('amd64', 'arm64'):
+            manifests[architecture] = ImageManifest.objects.create(
+                digest='sha256:' + architecture, schema_version=2,
+                media_type=MEDIA_TYPE.MANIFEST_V2)
+            ManifestListManifest.objects.create(
+                manifest_list=manifest_list, manifest=manifests[architecture], os='linux',
+                architecture=architecture)
+        remote = DockerRemote(upstream_name='busybox', platforms='linux/amd64')
+        dcs = TagListStage(remote).create_known_content([manifest_list])
+        self.assertEqual([dc.content for dc in dcs], [manifest_list, manifests['amd64']])
+
+    def test_unknown_platforms(self):
+        """A manifest list whose listed platforms were not recorded is downloaded again."""
+        manifest_list = ManifestList.objects.create(
+            digest='sha256:list', schema_version=2, media_type=MEDIA_TYPE.MANIFEST_LIST)
+        manifest = ImageManifest.objects.create(
+            digest='sha256:manifest', schema_version=2, media_type=MEDIA_TYPE.MANIFEST_V2)
+        ManifestListManifest.objects.create(manifest_list=manifest_list, manifest=manifest)
+        remote = DockerRemote(url='https://registry.example.com', upstream_name='busybox',
+                              platforms='linux/amd64')
+        dcs = TagListStage(remote).create_tags_from_digests(
+            OrderedDict([('latest', 'sha256:list')]))
+        self.assertEqual(len(dcs), 1)
+        self.assertIsInstance(dcs[0].content, TempTag)
+        self.assertEqual(dcs[0].content.name, 'latest')
+
+
+class TestInterrelateContent(TestCase):
+    """Test relating saved content in bulk."""
+
+    def setUp(self):
+        """Save a manifest list, a manifest and a blob."""
+        self.manifest_list = ManifestList.objects.create(
+            digest='sha256:list', schema_version=2, media_type=MEDIA_TYPE.MANIFEST_LIST)
+        self.manifest = ImageManifest.objects.create(
+            digest='sha256:manifest', schema_version=2, media_type=MEDIA_TYPE.MANIFEST_V2)
+        self.blob = ManifestBlob.objects.create(
+            digest='sha256:blob', media_type=MEDIA_TYPE.REGULAR_BLOB)
+
+    def batch(self):
+        """Return a batch relating the blob and the manifest, each twice."""
+        platform = {'architecture': 'amd64', 'os': 'linux'}
+        return [
+            DeclarativeContent(content=self.blob, d_artifacts=[],
+                               extra_data={'relation': (ImageManifest, self.manifest.digest)}),
+            DeclarativeContent(content=self.blob, d_artifacts=[],
+                               extra_data={'relation': (ImageManifest, self.manifest.digest)}),
+            DeclarativeContent(content=self.manifest, d_artifacts=[], extra_data={
+                'relation': (ManifestList, self.manifest_list.digest), 'platform': platform}),
+            DeclarativeContent(content=self.manifest, d_artifacts=[], extra_data={
+                'relation': (ManifestList, self.manifest_list.digest), 'platform': platform}),
+        ]
+
+    def test_relate_once(self):
+        """Relations appearing several times in a batch are inserted once."""
+        InterrelateContent().relate_batch(self.batch())
+        self.assertEqual(BlobManifestBlob.objects.filter(
+            manifest=self.manifest, manifest_blob=self.blob).count(), 1)
+        list_manifest = ManifestListManifest.objects.get(
+            manifest_list=self.manifest_list, manifest=self.manifest)
+        self.assertEqual((list_manifest.os, list_manifest.architecture), ('linux', 'amd64'))
+
+    def test_existing_relations(self):
+        """Relations that already exist are skipped, by a later sync too."""
+        InterrelateContent().relate_batch(self.batch())
+        InterrelateContent().relate_batch(self.batch())
+        self.assertEqual(BlobManifestBlob.objects.count(), 1)
+        self.assertEqual(ManifestListManifest.objects.count(), 1)
+
+    def test_existing_tag(self):
+        """A Tag that already points at the tagged content is used instead of the new one."""
+        existing = ManifestTag.objects.create(name='latest', manifest=self.manifest)
+        tag_dc = DeclarativeContent(content=ManifestTag.objects.create(name='latest'),
+                                    d_artifacts=[])
+        InterrelateContent.relate_tags(ManifestTag, 'manifest', [(tag_dc, self.manifest)])
+        self.assertEqual(tag_dc.content, existing)
+
+    def test_concurrent_tag(self):
+        """A Tag created by a concurrent sync after it was looked up is reused."""
+        concurrent = ManifestTag.objects.create(name='latest', manifest=self.manifest)
+        tag_dc = DeclarativeContent(content=ManifestTag.objects.create(name='latest'),
+                                    d_artifacts=[])
+        real_filter = ManifestTag.objects.filter
+        lookups = []
+
+        def filter_missing_first(*args, **kwargs):
+            lookups.append((args, kwargs))
+            if len(lookups) == 1:
+                return ManifestTag.objects.none()
+            return real_filter(*args, **kwargs)
+
+        with mock.patch.object(ManifestTag.objects, 'filter', side_effect=filter_missing_first):
+            InterrelateContent.relate_tags(ManifestTag, 'manifest', [(tag_dc, self.manifest)])
+        self.assertEqual(tag_dc.content, concurrent)
+        self.assertEqual(ManifestTag.objects.filter(name='latest', manifest=self.manifest).count(),
+                         1)
+
+
+class TestIncrementalTags(TestCase):
+    """Test skipping unchanged tags in an incremental sync."""
+
+    def test_head(self):
+        """Tags of known manifests are finished, changed ones are downloaded."""
+        manifest = ImageManifest.objects.create(
+            digest='sha256:known', schema_version=2, media_type=MEDIA_TYPE.MANIFEST_V2)
+        tag = ManifestTag.objects.create(name='old', manifest=manifest)
+        digests = {'old': 'sha256:known', 'new': 'sha256:changed'}
+        downloaders = []
+
+        def get_downloader(url):
+            downloaders.append(FakeHeadDownloader(digests[url.rsplit('/', 1)[1]]))
+            return downloaders[-1]
+
+        remote = DockerRemote(url='https://registry.example.com', upstream_name='busybox')
+        stage = TagListStage(remote, incremental=True)
+        out_q = asyncio.Queue()
+        with mock.patch.object(remote, 'get_downloader', side_effect=get_downloader):
+            asyncio.get_event_loop().run_until_complete(stage.emit_tags(['old', 'new'], out_q))
+        dcs = [out_q.get_nowait() for _ in range(out_q.qsize())]
+
+        self.assertEqual([downloader.methods for downloader in downloaders], [['head'], ['head']])
+        pending, *finished = dcs
+        self.assertIsInstance(pending.content, TempTag)
+        self.assertEqual(pending.content.name, 'new')
+        self.assertEqual(pending.d_artifacts[0].url,
+                         'https://registry.example.com/v2/library/busybox/manifests/new')
+        self.assertEqual([dc.content for dc in finished], [tag, manifest])
+        self.assertTrue(all(dc.extra_data['processed'] for dc in finished))
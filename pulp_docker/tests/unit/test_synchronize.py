@@ -0,0 +1,86 @@
+import asyncio
+
+from django.test import TestCase
+from pulpcore.plugin.stages import DeclarativeContent
+
+from pulp_docker.app.models import ManifestBlob
+from pulp_docker.app.tasks.download_stages import (DockerArtifactDownloader,
+                                                   DockerArtifactSaver,
+                                                   DockerQueryExistingArtifacts)
+from pulp_docker.app.tasks.sync_stages import FeedbackStage, ProcessContentStage
+from pulp_docker.app.tasks.synchronize import run_pipeline
+
+
+class TestRunPipeline(TestCase):
+    """Test running the stages of a sync in a shared event loop."""
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine until it is done."""
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_failure_cancels_stages(self):
+        """When a stage fails, the stages waiting on their queues are cancelled."""
+        cancelled = []
+
+        async def failing(in_q, out_q):
+            raise ValueError('failed')
+
+        async def waiting(in_q, out_q):
+            try:
+                await in_q.get()
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        with self.assertRaises(ValueError):
+            self.run_coroutine(run_pipeline([failing, waiting, waiting]))
+        self.assertEqual(cancelled, [True, True])
+
+    def test_success(self):
+        """Items flow through the stages in order."""
+        received = []
+
+        async def first(in_q, out_q):
+            for item in range(3):
+                await out_q.put(item)
+            await out_q.put(None)
+
+        async def last(in_q, out_q):
+            while True:
+                item = await in_q.get()
+                if item is None:
+                    break
+                received.append(item)
+
+        self.run_coroutine(run_pipeline([first, last]))
+        self.assertEqual(received, [0, 1, 2])
+
+
+class TestDownloadAndProcessLoop(TestCase):
+    """Test the stages between FeedbackStage and ProcessContentStage."""
+
+    def test_few_units(self):
+        """A loop holding fewer units than a full batch finishes."""
+        dcs = [DeclarativeContent(content=ManifestBlob(digest='sha256:{}'.format(i)),
+                                  d_artifacts=[], extra_data={'processed': True})
+               for i in range(3)]
+        received = []
+
+        async def first(in_q, out_q):
+            for dc in dcs:
+                await out_q.put(dc)
+            await out_q.put(None)
+
+        async def last(in_q, out_q):
+            while True:
+                dc = await in_q.get()
+                if dc is None:
+                    break
+                received.append(dc)
+
+        feedback = FeedbackStage()
+        stages = [first, feedback, DockerQueryExistingArtifacts(), DockerArtifactDownloader(),
+                  DockerArtifactSaver(), ProcessContentStage(None, feedback), last]
+        pipeline = asyncio.wait_for(run_pipeline(stages), timeout=5)
+        asyncio.get_event_loop().run_until_complete(pipeline)
+        self.assertEqual(received, dcs)